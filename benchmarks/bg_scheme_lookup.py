@@ -0,0 +1,57 @@
+"""Benchmark of the state aid scheme lookup used in `bg export`.
+
+Compares the per-row scan of the stateaid dataframe with the
+`StateAidIndex` lookup, on synthetic program codes sampled from the
+test fixtures.
+
+Usage:
+
+    python -m benchmarks.bg_scheme_lookup [n_rows]
+"""
+import sys
+import time
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+import typer
+
+from eu_state_aids.bg import StateAidIndex
+
+fixtures_path = Path(__file__).parent.parent / "tests"
+
+
+def scan_lookup(stateaid_df: pd.DataFrame, codes: pd.Series) -> pd.Series:
+    """The per-row lookup, as it was implemented before the index."""
+    def lookup_prog_id(x):
+        has_x = stateaid_df[stateaid_df.iloc[:, 1].str.contains(x, regex=False)]
+        if not has_x.empty:
+            return has_x.iloc[0, 0].split(',')[0]
+        else:
+            return np.NAN
+    return codes.apply(lookup_prog_id)
+
+
+def main(n_rows: int = 100000):
+    stateaid_df = pd.read_excel(fixtures_path / "bg_state_aids.xlsx", header=1).iloc[:, :10]
+    eu_df = pd.read_excel(fixtures_path / "bg_projects_sample.xlsx", header=3)[:-6]
+    sample_codes = eu_df['Project proposal number'].dropna().str.rsplit('-', n=1).str[0]
+    codes = sample_codes.sample(n=n_rows, replace=True, random_state=42).reset_index(drop=True)
+    typer.echo(f"{len(codes)} rows, {codes.nunique()} distinct codes, {len(stateaid_df)} schemes")
+
+    start = time.perf_counter()
+    indexed = StateAidIndex(stateaid_df).assign(codes)
+    indexed_time = time.perf_counter() - start
+    typer.echo(f"index: {indexed_time:.3f}s")
+
+    start = time.perf_counter()
+    scanned = scan_lookup(stateaid_df, codes)
+    scan_time = time.perf_counter() - start
+    typer.echo(f"scan:  {scan_time:.3f}s")
+
+    assert indexed.fillna('').tolist() == scanned.fillna('').tolist()
+    typer.echo(f"speedup: {scan_time / indexed_time:.0f}x")
+
+
+if __name__ == "__main__":
+    main(*[int(a) for a in sys.argv[1:]])
@@ -0,0 +1,188 @@
+"""Generators of synthetic, realistic inputs for the benchmarks.
+
+Generated files have the same layout as the real sources:
+
+- zipped Aiuti and Misure XML files, as published in the RNA mirror,
+  with nested `COMPONENTI_AIUTO/STRUMENTI_AIUTO` elements and numeric character references;
+- Bulgarian eufunds projects excel files, with the header on the 4th line and 6 rows of notes at the end;
+- the Bulgarian stateaid excel file, with scheme codes and descriptions mentioning the programs.
+
+Aiuti files are written as a stream, so that files of any size can be generated in constant memory.
+All generators are deterministic, given the seed.
+"""
+import random
+import zipfile
+from pathlib import Path
+from typing import List, Union
+
+from openpyxl import Workbook
+
+FONDI = ['FESR', 'FSE', 'FEASR', 'FEAMP']
+PROJECT_COLUMNS = [
+    'Beneficiary', 'Address', 'Location', 'Project proposal number', 'Project Name', 'Total', 'Grant',
+    'Self-financing by the Beneficiary', 'Actual amounts paid', 'Duration (months)',
+    'Status of Implementation of the Contract/Order of the Grant'
+]
+STATEAID_COLUMNS = [
+    'Номер на мярката', 'Наименование на мярката', 'Администратор', 'Период на прилагане',
+    'Съфинансирана мярка (Да/Не)', 'Общ бюджет в млн. лв.', 'Годишен бюджет в млн. лв.',
+    'Цел на мярката', 'Инструмент на подпомагане', 'Докладвано от администратора'
+]
+
+
+def measure_codes(n_measures: int, seed: int = 42) -> List[int]:
+    """Generate n_measures distinct CE codes numbers."""
+    return random.Random(seed).sample(range(10000, 100000), n_measures)
+
+
+def program_codes(n_programs: int, seed: int = 42) -> List[str]:
+    """Generate n_programs distinct program codes, in the `BG16RFOP002-2.001` format."""
+    rng = random.Random(seed)
+    codes = set()
+    while len(codes) < n_programs:
+        codes.add(f"BG{rng.choice(['05M2', '16RF', '16M1', '14MF'])}OP00{rng.randint(1, 9)}-"
+                  f"{rng.randint(1, 9)}.{rng.randint(1, 120):03}")
+    return sorted(codes)
+
+
+def _cod_ce(rng: random.Random, codes: List[int]) -> str:
+    """A CE code, in one of the formats found in the sources, sometimes invalid."""
+    r = rng.random()
+    if r < 0.05:
+        return f"X{rng.choice(codes)}"
+    return f"SA{'.' if r < 0.8 else ' '}{rng.choice(codes)}"
+
+
+def _aiuto(rng: random.Random, codes: List[int], n: int) -> str:
+    """An AIUTO element, with 1 to 3 components of 1 to 3 instruments each."""
+    def strumenti():
+        return "".join(
+            f"<STRUMENTO_AIUTO><COD_STRUMENTO>{rng.randint(1, 20)}</COD_STRUMENTO>"
+            f"<IMPORTO_NOMINALE>{rng.randint(100, 10 ** 6) / 100}</IMPORTO_NOMINALE>"
+            f"<ELEMENTO_DI_AIUTO>{rng.randint(100, 10 ** 5) / 100}</ELEMENTO_DI_AIUTO></STRUMENTO_AIUTO>"
+            for _ in range(rng.randint(1, 3))
+        )
+    componenti = "".join(
+        f"<COMPONENTE_AIUTO><ID_COMPONENTE_AIUTO>{n * 10 + c}</ID_COMPONENTE_AIUTO>"
+        f"<COD_PROCEDIMENTO>{rng.randint(1, 99)}</COD_PROCEDIMENTO>"
+        f"<STRUMENTI_AIUTO>{strumenti()}</STRUMENTI_AIUTO></COMPONENTE_AIUTO>"
+        for c in range(rng.randint(1, 3))
+    )
+    cod_ce = f"<COD_CE_MISURA>{_cod_ce(rng, codes)}</COD_CE_MISURA>" if rng.random() < 0.9 else ""
+    beneficiary = rng.randint(0, 10 ** 5)
+    return (
+        f"<AIUTO><CAR>{rng.randint(1, 20000)}</CAR><TITOLO_MISURA>Misura di aiuto n. {rng.randint(1, 999)}"
+        f"</TITOLO_MISURA>{cod_ce}<COR>{n}</COR><TITOLO_PROGETTO>Progetto d&#8217;impresa n. {n}</TITOLO_PROGETTO>"
+        f"<DATA_CONCESSIONE>2019-03-{rng.randint(1, 28):02}</DATA_CONCESSIONE>"
+        f"<DENOMINAZIONE_BENEFICIARIO>IMPRESA {beneficiary} S.R.L. &#8211; &#232;</DENOMINAZIONE_BENEFICIARIO>"
+        f"<CODICE_FISCALE_BENEFICIARIO>{beneficiary:011}</CODICE_FISCALE_BENEFICIARIO>"
+        f"<REGIONE_BENEFICIARIO>Lazio</REGIONE_BENEFICIARIO>"
+        f"<COMPONENTI_AIUTO>{componenti}</COMPONENTI_AIUTO></AIUTO>\n"
+    )
+
+
+def write_aiuti_zip(filepath: Union[str, Path], size_mb: float, codes: List[int], seed: int = 42) -> int:
+    """Write a zipped Aiuti XML file of about size_mb uncompressed megabytes.
+
+    :param filepath: the zip file path
+    :param size_mb: the size of the uncompressed XML content, in MB
+    :param codes: the CE codes numbers of the aids' measures
+    :param seed: the random seed
+    :return: the number of AIUTO elements written
+    """
+    rng = random.Random(seed)
+    size = int(size_mb * 1024 * 1024)
+    n, written = 0, 0
+    with zipfile.ZipFile(filepath, "w", compression=zipfile.ZIP_DEFLATED) as z:
+        with z.open("OpenData_Aiuti.xml", "w", force_zip64=True) as f:
+            written += f.write(b'<?xml version="1.0" encoding="UTF-8"?>\n<LISTA_AIUTI>\n')
+            while written < size:
+                chunk = "".join(_aiuto(rng, codes, n + i) for i in range(1000)).encode()
+                written += f.write(chunk)
+                n += 1000
+            f.write(b"</LISTA_AIUTI>\n")
+    return n
+
+
+def write_misure_zip(filepath: Union[str, Path], codes: List[int], seed: int = 42):
+    """Write a zipped Misure XML file, with a measure for each CE code,
+    some of which are not co-financed.
+
+    :param filepath: the zip file path
+    :param codes: the CE codes numbers of the measures
+    :param seed: the random seed
+    """
+    rng = random.Random(seed)
+    misure = []
+    for code in codes:
+        cofinanziamenti = "".join(
+            f"<COFINANZIAMENTO><COD_FONDO>{i}</COD_FONDO><DESCRIZIONE_FONDO>{fondo}</DESCRIZIONE_FONDO>"
+            f"<IMPORTO>{rng.randint(1, 10 ** 6)}</IMPORTO></COFINANZIAMENTO>"
+            for i, fondo in enumerate(rng.sample(FONDI, rng.randint(1, 2)))
+        )
+        lista = f"<LISTA_COFINANZIAMENTI>{cofinanziamenti}</LISTA_COFINANZIAMENTI>" if rng.random() < 0.7 else ""
+        misure.append(
+            f"<MISURA><COD_CE>SA{rng.choice('. ')}{code}</COD_CE><TITOLO>Misura {code}</TITOLO>{lista}</MISURA>"
+        )
+    with zipfile.ZipFile(filepath, "w", compression=zipfile.ZIP_DEFLATED) as z:
+        z.writestr("OpenData_Misura.xml", (
+            '<?xml version="1.0" encoding="UTF-8"?>\n'
+            '<ns0:LISTA_MISURE_TYPE xmlns:ns0="http://www.rna.gov.it/misure">\n'
+            + "\n".join(misure) + "\n</ns0:LISTA_MISURE_TYPE>\n"
+        ))
+
+
+def write_bg_projects_xlsx(filepath: Union[str, Path], n_rows: int, programs: List[str], seed: int = 42):
+    """Write a Bulgarian eufunds projects excel file, with n_rows projects.
+
+    :param filepath: the excel file path
+    :param n_rows: the number of projects
+    :param programs: the program codes of the projects
+    :param seed: the random seed
+    """
+    rng = random.Random(seed)
+    wb = Workbook(write_only=True)
+    ws = wb.create_sheet()
+    ws.append([])
+    ws.append(['Projects'] * 10)
+    ws.append([])
+    ws.append(PROJECT_COLUMNS)
+    for n in range(n_rows):
+        total = rng.randint(10 ** 4, 10 ** 8) / 100
+        grant = round(total * rng.random(), 2)
+        beneficiary = f"{rng.randint(10 ** 8, 10 ** 9)} Company {n} Ltd" if rng.random() < 0.97 else "Company Ltd"
+        proposal = f"{rng.choice(programs)}-{rng.randint(1, 9999):04}" if rng.random() < 0.98 else None
+        ws.append([
+            beneficiary, f"Bulgaria, Sofia, 1000, ul. {n}", 'Sofia', proposal, f"Project {n}",
+            total, grant, round(total - grant, 2), grant, rng.randint(6, 48), 'Closed (completion date)'
+        ])
+    ws.append([])
+    for note in ['Notes:', 'Elements in light blue allow detailed view when selected',
+                 'All amounts are in Bulgarian lev (BGN) / 1 EUR = 1,95583 BGN',
+                 'Project cost information in the regions', 'The information about the actually paid amounts']:
+        ws.append([note] * 10)
+    wb.save(filepath)
+
+
+def write_bg_stateaid_xlsx(filepath: Union[str, Path], programs: List[str], codes: List[int], seed: int = 42):
+    """Write the Bulgarian stateaid excel file, with a scheme for each CE code,
+    mentioning some of the programs in its description.
+
+    :param filepath: the excel file path
+    :param programs: the program codes
+    :param codes: the CE codes numbers of the schemes
+    :param seed: the random seed
+    """
+    rng = random.Random(seed)
+    wb = Workbook(write_only=True)
+    ws = wb.create_sheet()
+    ws.append(['Регистър на схемите за държавни помощи'])
+    ws.append(STATEAID_COLUMNS)
+    for code in codes:
+        program = rng.choice(programs)
+        ws.append([
+            f"SA.{code},  изм. c SA.{code + 1}" if rng.random() < 0.1 else f"SA.{code}",
+            f"{program} „Подкрепа за предприятията“" if rng.random() < 0.8 else f"Схема {code}",
+            'МИ', '2014-2020', 'Да', rng.randint(1, 100), rng.randint(1, 10), 'Регионално развитие', 'Грант', 0
+        ])
+    wb.save(filepath)
@@ -0,0 +1,294 @@
+"""End to end and per stage benchmarks of `bg export`, `it export` and `it generate-measures`,
+on synthetic inputs generated by `benchmarks.generators`.
+
+Inputs are generated once for each size, under `benchmarks/data/{size}`, and remote
+files are served by a local HTTP server. Each benchmark runs in a fresh process,
+whose peak RSS is recorded along with the timings of the stages, and the memory used by the
+intermediate frames, with their compact dtypes and with object dtypes, as they were before.
+Results are appended to `benchmarks/results.jsonl`, tagged with the package version
+and the git commit, so that they can be compared across versions.
+
+Usage:
+
+    python -m benchmarks.pipeline run [--size small|medium|large] [--only bg,it_export,it_measures]
+    python -m benchmarks.pipeline compare
+"""
+import contextlib
+import functools
+import io
+import json
+import multiprocessing
+import os
+import platform
+import shutil
+import subprocess
+import tempfile
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+from http.server import SimpleHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from typing import Callable, Dict, Tuple
+
+import pandas as pd
+import typer
+
+from benchmarks import generators
+from eu_state_aids import __version__, bg, it, schema
+from eu_state_aids.download import download_many
+from eu_state_aids.metrics import peak_rss_mb
+
+app = typer.Typer()
+
+benchmarks_path = Path(__file__).parent
+data_path = benchmarks_path / "data"
+results_path = benchmarks_path / "results.jsonl"
+
+# input sizes: uncompressed size of the Aiuti XML file, number of projects of the bg excel file
+SIZES = {
+    "small": {"aiuti_mb": 10, "bg_rows": 10000},
+    "medium": {"aiuti_mb": 100, "bg_rows": 100000},
+    "large": {"aiuti_mb": 1024, "bg_rows": 500000},
+}
+N_MEASURES = 5000
+N_PROGRAMS = 300
+YEAR, MONTH = "2019", 3
+
+
+def generate_inputs(size: str) -> Path:
+    """Generate the inputs of the given size, unless already there, and return their path."""
+    path = data_path / size
+    if os.path.exists(path / ".complete"):
+        return path
+    typer.echo(f"Generating {size} inputs into {path}")
+    for subdir in ["bg", "it", "rna_mirror/OpenDataMisure"]:
+        os.makedirs(path / subdir, exist_ok=True)
+
+    # only 3 out of 5 aids' codes are measures, so that the join filters records out
+    codes = generators.measure_codes(N_MEASURES)
+    misure_codes = codes[:N_MEASURES * 3 // 5]
+    for n, (year, month) in enumerate(it.misure_periods()):
+        generators.write_misure_zip(
+            path / "rna_mirror" / "OpenDataMisure" / f"OpenData_Misura_{year}_{month:02}.xml.zip",
+            misure_codes[n * 30:n * 30 + 200], seed=n
+        )
+    generators.write_aiuti_zip(path / "it" / f"aiuti_{YEAR}_{MONTH:02}.xml.zip", SIZES[size]["aiuti_mb"], codes)
+
+    programs = generators.program_codes(N_PROGRAMS)
+    generators.write_bg_projects_xlsx(path / "bg" / f"projects_{YEAR}.xlsx", SIZES[size]["bg_rows"], programs)
+    generators.write_bg_stateaid_xlsx(path / "stateaid.xlsx", programs, codes[:N_PROGRAMS])
+
+    (path / ".complete").touch()
+    return path
+
+
+@contextlib.contextmanager
+def serve(path: Path):
+    """Serve the files in path with a local HTTP server, yielding its base url."""
+    class QuietHandler(SimpleHTTPRequestHandler):
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), functools.partial(QuietHandler, directory=str(path)))
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    try:
+        yield f"http://127.0.0.1:{server.server_port}"
+    finally:
+        server.shutdown()
+
+
+class Stages:
+    """Timer of the stages of a benchmark, recording the memory used by its frames too."""
+
+    def __init__(self):
+        self.seconds = {}
+        self.frames_mb = {}
+
+    @contextlib.contextmanager
+    def __call__(self, name: str):
+        start = time.perf_counter()
+        yield
+        self.seconds[name] = round(time.perf_counter() - start, 4)
+
+    def frame(self, name: str, df: pd.DataFrame):
+        """Record the memory used by df, with its compact dtypes and with categoricals as object strings."""
+        objects = df.astype({c: object for c in df.columns if schema.is_categorical(df[c])})
+        self.frames_mb[name] = {
+            "compact": round(df.memory_usage(deep=True).sum() / 1024 ** 2, 2),
+            "object": round(objects.memory_usage(deep=True).sum() / 1024 ** 2, 2),
+        }
+
+
+def bench_bg(path: Path, base_url: str, end_to_end: bool) -> Stages:
+    local_path = path / "bg"
+    shutil.rmtree(local_path / "cache", ignore_errors=True)
+    # projects are read from the excel file, the converted copy is timed separately
+    if os.path.exists(local_path / f"projects_{YEAR}.parquet"):
+        os.unlink(local_path / f"projects_{YEAR}.parquet")
+    stateaid_url = f"{base_url}/stateaid.xlsx"
+    stages = Stages()
+    if end_to_end:
+        with stages("end_to_end"):
+            bg.export(
+                YEAR, local_path=str(local_path), stateaid_url=stateaid_url, program_start_year="2014", offline=False,
+                force=True, results_db=None, output_format="csv", delta=False
+            )
+        return stages
+
+    with stages("load_stateaid"):
+        stateaid_df = bg.load_stateaid(stateaid_url, local_path / "cache" / "stateaid")
+    with stages("build_index"):
+        index = bg.StateAidIndex(stateaid_df)
+    with stages("read_projects"):
+        eu_df = bg.read_projects(YEAR, local_path)
+    with stages("convert"):
+        bg.convert(YEAR, str(local_path))
+    with stages("read_converted"):
+        bg.read_projects(YEAR, local_path)
+    os.unlink(local_path / f"projects_{YEAR}.parquet")
+    with stages("transform"):
+        eu_df = bg.transform_projects(eu_df, YEAR, "2014", index)
+    stages.frame("projects", eu_df)
+    with stages("write_csv"):
+        eu_df.to_csv(local_path / f"{YEAR}.csv", na_rep='', index=False)
+    return stages
+
+
+def bench_it_export(path: Path, base_url: str, end_to_end: bool) -> Stages:
+    local_path = path / "it"
+    if not os.path.exists(local_path / "misure.csv"):
+        df = pd.concat(it.parse_misure(f) for f in sorted((path / "rna_mirror" / "OpenDataMisure").iterdir()))
+        df.drop_duplicates().to_csv(local_path / "misure.csv", index=False)
+    stages = Stages()
+    if end_to_end:
+        with stages("end_to_end"):
+            it.export(
+                f"{YEAR}_{MONTH:02}", local_path=str(local_path), delete_processed=False, workers=1, store_parsed=False,
+                memory_budget=None, stream=False, force=True, shards=1, results_db=None, output_format="csv",
+                delta=False
+            )
+        return stages
+
+    with stages("read_misure"):
+        misure_df = schema.compact(pd.read_csv(local_path / "misure.csv"), schema.MISURE_DTYPES)
+    with stages("parse"):
+        adf = it.parse_aiuti(local_path / f"aiuti_{YEAR}_{MONTH:02}.xml.zip")
+    stages.frame("aiuti", adf)
+    with stages("parse_pushdown"):
+        pushed_down = it.parse_aiuti(local_path / f"aiuti_{YEAR}_{MONTH:02}.xml.zip", it.build_misure_lookup(misure_df))
+    stages.frame("aiuti_pushdown", pushed_down)
+    # files smaller than it.SHARD_MIN_SIZE are parsed as a whole
+    with stages("parse_shards"):
+        sharded = it.parse_aiuti(local_path / f"aiuti_{YEAR}_{MONTH:02}.xml.zip", shards=4)
+    assert len(sharded) == len(adf)
+    with stages("sum_matches"):
+        sums = it.sum_matches(adf, misure_df)
+    stages.frame("sums", sums)
+    with stages("write_csv"):
+        sums.to_csv(local_path / f"{YEAR}_{MONTH:02}.csv", index=False)
+    return stages
+
+
+def bench_it_measures(path: Path, base_url: str, end_to_end: bool) -> Stages:
+    it.rna_mirror_url = base_url + "/rna_mirror"
+    local_path = Path(tempfile.mkdtemp(prefix="misure_"))
+    stages = Stages()
+    try:
+        if end_to_end:
+            with stages("end_to_end"):
+                it.generate_measures(local_path=str(local_path), since=None, force=True, output_format="csv")
+            return stages
+
+        periods = it.misure_periods()
+        filepaths = [local_path / f"misure_{y}_{m:02}.xml.zip" for y, m in periods]
+        with stages("fetch"):
+            download_many(zip([it.build_misure_url(*p) for p in periods], filepaths))
+        with stages("parse"):
+            df = pd.concat(it.parse_misure(f) for f in filepaths).drop_duplicates()
+        with stages("write_csv"):
+            df.to_csv(local_path / "misure.csv", index=False)
+        return stages
+    finally:
+        shutil.rmtree(local_path)
+
+
+BENCHMARKS = {
+    "bg": bench_bg,
+    "it_export": bench_it_export,
+    "it_measures": bench_it_measures,
+}
+
+
+def _measure(func: Callable, *args) -> Tuple[Dict[str, float], Dict[str, dict], float]:
+    """Call func, quietly, returning its timings, its frames' memory and the peak RSS of the process."""
+    with contextlib.redirect_stdout(io.StringIO()):
+        stages = func(*args)
+    return stages.seconds, stages.frames_mb, peak_rss_mb()
+
+
+def run_isolated(func: Callable, *args) -> Tuple[Dict[str, float], Dict[str, dict], float]:
+    """Run func in a fresh process, so that peak RSS measures func only."""
+    with ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context("spawn")) as executor:
+        return executor.submit(_measure, func, *args).result()
+
+
+def git_commit() -> str:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], cwd=benchmarks_path, capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+@app.command()
+def run(
+    size: str = typer.Option("small", help="Size of the inputs: small, medium or large"),
+    only: str = typer.Option(None, help="Comma separated benchmarks to run, defaults to all"),
+    results_file: str = typer.Option(str(results_path), help="File the results are appended to"),
+):
+    """Run the benchmarks, appending their results to the results file."""
+    assert(size in SIZES)
+    names = only.split(",") if only else list(BENCHMARKS)
+    assert(all(name in BENCHMARKS for name in names))
+
+    path = generate_inputs(size)
+    with serve(path) as base_url:
+        for name in names:
+            stages, frames_mb, _ = run_isolated(BENCHMARKS[name], path, base_url, False)
+            end_to_end, _, rss = run_isolated(BENCHMARKS[name], path, base_url, True)
+            result = {
+                "date": datetime.now().isoformat(timespec="seconds"),
+                "version": __version__,
+                "commit": git_commit(),
+                "python": platform.python_version(),
+                "benchmark": name,
+                "size": size,
+                "stages": stages,
+                "end_to_end": end_to_end["end_to_end"],
+                "peak_rss_mb": rss,
+                "frames_mb": frames_mb,
+            }
+            typer.echo(
+                f"{name} ({size}): {result['end_to_end']:.2f}s end to end, {rss} MB peak RSS, stages: "
+                + ", ".join(f"{k} {v:.2f}s" for k, v in stages.items())
+            )
+            for frame, mb in frames_mb.items():
+                typer.echo(f"  {frame} frame: {mb['compact']} MB compact, {mb['object']} MB with object dtypes")
+            with open(results_file, "a") as f:
+                f.write(json.dumps(result) + "\n")
+
+
+@app.command()
+def compare(results_file: str = typer.Option(str(results_path), help="File with the results")):
+    """Show the latest results of each benchmark, size and version, to spot regressions."""
+    with open(results_file) as f:
+        df = pd.DataFrame([json.loads(line) for line in f if line.strip()])
+    df = df.sort_values("date").groupby(["benchmark", "size", "version", "commit"], dropna=False).last()
+    typer.echo(df[["date", "end_to_end", "peak_rss_mb"]].to_string())
+
+
+if __name__ == "__main__":
+    app()
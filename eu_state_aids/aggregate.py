@@ -0,0 +1,113 @@
+import os
+import shutil
+import tempfile
+from pathlib import Path
+from typing import List, Optional, Union
+
+import pandas as pd
+
+from eu_state_aids.schema import is_categorical, unify_categories
+
+
+class PartialSums:
+    """Map-reduce aggregation of sums by keys, with bounded memory.
+
+    Partial sums (ie: the sums of a month's records) are added as they are computed,
+    and combined together whenever their memory usage exceeds `memory_budget`;
+    within the budget, they are all combined at once, at the end,
+    so that a budget changes the order values are added in, and possibly the last digits of their sums.
+    When the combined partial sums still exceed the budget, they are spilled to disk,
+    split into `n_buckets` files by the hash of their keys, so that at the end each
+    bucket can be combined separately.
+
+    Missing keys are kept as groups of their own, and partial sums are always
+    combined in the order they were added.
+    Categorical keys are grouped by their codes, their categories being unified first.
+    """
+
+    def __init__(
+        self, keys: List[str], values: List[str],
+        memory_budget: Optional[int] = None, spill_path: Optional[Union[str, Path]] = None, n_buckets: int = 16
+    ):
+        """
+        :param keys: the key columns
+        :param values: the value columns, to be summed
+        :param memory_budget: max memory used by partial sums, in bytes, None for no limit
+        :param spill_path: directory where the temporary spill directory is created, defaults to the system's
+        :param n_buckets: number of buckets partial sums are split into, when spilled
+        """
+        self.keys = keys
+        self.values = values
+        self.memory_budget = memory_budget
+        self.spill_path = spill_path
+        self.n_buckets = n_buckets
+
+        self.partials = []
+        self.memory_usage = 0
+        self.spill_dir = None
+        self.n_spills = 0
+
+    def combine(self, dfs: List[pd.DataFrame], sort: bool = False) -> pd.DataFrame:
+        """Combine partial sums (or records) into sums by keys."""
+        dfs = [df for df in dfs if len(df)]
+        if not dfs:
+            return pd.DataFrame(columns=self.keys + self.values)
+        df = pd.concat(unify_categories(dfs), ignore_index=True)
+
+        # missing categorical keys have code -1, so they are grouped as any other code
+        categorical = [k for k in self.keys if is_categorical(df[k])]
+        by = [df[k].cat.codes.rename(k) if k in categorical else df[k] for k in self.keys]
+        sums = df.groupby(by, dropna=False, sort=sort)[self.values].sum().reset_index()
+        for k in categorical:
+            sums[k] = pd.Categorical.from_codes(sums[k], dtype=df[k].dtype)
+        return sums
+
+    def add(self, df: pd.DataFrame):
+        """Add partial sums, combining or spilling them when over the memory budget."""
+        self.partials.append(df)
+        if self.memory_budget is None:
+            return
+
+        self.memory_usage += int(df.memory_usage(deep=True).sum())
+        if self.memory_usage > self.memory_budget:
+            combined = self.combine(self.partials)
+            self.partials = [combined]
+            self.memory_usage = int(combined.memory_usage(deep=True).sum())
+            if self.memory_usage > self.memory_budget:
+                self.spill()
+
+    def spill(self):
+        """Write partial sums to disk, split into buckets by the hash of their keys."""
+        if self.spill_dir is None:
+            self.spill_dir = Path(tempfile.mkdtemp(prefix="spill_", dir=self.spill_path))
+        df = self.combine(self.partials)
+        buckets = pd.util.hash_pandas_object(df[self.keys], index=False) % self.n_buckets
+        for bucket, bdf in df.groupby(buckets.values):
+            bdf.to_pickle(self.spill_dir / f"bucket_{bucket:03}_{self.n_spills:05}.pkl")
+        self.n_spills += 1
+        self.partials = []
+        self.memory_usage = 0
+
+    def result(self) -> pd.DataFrame:
+        """Combine all partial sums into the final sums by keys, sorted by keys.
+
+        Temporary spill files are removed.
+        """
+        if self.spill_dir is None:
+            return self.combine(self.partials, sort=True)
+
+        try:
+            if self.partials:
+                self.spill()
+            buckets = []
+            for bucket in range(self.n_buckets):
+                buckets.append(self.combine([
+                    pd.read_pickle(self.spill_dir / f"bucket_{bucket:03}_{n:05}.pkl")
+                    for n in range(self.n_spills)
+                    if os.path.exists(self.spill_dir / f"bucket_{bucket:03}_{n:05}.pkl")
+                ]))
+            # keys are distinct across buckets, so this only sorts them
+            return self.combine(buckets, sort=True)
+        finally:
+            shutil.rmtree(self.spill_dir)
+            self.spill_dir = None
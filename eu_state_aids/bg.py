@@ -1,17 +1,158 @@
+from __future__ import annotations
+
+import bisect
+import math
 import os
-from io import BytesIO
+import time
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+from itertools import accumulate
 from pathlib import Path
+from typing import TYPE_CHECKING, List, Optional, Tuple, Union
 
-import numpy as np
-import pandas as pd
 import requests
 import typer
 import validators
 
+from eu_state_aids import metrics
+from eu_state_aids.download import (MAX_WORKERS, download,
+                                    download_if_modified, download_many)
 from eu_state_aids.utils import validate_year
 
+# pandas is only imported by the commands processing data, so that fetch commands start fast
+if TYPE_CHECKING:
+    import pandas as pd
+
+    from eu_state_aids.manifest import Manifest
+    from eu_state_aids.pipeline import Task
+
 app = typer.Typer()
 
+DEFAULT_STATEAID_URL = "https://stateaid.minfin.bg/document/860"
+
+
+# years are mapped to their codes (sic)
+years_encoding = {
+    '2014': '3xRCSNcrgNc%3D',
+    '2015': '8U%2BIPGXBzzM%3D',
+    '2016': 'L35Wg8m16s0%3D',
+    '2017': 'wxlx7atW%2FuQ%3D',
+    '2018': 'DrjrB6YmlCo%3D',
+    '2019': 'c3E0NC9D3EE%3D',
+    '2020': 'ip23bQ8hOOQ%3D',
+    '2021': 'mwei5Zc2UEA%3D',
+    '2022': '2Q0LfOC9lQ4%3D',
+    '2023': 'VuK356PVlaY%3D'
+}
+
+
+def build_excel_url(year: str) -> str:
+    """Build the url of the eufunds excel file for the given year."""
+    return f"http://2020.eufunds.bg/en/0/0/Project/ExportToExcel?StFrom={years_encoding[year]}&" \
+        f"StTo={years_encoding[year]}&ShowRes=True&IsProgrammeSelected=False&IsRegionSelected=False"
+
+
+# version of the stateaid parsing logic, cached dataframes of other versions are parsed again
+STATEAID_CACHE_VERSION = "1"
+
+
+def load_stateaid(stateaid_url: str, cache_path: Union[str, Path], offline: bool = False) -> Optional[pd.DataFrame]:
+    """Load the stateaid dataframe, out of the stateaid excel file.
+
+    The excel file and the dataframe parsed out of it are cached in cache_path.
+    The cached dataframe is used when the remote file was not modified since it was
+    fetched (as told by its ETag and Last-Modified headers), when its content did not change,
+    and when working offline.
+
+    :param stateaid_url: URL of stateaid excel file
+    :param cache_path: path of the cache directory
+    :param offline: only use the cached dataframe
+    :return: the dataframe, with the first 10 columns of the file, None when working offline with no cache
+    """
+    import pandas as pd
+
+    from eu_state_aids.cache import ParsedCache, file_checksum
+
+    cache = ParsedCache(cache_path, version=STATEAID_CACHE_VERSION)
+    entry = cache.get(stateaid_url)
+    if offline:
+        if entry is None:
+            typer.echo(f"No cached stateaid data for {stateaid_url}, can not work offline")
+            return None
+        typer.echo(f"Using cached stateaid data for {stateaid_url}")
+        return cache.load(stateaid_url)
+
+    # the stateaid file is fetched (download), unless not modified
+    typer.echo(f"Fetching stateaid data at {stateaid_url}")
+    filepath = cache.source_path(stateaid_url, ".xlsx")
+    entry = entry or {}
+    try:
+        result = download_if_modified(stateaid_url, filepath, entry.get("etag"), entry.get("last_modified"))
+    except requests.RequestException as e:
+        if not entry:
+            raise
+        typer.echo(f"Error {e} while fetching stateaid data, using cached data")
+        return cache.load(stateaid_url)
+
+    checksum = file_checksum(filepath) if result is not None else None
+    if result is None or checksum == entry.get("checksum"):
+        typer.echo("Stateaid data not modified, using cached data")
+        if result is not None:
+            cache.update(stateaid_url, **result)
+            cache.save()
+        return cache.load(stateaid_url)
+
+    # DataFrame is created out of the local file
+    # the header starts at the 1st line
+    # only the first 10 columns are kept
+    with metrics.stage("read_stateaid") as counters:
+        stateaid_df = pd.read_excel(filepath, header=1)
+        stateaid_df = stateaid_df.iloc[:, :10]
+        counters.update(bytes_read=os.path.getsize(filepath), rows_out=len(stateaid_df))
+
+    cache.store(stateaid_url, stateaid_df, checksum, **result)
+    cache.save()
+    return stateaid_df
+
+
+class StateAidIndex:
+    """Index of the state aid schemes found in the stateaid excel file,
+    to look up the scheme of many program codes at once.
+
+    The scheme of a code is the one in the first row of the stateaid dataframe
+    whose description (2nd column) contains the code, as a literal substring.
+    Descriptions are joined into a single text, so that each distinct code
+    is looked up with one `str.find`, and its first occurrence in the
+    text gives the first matching row.
+    """
+
+    separator = "\0"
+
+    def __init__(self, stateaid_df: pd.DataFrame):
+        descriptions = [d if isinstance(d, str) else "" for d in stateaid_df.iloc[:, 1]]
+        self.schemes = [
+            s.split(',')[0] if isinstance(s, str) else math.nan for s in stateaid_df.iloc[:, 0]
+        ]
+        self.text = self.separator.join(descriptions)
+
+        # offsets of the end of each description in the text
+        lengths = accumulate(len(d) + len(self.separator) for d in descriptions)
+        self.ends = [end - len(self.separator) for end in lengths]
+
+    def lookup(self, code: str):
+        """Return the scheme of the first row whose description contains code, NaN if none does."""
+        if not code or self.separator in code:
+            return math.nan
+        pos = self.text.find(code)
+        if pos < 0:
+            return math.nan
+        return self.schemes[bisect.bisect_right(self.ends, pos)]
+
+    def assign(self, codes: pd.Series) -> pd.Series:
+        """Return the schemes of all codes, looking up each distinct code only once."""
+        mapping = {code: self.lookup(code) for code in codes.dropna().unique()}
+        return codes.map(mapping)
+
 
 @app.command()
 def fetch(
@@ -33,20 +174,6 @@ def fetch(
     # script parameters validations
     assert(validate_year(year))
 
-    # years are mapped to their codes (sic)
-    years_encoding = {
-        '2014': '3xRCSNcrgNc%3D',
-        '2015': '8U%2BIPGXBzzM%3D',
-        '2016': 'L35Wg8m16s0%3D',
-        '2017': 'wxlx7atW%2FuQ%3D',
-        '2018': 'DrjrB6YmlCo%3D',
-        '2019': 'c3E0NC9D3EE%3D',
-        '2020': 'ip23bQ8hOOQ%3D',
-        '2021': 'mwei5Zc2UEA%3D',
-        '2022': '2Q0LfOC9lQ4%3D',
-        '2023': 'VuK356PVlaY%3D'
-    }
-
     # create directory if not existing
     local_path = Path(local_path)
     if not os.path.exists(local_path):
@@ -54,113 +181,214 @@ def fetch(
 
     # build remote url and filepath, out of the year,
     typer.echo(f"Fetching EU data for year: {year}")
-    excel_url = f"http://2020.eufunds.bg/en/0/0/Project/ExportToExcel?StFrom={years_encoding[year]}&" \
-        f"StTo={years_encoding[year]}&ShowRes=True&IsProgrammeSelected=False&IsRegionSelected=False"
+    excel_url = build_excel_url(year)
 
-    # read remote excel file content
-    r = requests.get(excel_url)
-
-    # store it locally
+    # stream remote excel file content into the local file
     filepath = local_path / f"projects_{year}.xlsx"
-    with open(filepath, 'wb') as f:
-        f.write(r.content)
-    typer.echo(f"File saved to {filepath}")
+    with metrics.stage("fetch", year=int(year)):
+        downloaded = download(excel_url, filepath)
+    if downloaded:
+        typer.echo(f"File saved to {filepath}")
+    else:
+        typer.echo("File not found")
 
 
 @app.command()
-def export(
-    year: str,
+def fetch_range(
+    start_year: str,
+    end_year: str,
     local_path: str = typer.Option(
         "./data/bg",
-        help="Local path to use for eufunds excel files. Leave unset to use eufunds.org source."
+        help="Local path to use for eufunds excel files. Always use forward slashes."
     ),
-    stateaid_url: str = typer.Option("https://stateaid.minfin.bg/document/860", help="URL of stateaid excel file"),
-    program_start_year: str = typer.Option("2014", help="Program's starting year"),
+    workers: int = typer.Option(MAX_WORKERS, help="Max number of concurrent downloads"),
 ):
-    """Read Excel file from local path, produces CSV output in the same local path.
+    """Fetch Excel files for all years from start_year to end_year (included),
+    downloading them concurrently, and store them locally.
 
-    Local path defaults to ./data/bg, and can be changed with local_path.
-    Uses pandas to read from Excel, transform the dataframe, and cross the data with
-    a second source to find out which of the EU funds are related to state aids.
+    Create the directory if it does not exist. Default directory is ./data/bg,
+    and it can be changed with local_path.
     """
 
     # script parameters validations
-    assert(validate_year(year))
-    assert(validate_year(program_start_year))
-    assert(validators.url(stateaid_url))
+    assert(validate_year(start_year))
+    assert(validate_year(end_year))
+    assert(workers >= 1)
+
+    # create directory if not existing
+    local_path = Path(local_path)
+    if not os.path.exists(local_path):
+        os.makedirs(local_path)
+
+    years = [str(y) for y in range(int(start_year), int(end_year) + 1)]
+    typer.echo(f"Fetching EU data for years: {', '.join(years)}")
+    filepaths = [local_path / f"projects_{year}.xlsx" for year in years]
+    results = download_many(
+        [(build_excel_url(year), filepath) for year, filepath in zip(years, filepaths)],
+        max_workers=workers
+    )
+    for year, filepath, result in zip(years, filepaths, results):
+        if result is True:
+            typer.echo(f"File saved to {filepath}")
+        elif result is False:
+            typer.echo(f"File not found for year: {year}")
+        else:
+            typer.echo(f"Error {result} while fetching year: {year}")
 
+
+# version of the projects' conversion logic, converted files of other versions are not used
+PROJECTS_CONVERSION_VERSION = "1"
+
+
+def read_projects_excel(excel_file: Union[str, Path]) -> pd.DataFrame:
+    """Read the eufunds projects out of an excel file.
+
+    :param excel_file: path of the excel file
+    :return: the projects' dataframe, notes excluded
+    """
     # read the dataframe from the local file
     # the header starts at the 4th line
     # the pandas.DataFrame is created reading from the excel file's url
-    typer.echo(f"Fetching EU data for year: {year}")
+    import pandas as pd
+
+    with metrics.stage("read_excel") as counters:
+        eu_df = pd.read_excel(f"file://localhost/{os.path.abspath(excel_file)}", header=3)
+
+        # The last 6 rows are removed from the dataframe, as they contain the notes
+        eu_df = eu_df[:-6]
+        counters.update(bytes_read=os.path.getsize(excel_file), rows_out=len(eu_df))
+    return eu_df
+
+
+def read_converted_projects(year: str, local_path: Union[str, Path]) -> Optional[pd.DataFrame]:
+    """Read the eufunds projects of the year from their Parquet copy in local_path,
+    if it is fresh: converted from the current excel file, by the current conversion logic.
+
+    The copy is used even if the excel file was removed.
+
+    :param year: the year
+    :param local_path: local path of the eufunds files
+    :return: the projects' dataframe, None if there is no fresh copy, or pyarrow is not installed
+    """
+    from eu_state_aids.cache import file_checksum
+    from eu_state_aids.partitions import read_table
+
     local_path = Path(local_path)
     excel_file = local_path / f"projects_{year}.xlsx"
-    eu_df = pd.read_excel(f"file://localhost/{os.path.abspath(excel_file)}", header=3)
+    parquet_file = local_path / f"projects_{year}.parquet"
+    if not os.path.exists(parquet_file):
+        return None
+
+    checksum = file_checksum(excel_file) if os.path.exists(excel_file) else None
+    with metrics.stage("read_converted") as counters:
+        try:
+            eu_df = read_table(parquet_file, PROJECTS_CONVERSION_VERSION, checksum)
+        except ImportError:
+            return None
+        counters.update(bytes_read=os.path.getsize(parquet_file), rows_out=0 if eu_df is None else len(eu_df))
+    return eu_df
+
 
-    # The last 6 rows are removed from the dataframe, as they contain the notes
-    eu_df = eu_df[:-6]
+def read_projects(year: str, local_path: Union[str, Path]) -> pd.DataFrame:
+    """Read the eufunds projects of the year, from the Parquet copy in local_path, when fresh,
+    from the excel file otherwise.
+
+    :param year: the year
+    :param local_path: local path of the eufunds files
+    :return: the projects' dataframe, notes excluded
+    """
+    typer.echo(f"Fetching EU data for year: {year}")
+    eu_df = read_converted_projects(year, local_path)
+    if eu_df is not None:
+        typer.echo(f"DataFrame with {len(eu_df)} rows read from {Path(local_path) / f'projects_{year}.parquet'}")
+        return eu_df
+
+    excel_file = Path(local_path) / f"projects_{year}.xlsx"
+    eu_df = read_projects_excel(excel_file)
     typer.echo(f"DataFrame with {len(eu_df)} rows created from {excel_file}")
+    return eu_df
 
-    # EU dataframe transformations
 
-    def lookup_name(x):
-        try:
-            return str(x).split(' ', 1)[1]
-        except IndexError:
-            return str(x)
-    eu_df['Name of the beneficiary'] = eu_df.Beneficiary.apply(lookup_name)
+def typed_projects(eu_df: pd.DataFrame) -> pd.DataFrame:
+    """Convert the columns of the projects' dataframe into their inferred types, so that they can be stored
+    as Parquet: numeric columns become numeric, and columns mixing strings and numbers (ie: beneficiaries
+    with no name) become strings, as they are treated by the transformations anyway.
+    """
+    eu_df = eu_df.infer_objects()
+    for column in eu_df.columns:
+        values = eu_df[column].dropna()
+        if eu_df[column].dtype == object and not values.map(lambda v: isinstance(v, str)).all():
+            eu_df[column] = eu_df[column].where(eu_df[column].isna(), eu_df[column].astype(str))
+    return eu_df
 
-    def lookup_id(x):
-        try:
-            return int(str(x).split(' ', 1)[0])
-        except ValueError:
-            return np.NAN
-    eu_df['ID of the beneficiary'] = eu_df.Beneficiary.apply(lookup_id)
-
-    def build_eu_prog_id(x):
-        splits = x.split('-', 1)
-        if len(splits) < 2:
-            return np.NAN
-        return program_start_year + x.split('-', 1)[0]
-    eu_df['European operation program (ID)'] = eu_df['Project proposal number'].apply(build_eu_prog_id)
+
+@app.command()
+def convert(
+    year: str,
+    local_path: str = typer.Option(
+        "./data/bg",
+        help="Local path to use for eufunds excel files. Always use forward slashes."
+    ),
+):
+    """Convert the Excel file of the year into a typed Parquet copy, stored next to it,
+    that the export commands read instead of the Excel file, as long as the Excel file is not changed.
+
+    Requires the pyarrow package, installed with the parquet extra.
+    """
+    from eu_state_aids.cache import file_checksum
+    from eu_state_aids.partitions import write_table
+
+    # script parameters validations
+    assert(validate_year(year))
+
+    local_path = Path(local_path)
+    excel_file = local_path / f"projects_{year}.xlsx"
+    if not os.path.exists(excel_file):
+        typer.echo(f"File {excel_file} not found, fetch it first")
+        return
+
+    typer.echo(f"Converting {excel_file}")
+    with metrics.stage("convert", hot=True, year=int(year)) as counters:
+        eu_df = typed_projects(read_projects_excel(excel_file))
+        parquet_file = local_path / f"projects_{year}.parquet"
+        write_table(parquet_file, eu_df, PROJECTS_CONVERSION_VERSION, file_checksum(excel_file))
+        counters["rows_out"] = len(eu_df)
+    typer.echo(f"DataFrame with {len(eu_df)} rows saved to {parquet_file}")
+
+
+def transform_projects(
+    eu_df: pd.DataFrame, year: str, program_start_year: str, stateaid_index: StateAidIndex
+) -> pd.DataFrame:
+    """Transform the eufunds projects' dataframe into the common format,
+    keeping only the projects related to state aids schemes.
+
+    :param eu_df: the projects' dataframe
+    :param year: the year
+    :param program_start_year: program's starting year
+    :param stateaid_index: the index of the state aid schemes
+    :return: the transformed dataframe, with the compact dtypes of schema.BG_DTYPES
+    """
+    from eu_state_aids import schema, transforms
+
+    # EU dataframe transformations
+
+    eu_df['Name of the beneficiary'] = transforms.lookup_name(eu_df.Beneficiary)
+    eu_df['ID of the beneficiary'] = transforms.lookup_id(eu_df.Beneficiary)
+    eu_df['European operation program (ID)'] = transforms.build_eu_prog_id(
+        eu_df['Project proposal number'], program_start_year
+    )
 
     eu_df['Amounts (€)'] = eu_df['Total'] * 0.51
     eu_df['Amounts (€)'] = eu_df['Amounts (€)'].astype(float).round(decimals=2)
 
     eu_df['Date'] = year
 
-    # the stateaid file is fetched (download)
-    typer.echo(f"Fetching stateaid data at {stateaid_url}")
-    r = requests.get(stateaid_url)
-
-    # DataFrame is created out of a stream, generated by a content
-    # the header starts at the 1st line
-    # only the first 10 columns are kept
-    stateaid_df = pd.read_excel(BytesIO(r.content), header=1)
-    stateaid_df = stateaid_df.iloc[:, :10]
-
-    def build_eu_prog_aid_id(x):
-        splits = x.split('-')
-        if len(splits) < 3:
-            return np.NAN
-        else:
-            return '-'.join(splits[:-1])
     eu_df.dropna(subset=['Project proposal number'], inplace=True)
-    eu_df['EUProgAidID'] = eu_df['Project proposal number'].apply(build_eu_prog_aid_id)
+    eu_df['EUProgAidID'] = transforms.build_eu_prog_aid_id(eu_df['Project proposal number'])
     eu_df.dropna(subset=['EUProgAidID', 'ID of the beneficiary'], inplace=True)
 
-    def lookup_prog_id(x):
-        """Looks up for program ID in stateaid_df
-
-        :param x:
-        :return:
-        """
-        has_x = stateaid_df[stateaid_df.iloc[:, 1].str.contains(x)]
-        if not has_x.empty:
-            return has_x.iloc[0, 0].split(',')[0]
-        else:
-            return np.NAN
-    eu_df['State aid Scheme'] = eu_df['EUProgAidID'].apply(lookup_prog_id)
+    # look up program IDs in stateaid_df, through an index built once
+    eu_df['State aid Scheme'] = stateaid_index.assign(eu_df['EUProgAidID'])
     eu_df.dropna(subset=['State aid Scheme'], inplace=True)
 
     eu_df.drop(
@@ -173,10 +401,397 @@ def export(
         ],
         inplace=True
     )
+    return schema.compact(eu_df, schema.BG_DTYPES)
+
+
+def _read_and_transform(
+    year: str, local_path: Union[str, Path], stateaid_index: StateAidIndex, program_start_year: str
+) -> Tuple[pd.DataFrame, int]:
+    """Read and transform the projects of the year, returning the transformed dataframe and the rows read."""
+    with metrics.stage("read_projects", hot=True, year=int(year)) as counters:
+        eu_df = read_projects(year, local_path)
+        counters["rows_out"] = len(eu_df)
+    n_rows = len(eu_df)
+    with metrics.stage("transform", year=int(year)) as counters:
+        eu_df = transform_projects(eu_df, year, program_start_year, stateaid_index)
+        counters.update(rows_in=n_rows, rows_out=len(eu_df))
+    return eu_df, n_rows
+
+
+def load_year(
+    year: str, local_path: Union[str, Path] = "./data/bg", stateaid_index: Optional[StateAidIndex] = None,
+    stateaid_url: str = DEFAULT_STATEAID_URL, program_start_year: str = "2014", offline: bool = False
+) -> pd.DataFrame:
+    """Load the projects of the year related to state aids, transformed as the export command does,
+    without writing any CSV file.
+
+    :param year: the year
+    :param local_path: local path of the eufunds excel files
+    :param stateaid_index: the index of the state aid schemes, loaded from stateaid_url if not given,
+      so that it can be built once for many years
+    :param stateaid_url: URL of stateaid excel file, cached in local_path
+    :param program_start_year: program's starting year
+    :param offline: only use the cached stateaid file, never fetching it
+    :return: the transformed dataframe, with the compact dtypes of schema.BG_DTYPES
+    :raise ValueError: when working offline and the stateaid file was never cached
+    """
+    if stateaid_index is None:
+        stateaid_df = load_stateaid(stateaid_url, Path(local_path) / "cache" / "stateaid", offline=offline)
+        if stateaid_df is None:
+            raise ValueError(f"No cached stateaid data for {stateaid_url}")
+        stateaid_index = StateAidIndex(stateaid_df)
+    eu_df, _ = _read_and_transform(year, local_path, stateaid_index, program_start_year)
+    return eu_df
+
+
+def export_year(
+    year: str, local_path: Union[str, Path], stateaid_index: StateAidIndex, program_start_year: str,
+    output_format: str = "csv", delta: bool = False
+) -> Tuple[pd.DataFrame, dict]:
+    """Read, transform and emit the output file of the year, in local_path.
+
+    This is the unit of work of the export commands, and can be run in a separate process.
+
+    :param year: the year
+    :param local_path: local path of the eufunds excel files
+    :param stateaid_index: the index of the state aid schemes
+    :param program_start_year: program's starting year
+    :param output_format: format of the output file, one of writers.FORMATS
+    :param delta: also write the records changed since the previous output file of the year,
+      into a `{year}_delta` file; the previous output file is removed when the year has no records
+    :return: the exported dataframe, and a summary of the export (year, rows, matches, seconds)
+    """
+    from eu_state_aids.delta import read_records, remove, write_delta
+    from eu_state_aids.writers import output_filepath, write_output
 
-    # emit csv
+    start = time.perf_counter()
+    local_path = Path(local_path)
+    eu_df, n_rows = _read_and_transform(year, local_path, stateaid_index, program_start_year)
+
+    # emit output file
     typer.echo(f"{len(eu_df)} matches found.")
-    csv_filepath = local_path / f"{year}.csv"
+    filepath = output_filepath(local_path, year, output_format)
+    previous = read_records(filepath) if delta else None
     if len(eu_df):
-        typer.echo(f"Writing results to {csv_filepath}")
-        eu_df.to_csv(csv_filepath, na_rep='', index=False)
+        typer.echo(f"Writing results to {filepath}")
+        with metrics.stage("write_output", year=int(year)) as counters:
+            write_output(eu_df, filepath, output_format)
+            counters["rows_out"] = len(eu_df)
+    elif delta:
+        # the outdated output file is removed, so that the next delta does not delete its records again
+        remove(filepath)
+
+    # emit the records changed since the previous output file
+    if delta:
+        delta_filepath = output_filepath(local_path, f"{year}_delta", output_format)
+        with metrics.stage("write_delta", year=int(year)) as counters:
+            delta_df = write_delta(
+                previous, filepath if len(eu_df) else None, delta_filepath, output_format, DELTA_KEYS
+            )
+            counters.update(rows_in=len(eu_df), rows_out=len(delta_df))
+        typer.echo(f"{len(delta_df)} changed records written to {delta_filepath}")
+
+    return eu_df, {"year": year, "rows": n_rows, "matches": len(eu_df), "seconds": time.perf_counter() - start}
+
+
+# columns of the exported records stored in the results database (see results.COLUMNS)
+RESULTS_COLUMNS = {
+    'ID of the beneficiary': 'beneficiary_id',
+    'Name of the beneficiary': 'beneficiary_name',
+    'State aid Scheme': 'scheme',
+    'European operation program (ID)': 'program',
+    'Amounts (€)': 'amount',
+}
+
+
+# columns identifying the exported records, in their deltas
+DELTA_KEYS = ['ID of the beneficiary', 'State aid Scheme', 'European operation program (ID)']
+
+
+def export_inputs(
+    manifest: Manifest, year: str, local_path: Union[str, Path], stateaid_url: str, program_start_year: str
+) -> dict:
+    """Build the inputs of the export of the year, for the manifest of local_path:
+    the projects' file (the excel file, or its converted copy if the excel file was removed),
+    the cached stateaid file, and the program's starting year.
+
+    :param manifest: the manifest of local_path
+    :param year: the year
+    :param local_path: local path of the eufunds excel files
+    :param stateaid_url: URL of stateaid excel file
+    :param program_start_year: program's starting year
+    :return: the inputs
+    """
+    from eu_state_aids.cache import ParsedCache
+
+    local_path = Path(local_path)
+    projects_file = local_path / f"projects_{year}.xlsx"
+    if not os.path.exists(projects_file):
+        projects_file = local_path / f"projects_{year}.parquet"
+    cache = ParsedCache(local_path / "cache" / "stateaid", version=STATEAID_CACHE_VERSION)
+    return manifest.inputs(
+        {"projects": projects_file, "stateaid": cache.source_path(stateaid_url, ".xlsx")},
+        program_start_year=program_start_year
+    )
+
+
+@app.command()
+def export(
+    year: str,
+    local_path: str = typer.Option(
+        "./data/bg",
+        help="Local path to use for eufunds excel files. Leave unset to use eufunds.org source."
+    ),
+    stateaid_url: str = typer.Option(DEFAULT_STATEAID_URL, help="URL of stateaid excel file"),
+    program_start_year: str = typer.Option("2014", help="Program's starting year"),
+    offline: bool = typer.Option(
+        False, help="Only use the cached stateaid file, never fetching it; fails when it was never cached"
+    ),
+    force: bool = typer.Option(False, help="Export the year even if its inputs did not change since its last export"),
+    results_db: str = typer.Option(
+        None, help="Also store the exported records into this SQLite database, to be looked up with the query command"
+    ),
+    output_format: str = typer.Option(
+        "csv", help="Format of the output file: csv, csv.gz, csv.zst or parquet, written with a .meta.json sidecar"
+    ),
+    delta: bool = typer.Option(
+        False, help="Also write the records inserted, updated or deleted since the previous export into a "
+                    "{year}_delta file"
+    ),
+):
+    """Read Excel file from local path, produces CSV output in the same local path.
+
+    Local path defaults to ./data/bg, and can be changed with local_path.
+    Uses pandas to read from Excel, transform the dataframe, and cross the data with
+    a second source, cached in local_path, to find out which of the EU funds are related to state aids.
+    The year is skipped if its inputs did not change since its last export.
+    """
+    from eu_state_aids import delta as deltas
+    from eu_state_aids.manifest import Manifest
+    from eu_state_aids.results import ResultsStore
+    from eu_state_aids.writers import check_format, output_filepath
+
+    # script parameters validations
+    assert(validate_year(year))
+    assert(validate_year(program_start_year))
+    assert(validators.url(stateaid_url))
+    check_format(output_format)
+
+    # the stateaid dataframe is read from the local cache, or fetched
+    local_path = Path(local_path)
+    stateaid_df = load_stateaid(stateaid_url, local_path / "cache" / "stateaid", offline=offline)
+    if stateaid_df is None:
+        # load_stateaid reported that there are no cached stateaid data
+        raise typer.Exit(1)
+
+    # the year is skipped if its inputs and output did not change
+    manifest = Manifest(local_path)
+    store = ResultsStore(results_db) if results_db else None
+    try:
+        inputs = export_inputs(manifest, year, local_path, stateaid_url, program_start_year)
+        filepath = output_filepath(local_path, year, output_format)
+        if not force and manifest.is_unchanged(f"export:{year}", inputs, filepath) and \
+                (store is None or store.has_period("bg", year)):
+            typer.echo(
+                f"Inputs of {year} not changed since its last export, skipped. Use --force to export it again."
+            )
+            if delta:
+                deltas.remove(output_filepath(local_path, f"{year}_delta", output_format))
+            return
+
+        eu_df, _ = export_year(
+            year, local_path, StateAidIndex(stateaid_df), program_start_year, output_format, delta
+        )
+        manifest.record(f"export:{year}", inputs, filepath)
+        manifest.save()
+        if store is not None:
+            with metrics.stage("store_results", year=int(year)) as counters:
+                store.upsert("bg", year, eu_df, RESULTS_COLUMNS)
+                counters["rows_out"] = len(eu_df)
+            typer.echo(f"Records stored into {results_db}")
+    finally:
+        if store is not None:
+            store.close()
+
+
+@app.command()
+def export_range(
+    start_year: str,
+    end_year: str,
+    local_path: str = typer.Option(
+        "./data/bg",
+        help="Local path to use for eufunds excel files. Leave unset to use eufunds.org source."
+    ),
+    stateaid_url: str = typer.Option(DEFAULT_STATEAID_URL, help="URL of stateaid excel file"),
+    program_start_year: str = typer.Option("2014", help="Program's starting year"),
+    offline: bool = typer.Option(
+        False, help="Only use the cached stateaid file, never fetching it; fails when it was never cached"
+    ),
+    workers: int = typer.Option(1, help="Number of processes used to export years in parallel"),
+    combined: bool = typer.Option(False, help="Also write all years' results in a single {start_year}_{end_year} file"),
+    force: bool = typer.Option(False, help="Export all years, even if their inputs did not change"),
+    results_db: str = typer.Option(
+        None, help="Also store the exported records into this SQLite database, to be looked up with the query command"
+    ),
+    output_format: str = typer.Option(
+        "csv", help="Format of the output files: csv, csv.gz, csv.zst or parquet, written with .meta.json sidecars"
+    ),
+    delta: bool = typer.Option(
+        False, help="Also write the records inserted, updated or deleted since the previous export of each year "
+                    "into a {year}_delta file"
+    ),
+):
+    """Read Excel files for all years from start_year to end_year (included),
+    and produce a CSV output for each year in local path, as the export command does.
+
+    The stateaid data are loaded once, for all years, and a summary of the export is shown at the end.
+    """
+    import pandas as pd
+
+    from eu_state_aids import delta as deltas
+    from eu_state_aids.manifest import Manifest
+    from eu_state_aids.results import ResultsStore
+    from eu_state_aids.writers import (check_format, output_filepath,
+                                       read_output, write_output)
+
+    # script parameters validations
+    assert(validate_year(start_year))
+    assert(validate_year(end_year))
+    assert(validate_year(program_start_year))
+    assert(validators.url(stateaid_url))
+    assert(workers >= 1)
+    check_format(output_format)
+
+    # the stateaid dataframe is read and indexed once, for all years
+    local_path = Path(local_path)
+    stateaid_df = load_stateaid(stateaid_url, local_path / "cache" / "stateaid", offline=offline)
+    if stateaid_df is None:
+        # load_stateaid reported that there are no cached stateaid data
+        raise typer.Exit(1)
+    stateaid_index = StateAidIndex(stateaid_df)
+
+    # years whose inputs and outputs did not change are skipped
+    years = [str(y) for y in range(int(start_year), int(end_year) + 1)]
+    manifest = Manifest(local_path)
+    store = ResultsStore(results_db) if results_db else None
+    try:
+        inputs = {
+            year: export_inputs(manifest, year, local_path, stateaid_url, program_start_year) for year in years
+        }
+        filepaths = {year: output_filepath(local_path, year, output_format) for year in years}
+        skipped = [
+            year for year in years
+            if not force and manifest.is_unchanged(f"export:{year}", inputs[year], filepaths[year])
+            and (store is None or store.has_period("bg", year))
+        ]
+
+        args = [
+            (year, str(local_path), stateaid_index, program_start_year, output_format, delta)
+            for year in years if year not in skipped
+        ]
+        if delta:
+            for year in skipped:
+                deltas.remove(output_filepath(local_path, f"{year}_delta", output_format))
+        if workers > 1 and len(args) > 1:
+            with ProcessPoolExecutor(max_workers=workers) as executor:
+                futures = [
+                    executor.submit(metrics.collected, metrics.worker_settings(), _export_year_outcome, *a)
+                    for a in args
+                ]
+                exported = [metrics.merge(f.result()) for f in futures]
+        else:
+            exported = [_export_year_outcome(*a) for a in args]
+
+        for df, summary in exported:
+            if "error" not in summary:
+                manifest.record(f"export:{summary['year']}", inputs[summary['year']], filepaths[summary['year']])
+                if store is not None:
+                    with metrics.stage("store_results", year=int(summary['year'])) as counters:
+                        store.upsert("bg", summary['year'], df, RESULTS_COLUMNS)
+                        counters["rows_out"] = len(df)
+        manifest.save()
+        if store is not None:
+            typer.echo(f"Records stored into {results_db}")
+    finally:
+        if store is not None:
+            store.close()
+
+    # the results of skipped years are read back from their output files, when combined
+    outcomes = dict((summary["year"], (df, summary)) for df, summary in exported)
+    for year in skipped:
+        df = None
+        if combined and os.path.exists(filepaths[year]):
+            df = read_output(filepaths[year], dtype=str, keep_default_na=False)
+        outcomes[year] = (df, {"year": year, "skipped": True})
+    outcomes = [outcomes[year] for year in years]
+
+    if combined:
+        dfs = [df for df, _ in outcomes if df is not None and len(df)]
+        combined_filepath = output_filepath(local_path, f"{start_year}_{end_year}", output_format)
+        if dfs:
+            typer.echo(f"Writing combined results to {combined_filepath}")
+            write_output(pd.concat(dfs), combined_filepath, output_format)
+
+    # summary
+    summaries = [summary for _, summary in outcomes]
+    typer.echo("Summary:")
+    for summary in summaries:
+        if "error" in summary:
+            typer.echo(f"  {summary['year']}: error {summary['error']}")
+        elif "skipped" in summary:
+            typer.echo(f"  {summary['year']}: not changed, skipped")
+        else:
+            typer.echo(
+                f"  {summary['year']}: {summary['rows']} rows, {summary['matches']} matches, "
+                f"{summary['seconds']:.2f}s"
+            )
+    typer.echo(
+        f"  total: {sum(s.get('rows', 0) for s in summaries)} rows, "
+        f"{sum(s.get('matches', 0) for s in summaries)} matches, "
+        f"{sum(s.get('seconds', 0) for s in summaries):.2f}s"
+    )
+
+
+def _export_year_outcome(*args) -> Tuple[Optional[pd.DataFrame], dict]:
+    """Call export_year, returning the error in the summary, if any exception is raised."""
+    try:
+        return export_year(*args)
+    except Exception as e:
+        return None, {"year": args[0], "error": str(e)}
+
+
+def pipeline_tasks(years: List[str], local_path: Union[str, Path], force: bool = False) -> List[Task]:
+    """Tasks of the pipeline of the given years: the stateaid data are fetched once,
+    the excel files of the years are fetched, unless already there,
+    and each year is exported as soon as its excel file is there, using the fetched stateaid data.
+
+    :param years: the years
+    :param local_path: local path of the eufunds excel files
+    :param force: export the years even if their inputs did not change
+    :return: the tasks
+    """
+    from eu_state_aids.pipeline import Task
+
+    local_path = Path(local_path)
+    cache_path = local_path / "cache" / "stateaid"
+    # the commands are called with all their options, by name, as their defaults are typer.Option objects
+    tasks = [Task(
+        "bg:stateaid", partial(load_stateaid, stateaid_url=DEFAULT_STATEAID_URL, cache_path=cache_path),
+        outputs=[cache_path / "index.json"]
+    )]
+    for year in years:
+        excel_file = local_path / f"projects_{year}.xlsx"
+        if not os.path.exists(excel_file):
+            tasks.append(Task(
+                f"bg:fetch:{year}", partial(fetch, year=year, local_path=str(local_path)), outputs=[excel_file]
+            ))
+        tasks.append(Task(
+            f"bg:export:{year}",
+            partial(
+                export, year=year, local_path=str(local_path), stateaid_url=DEFAULT_STATEAID_URL,
+                program_start_year="2014", offline=True, force=force, results_db=None, output_format="csv",
+                delta=False
+            ),
+            inputs=[cache_path / "index.json", excel_file], outputs=[local_path / f"{year}.csv"]
+        ))
+    return tasks
@@ -0,0 +1,89 @@
+import hashlib
+import json
+import os
+from pathlib import Path
+from typing import Optional, Union
+
+import pandas as pd
+
+
+def file_checksum(filepath: Union[str, Path], chunk_size: int = 1024 * 1024) -> str:
+    """Compute the sha256 checksum of a file, reading it in chunks.
+
+    :param filepath: the file path
+    :param chunk_size: size of the chunks read, in bytes
+    :return: the hex digest of the checksum
+    """
+    h = hashlib.sha256()
+    with open(filepath, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+class ParsedCache:
+    """Local cache of the dataframes parsed out of remote source files.
+
+    Entries are keyed by the url of the source file, and hold the checksum
+    of the source file, the HTTP validators (ETag, Last-Modified) of its
+    last download, and the parsed dataframe, pickled in a separate file.
+    The entries are indexed in an `index.json` file, in the cache directory.
+
+    Entries stored by a different `version` of the parsing logic are ignored,
+    so that they are parsed again.
+    """
+
+    def __init__(self, path: Union[str, Path], version: str = "1"):
+        self.path = Path(path)
+        self.version = version
+        if not os.path.exists(self.path):
+            os.makedirs(self.path)
+
+        self.index_filepath = self.path / "index.json"
+        if os.path.exists(self.index_filepath):
+            with open(self.index_filepath) as f:
+                self.index = json.load(f)
+        else:
+            self.index = {}
+
+    def _basename(self, url: str) -> str:
+        return hashlib.sha1(url.encode()).hexdigest()[:16]
+
+    def source_path(self, url: str, suffix: str = "") -> Path:
+        """Return the path where the source file of url can be kept, in the cache directory."""
+        return self.path / f"{self._basename(url)}{suffix}"
+
+    def get(self, url: str) -> Optional[dict]:
+        """Return the entry of url, None if there is no valid entry."""
+        entry = self.index.get(url)
+        if entry is None or entry.get("version") != self.version or \
+                not os.path.exists(self.path / entry["filename"]):
+            return None
+        return entry
+
+    def load(self, url: str) -> pd.DataFrame:
+        """Return the dataframe of url."""
+        return pd.read_pickle(self.path / self.index[url]["filename"])
+
+    def store(
+        self, url: str, df: pd.DataFrame, checksum: str,
+        etag: Optional[str] = None, last_modified: Optional[str] = None
+    ):
+        """Store the dataframe parsed out of url, along with the checksum and validators of the source file."""
+        filename = self._basename(url) + ".pkl"
+        df.to_pickle(self.path / filename)
+        self.index[url] = {
+            "version": self.version, "filename": filename, "checksum": checksum,
+            "etag": etag, "last_modified": last_modified,
+        }
+
+    def update(self, url: str, etag: Optional[str] = None, last_modified: Optional[str] = None):
+        """Update the validators of the entry of url, when its source file was downloaded again, unchanged."""
+        self.index[url].update(etag=etag, last_modified=last_modified)
+
+    def save(self):
+        """Write the index to disk, atomically."""
+        tmp_filepath = self.index_filepath.with_name(self.index_filepath.name + ".tmp")
+        with open(tmp_filepath, "w") as f:
+            json.dump(self.index, f, indent=2, sort_keys=True)
+        os.replace(tmp_filepath, self.index_filepath)
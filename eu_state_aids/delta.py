@@ -0,0 +1,128 @@
+import os
+from pathlib import Path
+from typing import List, Optional, Union
+
+import pandas as pd
+
+# name of the column holding the operation of each row of a delta
+OPERATION = "operation"
+INSERT = "insert"
+UPDATE = "update"
+DELETE = "delete"
+
+# name of the column holding the position of each row of a delta among the records with the same keys,
+# in the previous export for updated and deleted records, in the current one for inserted records
+OCCURRENCE = "occurrence"
+
+
+def read_records(filepath: Union[str, Path]) -> Optional[pd.DataFrame]:
+    """Read the records of an output file, to be compared, keeping the values of CSV files as written.
+
+    :param filepath: the output file
+    :return: the dataframe, None if the file does not exist
+    """
+    from eu_state_aids.writers import read_output
+
+    if not os.path.exists(filepath):
+        return None
+    return read_output(filepath, dtype=str, keep_default_na=False)
+
+
+def _hashes(df: pd.DataFrame, keys: List[str]) -> pd.DataFrame:
+    """Hash the keys and the values of each row of df, along with its position among the rows with the same keys
+    (occurrence), and among the rows with the same values (duplicate)."""
+    values = df.astype(str)
+    hashes = pd.DataFrame({
+        "key": pd.util.hash_pandas_object(values[keys], index=False).values,
+        "row": pd.util.hash_pandas_object(values, index=False).values,
+    })
+    hashes["occurrence"] = hashes.groupby("key", sort=False).cumcount()
+    hashes["duplicate"] = hashes.groupby("row", sort=False).cumcount()
+    return hashes
+
+
+def _ids(*columns: pd.Series) -> pd.MultiIndex:
+    """Identify rows by the values of columns, to be looked up in another version of the records."""
+    return pd.MultiIndex.from_arrays([column.values for column in columns])
+
+
+def diff(previous: Optional[pd.DataFrame], current: Optional[pd.DataFrame], keys: List[str]) -> pd.DataFrame:
+    """Compare two versions of the records of a period, by hashing their keys and their rows.
+
+    Keys need not be unique (ie: many projects of a beneficiary, with the same scheme):
+    records found unchanged in both versions are matched first, whatever their position,
+    then the remaining records with the same keys are paired in their order, as updates,
+    so that removing a record does not turn the following ones into updates.
+    The OCCURRENCE column tells which of the records with the same keys a row of the delta refers to.
+
+    :param previous: the records of the previous export, None if there was none
+    :param current: the records of the current export, None if there are none
+    :param keys: the columns identifying a record
+    :return: the inserted, updated and deleted records, with their OPERATION and OCCURRENCE as first columns;
+      inserted and updated records with their current values, deleted records with their previous ones
+    """
+    if previous is None and current is None:
+        return pd.DataFrame(columns=[OPERATION, OCCURRENCE] + keys)
+    if previous is None:
+        previous = current.iloc[:0]
+    if current is None:
+        current = previous.iloc[:0]
+
+    previous_hashes = _hashes(previous, keys)
+    current_hashes = _hashes(current, keys)
+
+    # records unchanged in both versions are left out, identical records being matched in their order
+    previous_changed = previous_hashes[~_ids(previous_hashes.row, previous_hashes.duplicate).isin(
+        _ids(current_hashes.row, current_hashes.duplicate)
+    )]
+    current_changed = current_hashes[~_ids(current_hashes.row, current_hashes.duplicate).isin(
+        _ids(previous_hashes.row, previous_hashes.duplicate)
+    )]
+
+    # changed records with the same keys are paired in their order
+    previous_pairs = _ids(previous_changed.key, previous_changed.groupby("key", sort=False).cumcount())
+    current_pairs = _ids(current_changed.key, current_changed.groupby("key", sort=False).cumcount())
+    is_updated = current_pairs.isin(previous_pairs)
+    is_deleted = ~previous_pairs.isin(current_pairs)
+    previous_occurrences = pd.Series(previous_changed.occurrence.values, index=previous_pairs)
+
+    def rows(df, hashes, mask, operation, occurrences):
+        return df.iloc[hashes.index[mask]].assign(**{OPERATION: operation, OCCURRENCE: occurrences})
+
+    return pd.concat([
+        rows(current, current_changed, ~is_updated, INSERT, current_changed.occurrence.values[~is_updated]),
+        rows(current, current_changed, is_updated, UPDATE, previous_occurrences.loc[current_pairs[is_updated]].values),
+        rows(previous, previous_changed, is_deleted, DELETE, previous_changed.occurrence.values[is_deleted]),
+    ], ignore_index=True).pipe(
+        lambda df: df[[OPERATION, OCCURRENCE] + [c for c in df.columns if c not in (OPERATION, OCCURRENCE)]]
+    )
+
+
+def write_delta(
+    previous: Optional[pd.DataFrame], filepath: Optional[Union[str, Path]], delta_filepath: Union[str, Path],
+    output_format: str, keys: List[str]
+) -> pd.DataFrame:
+    """Compare the output file just written with the previous records of the period, and write their delta.
+
+    :param previous: the previous records, read with read_records before the output file was written
+    :param filepath: the output file just written, None if no records were written
+    :param delta_filepath: the delta file
+    :param output_format: the format of the delta file, one of writers.FORMATS
+    :param keys: the columns identifying a record
+    :return: the delta
+    """
+    from eu_state_aids.writers import write_output
+
+    delta_df = diff(previous, read_records(filepath) if filepath else None, keys)
+    write_output(delta_df, delta_filepath, output_format)
+    return delta_df
+
+
+def remove(filepath: Union[str, Path]):
+    """Remove an output file and its sidecar file, if any, so that an outdated delta is not loaded again,
+    or an outdated export not compared again."""
+    from eu_state_aids.writers import sidecar_filepath
+
+    for path in (filepath, sidecar_filepath(filepath)):
+        if os.path.exists(path):
+            os.remove(path)
@@ -0,0 +1,349 @@
+import contextlib
+import hashlib
+import json
+import os
+import queue
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Callable, Dict, Iterable, Iterator, Optional, Tuple, Union
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from eu_state_aids import metrics
+
+# (connect, read) timeouts, in seconds
+DEFAULT_TIMEOUT = (10, 120)
+CHUNK_SIZE = 1024 * 1024
+MAX_WORKERS = 4
+
+_session = None
+_session_pid = None
+_session_lock = threading.Lock()
+
+
+def get_session() -> requests.Session:
+    """Return the shared HTTP session, with a pool of keep-alive connections.
+
+    A new session is created in each process, as connections can not be
+    shared with forked workers.
+    """
+    global _session, _session_pid
+    with _session_lock:
+        if _session is None or _session_pid != os.getpid():
+            session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=MAX_WORKERS, pool_maxsize=4 * MAX_WORKERS)
+            session.mount("http://", adapter)
+            session.mount("https://", adapter)
+            _session, _session_pid = session, os.getpid()
+    return _session
+
+
+def _validators_filepath(part_filepath: Path) -> Path:
+    """Return the path of the file holding the validators of the response a `.part` file was written from."""
+    return part_filepath.with_name(part_filepath.name + ".json")
+
+
+def _read_validators(part_filepath: Path) -> Optional[Dict[str, Optional[str]]]:
+    """Read the validators of a `.part` file, None if they were not stored."""
+    try:
+        with open(_validators_filepath(part_filepath)) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def _remove_part(part_filepath: Path):
+    """Remove a `.part` file and its validators, so that the download starts over."""
+    for path in (part_filepath, _validators_filepath(part_filepath)):
+        if path.exists():
+            os.unlink(path)
+
+
+def _if_range(validators: Optional[Dict[str, Optional[str]]]) -> Optional[str]:
+    """The If-Range header of a request resuming a download: the strong ETag of the response
+    the partial file was written from, or its Last-Modified date, None if it has neither."""
+    if not validators:
+        return None
+    etag = validators.get("etag")
+    if etag and not etag.startswith("W/"):
+        return etag
+    return validators.get("last_modified")
+
+
+def _check_complete(response: requests.Response):
+    """Check that the whole content of a response was received, as its Content-Length tells,
+    as older versions of urllib3 end the content quietly when the connection is dropped.
+
+    :raise requests.exceptions.ChunkedEncodingError: when the content is incomplete
+    """
+    length = response.headers.get("Content-Length")
+    if length and length.isdigit() and response.raw.tell() < int(length):
+        raise requests.exceptions.ChunkedEncodingError(
+            f"Connection dropped after {response.raw.tell()} of {length} bytes"
+        )
+
+
+def download_if_modified(
+    url: str,
+    filepath: Union[str, Path],
+    etag: Optional[str] = None,
+    last_modified: Optional[str] = None,
+    session: Optional[requests.Session] = None,
+    timeout: Tuple[float, float] = DEFAULT_TIMEOUT,
+    retries: int = 3,
+    backoff: float = 1.0,
+    chunk_size: int = CHUNK_SIZE,
+) -> Optional[Dict[str, Optional[str]]]:
+    """Download url into filepath, streaming the content in chunks,
+    unless the remote file was not modified since a previous download,
+    as told by the `etag` and `last_modified` validators of that download.
+
+    Content is written to a `.part` file, that is renamed into filepath only
+    once the download is complete, so that filepath is never truncated.
+    When a `.part` file is already there, the download is resumed from its end,
+    with an HTTP Range request, conditional on the remote file being the one the `.part` file
+    was written from (If-Range), as told by the validators stored next to it (`.part.json`);
+    when the remote file changed, the server sends it whole, and the download starts over.
+    Partial files with no validators are downloaded again from the start.
+    Connection errors, timeouts and server errors are retried,
+    waiting `backoff * 2 ** n` seconds before the n-th retry.
+
+    :param url: the remote url
+    :param filepath: the local file path
+    :param etag: the ETag header of a previous download
+    :param last_modified: the Last-Modified header of a previous download
+    :param session: the HTTP session, defaults to the shared one
+    :param timeout: (connect, read) timeouts, in seconds
+    :param retries: max number of retries
+    :param backoff: base delay between retries, in seconds
+    :param chunk_size: size of the chunks written to disk, in bytes
+    :return: the validators (etag, last_modified) of the downloaded file, None if the file was not modified
+    :raise requests.HTTPError: when the server answered with a client error (ie: 404)
+    :raise requests.RequestException: when all retries failed
+    """
+    filepath = Path(filepath)
+    part_filepath = filepath.with_name(filepath.name + ".part")
+    session = session or get_session()
+
+    with metrics.stage("download", url=url) as counters:
+        counters["bytes_read"] = 0
+        attempt = 0
+        while True:
+            offset = part_filepath.stat().st_size if part_filepath.exists() else 0
+            part_validators = _read_validators(part_filepath) if offset else None
+            if offset and not _if_range(part_validators):
+                # partial file can not be matched with the remote one, start over
+                _remove_part(part_filepath)
+                offset = 0
+            if offset:
+                headers = {"Range": f"bytes={offset}-", "If-Range": _if_range(part_validators)}
+            else:
+                headers = {"If-None-Match": etag, "If-Modified-Since": last_modified}
+            try:
+                with session.get(
+                    url, headers={k: v for k, v in headers.items() if v}, stream=True, timeout=timeout
+                ) as r:
+                    if r.status_code == 304:
+                        counters["not_modified"] = True
+                        return None
+                    if r.status_code == 416:
+                        # partial file does not match the remote one, start over
+                        _remove_part(part_filepath)
+                    r.raise_for_status()
+
+                    # the server sends the whole content when the remote file changed (If-Range),
+                    # or when it ignores the Range header
+                    resumed = bool(offset) and r.status_code == 206
+                    if resumed and not r.headers.get("Content-Range", "").startswith(f"bytes {offset}-"):
+                        # not the requested range, start over
+                        _remove_part(part_filepath)
+                        continue
+                    if resumed:
+                        validators = part_validators
+                    else:
+                        validators = {"etag": r.headers.get("ETag"), "last_modified": r.headers.get("Last-Modified")}
+                        with open(_validators_filepath(part_filepath), "w") as f:
+                            json.dump(validators, f)
+                    with open(part_filepath, "ab" if resumed else "wb") as f:
+                        for chunk in r.iter_content(chunk_size=chunk_size):
+                            f.write(chunk)
+                            counters["bytes_read"] += len(chunk)
+                    _check_complete(r)
+
+                os.replace(part_filepath, filepath)
+                _remove_part(part_filepath)
+                return validators
+            except (requests.ConnectionError, requests.Timeout, requests.HTTPError,
+                    requests.exceptions.ChunkedEncodingError) as e:
+                if isinstance(e, requests.HTTPError) and is_client_error(e.response):
+                    raise
+                attempt += 1
+                counters["retries"] = attempt
+                if attempt > retries:
+                    raise
+                time.sleep(backoff * 2 ** (attempt - 1))
+
+
+def is_client_error(response: Optional[requests.Response]) -> bool:
+    """Tell whether the server answered with a client error, not worth retrying (ie: 404)."""
+    return response is not None and 400 <= response.status_code < 500 and response.status_code != 416
+
+
+def download(url: str, filepath: Union[str, Path], **kwargs) -> bool:
+    """Download url into filepath, see `download_if_modified` for details
+    and further keyword arguments.
+
+    :return: True if the file was downloaded, False if the server answered with a client error (ie: 404)
+    :raise requests.RequestException: when all retries failed
+    """
+    try:
+        download_if_modified(url, filepath, **kwargs)
+    except requests.HTTPError as e:
+        if is_client_error(e.response):
+            return False
+        raise
+    return True
+
+
+def download_many(
+    items: Iterable[tuple],
+    max_workers: int = MAX_WORKERS,
+    func: Callable = download,
+    **kwargs
+) -> list:
+    """Download many (url, filepath) items concurrently, with at most
+    max_workers downloads running at the same time.
+
+    Each item is passed as positional arguments to `func` (`download` by default),
+    further keyword arguments are passed to `func` as well.
+
+    :param items: the (url, filepath, ...) tuples
+    :param max_workers: the max number of concurrent downloads
+    :param func: the download function
+    :return: the results of `func` for each item, in the same order,
+             or the exception raised, when all retries failed
+    """
+    def _download(item):
+        try:
+            return func(*item, **kwargs)
+        except requests.RequestException as e:
+            return e
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        return list(executor.map(_download, items))
+
+
+class HTTPStream:
+    """Binary stream of the content of an HTTP response.
+
+    The content is read ahead by a background thread, at most `prefetch` chunks at a time,
+    so that downloading overlaps with the processing of the content.
+    The sha256 checksum of the content is computed while it is read.
+    """
+
+    def __init__(self, response: requests.Response, chunk_size: int = CHUNK_SIZE, prefetch: int = 4):
+        self.response = response
+        self.chunks = queue.Queue(maxsize=prefetch)
+        self.buffer = bytearray()
+        self.eof = False
+        self.closed = threading.Event()
+        self.bytes_read = 0
+        self.sha256 = hashlib.sha256()
+        self.thread = threading.Thread(target=self._prefetch, args=(chunk_size,), daemon=True)
+        self.thread.start()
+
+    def _prefetch(self, chunk_size: int):
+        try:
+            for chunk in self.response.iter_content(chunk_size=chunk_size):
+                if not self._put(chunk):
+                    return
+            _check_complete(self.response)
+            self._put(None)
+        except Exception as e:
+            self._put(e)
+
+    def _put(self, item) -> bool:
+        """Queue an item, unless the stream is closed in the meantime."""
+        while not self.closed.is_set():
+            try:
+                self.chunks.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def read(self, size: int = -1) -> bytes:
+        while not self.eof and (size < 0 or len(self.buffer) < size):
+            chunk = self.chunks.get()
+            if isinstance(chunk, Exception):
+                raise chunk
+            if chunk is None:
+                self.eof = True
+                break
+            self.bytes_read += len(chunk)
+            self.sha256.update(chunk)
+            self.buffer += chunk
+        if size < 0:
+            size = len(self.buffer)
+        data = bytes(self.buffer[:size])
+        del self.buffer[:size]
+        return data
+
+    def close(self):
+        self.closed.set()
+        self.thread.join()
+        self.response.close()
+
+
+@contextlib.contextmanager
+def stream_url(
+    url: str,
+    session: Optional[requests.Session] = None,
+    timeout: Tuple[float, float] = DEFAULT_TIMEOUT,
+    retries: int = 3,
+    backoff: float = 1.0,
+    chunk_size: int = CHUNK_SIZE,
+    prefetch: int = 4,
+) -> Iterator[HTTPStream]:
+    """Open url as a binary stream, to process its content while it is downloaded, without storing it.
+
+    Connecting to the server is retried as in `download_if_modified`,
+    while errors raised once the content is being read are not, as it could
+    have already been processed in part.
+
+    :param url: the remote url
+    :param session: the HTTP session, defaults to the shared one
+    :param timeout: (connect, read) timeouts, in seconds
+    :param retries: max number of retries
+    :param backoff: base delay between retries, in seconds
+    :param chunk_size: size of the chunks read from the response, in bytes
+    :param prefetch: max number of chunks read ahead
+    :raise requests.HTTPError: when the server answered with a client error (ie: 404)
+    :raise requests.RequestException: when all retries failed
+    """
+    session = session or get_session()
+    with metrics.stage("download", url=url) as counters:
+        attempt = 0
+        while True:
+            try:
+                response = session.get(url, stream=True, timeout=timeout)
+                response.raise_for_status()
+                break
+            except (requests.ConnectionError, requests.Timeout, requests.HTTPError) as e:
+                if isinstance(e, requests.HTTPError) and is_client_error(e.response):
+                    raise
+                attempt += 1
+                counters["retries"] = attempt
+                if attempt > retries:
+                    raise
+                time.sleep(backoff * 2 ** (attempt - 1))
+
+        stream = HTTPStream(response, chunk_size=chunk_size, prefetch=prefetch)
+        try:
+            yield stream
+        finally:
+            stream.close()
+            counters["bytes_read"] = stream.bytes_read
@@ -1,29 +1,271 @@
+from __future__ import annotations
+
+import mmap
 import os
 import re
+import shutil
+import tempfile
 import zipfile
-from io import BytesIO
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
 from pathlib import Path
+from typing import (TYPE_CHECKING, BinaryIO, Container, Dict, Iterator, List,
+                    Optional, Tuple, Union)
+from xml.etree import ElementTree
 
-import numpy as np
-import pandas as pd
-import pandas_read_xml as pdx
-from pandas_read_xml import flatten, fully_flatten
-
-import requests
 import typer
 
+from eu_state_aids import metrics
+from eu_state_aids.download import (CHUNK_SIZE, MAX_WORKERS, download,
+                                    download_if_modified, download_many,
+                                    is_client_error, stream_url)
 from eu_state_aids.utils import validate_year, validate_year_month
+from eu_state_aids.zipstream import ZipMemberStream
+
+# pandas and pandas_read_xml are only imported by the commands processing data, so that fetch commands start fast
+if TYPE_CHECKING:
+    import pandas as pd
+
+    from eu_state_aids.aggregate import PartialSums
+    from eu_state_aids.manifest import Manifest
+    from eu_state_aids.pipeline import Task
 
 app = typer.Typer()
 
+rna_mirror_url = "http://eu-state-aids.s3-eu-west-1.amazonaws.com/it/rna_mirror"
 
-def normalize_cod_ce(x):
-    c = re.compile(r'SA[. ](\d+)')
-    m = re.match(c, x)
-    if m and len(m.groups()) == 1:
-        return f"SA.{m.group(1)}"
-    else:
-        return np.NAN
+
+def build_misure_url(year: int, month: int) -> str:
+    """Build the url of the zipped Misure XML file for the given year and month."""
+    return f"{rna_mirror_url}/OpenDataMisure/OpenData_Misura_{year}_{month:02}.xml.zip"
+
+
+def build_aiuti_url(year: int, month: int) -> str:
+    """Build the url of the zipped Aiuti XML file for the given year and month."""
+    return f"{rna_mirror_url}/OpenDataAiuti/OpenData_Aiuti_{year}_{month:02}.xml.zip"
+
+
+class CharRefStripper:
+    """Read-only binary stream wrapper, removing numeric character references
+    (``&#NNN;``) from the underlying stream.
+
+    References split across two reads are held back until they can be
+    matched as a whole, so the result is the same as applying
+    ``re.sub(r"&#(\\d+);", "", content)`` to the full content.
+    """
+
+    char_ref = re.compile(rb"&#\d+;")
+    partial_char_ref = re.compile(rb"&(#\d*)?")
+
+    def __init__(self, stream: BinaryIO):
+        self.stream = stream
+        self.tail = b""
+
+    def read(self, size: int = -1) -> bytes:
+        while True:
+            data = self.stream.read(size)
+            buf = self.tail + data
+            if not data:
+                self.tail = b""
+                return self.char_ref.sub(b"", buf)
+
+            # hold back a trailing, possibly incomplete, reference
+            idx = buf.rfind(b"&")
+            if idx >= 0 and self.partial_char_ref.fullmatch(buf, idx):
+                buf, self.tail = buf[:idx], buf[idx:]
+            else:
+                self.tail = b""
+
+            buf = self.char_ref.sub(b"", buf)
+            if buf:
+                return buf
+
+
+def _local_name(tag: str) -> str:
+    return tag.rsplit('}', 1)[-1]
+
+
+def _child_text(elem: ElementTree.Element, name: str) -> Optional[str]:
+    """Text of the first child named `name`, stripped as xmltodict does,
+    None if the child is missing or empty."""
+    for child in elem:
+        if _local_name(child.tag) == name:
+            return (child.text or '').strip() or None
+    return None
+
+
+def _children(elem: Optional[ElementTree.Element], name: str) -> list:
+    if elem is None:
+        return []
+    return [child for child in elem if _local_name(child.tag) == name]
+
+
+def _is_dict(elem: Optional[ElementTree.Element]) -> bool:
+    """Tell if xmltodict would parse the element into a dict: it has children or attributes."""
+    return elem is not None and (len(elem) > 0 or bool(elem.attrib))
+
+
+def _flatten_order(*keys: bool) -> int:
+    """Pack the flatten keys of a record, from the outermost to the innermost, into a sort key:
+    `fully_flatten` moves rows to the front level by level, so the innermost key sorts first.
+    Records missing the inner levels (ie: aids with no components) are not moved to the front by them.
+    """
+    keys = keys + (False,) * (6 - len(keys))
+    return sum(int(not key) << i for i, key in enumerate(keys))
+
+
+AIUTI_COLUMNS = ['cod_ce', 'denom_benef', 'cf_benef', 'componenti_importo_aiuto']
+
+# column holding the sort key of the records in the order of fully_flatten, dropped once sorted
+FLATTEN_ORDER = 'flatten_order'
+
+
+def iter_aiuti(stream: BinaryIO, codes: Optional[Container[str]] = None) -> Iterator[Tuple[Optional[str], ...]]:
+    """Parse an Aiuti XML stream incrementally, one AIUTO element at a time.
+
+    Yield a tuple of AIUTI_COLUMNS values for each STRUMENTO_AIUTO
+    of each COMPONENTE_AIUTO, or a single tuple with no amount when the aid
+    has no components or instruments, as `fully_flatten` would do.
+    Aids with no COD_CE_MISURA are skipped, and so are aids whose COD_CE_MISURA,
+    normalized, is not in codes, when given, before their components are read.
+
+    Records are yielded in the document order, followed by their FLATTEN_ORDER sort key:
+    `fully_flatten` explodes repeated elements and normalizes nested ones level by level,
+    moving the rows with repeated elements (lists), then the rows with nested elements (dicts),
+    before the others at each level. Sorting the records by their key, stably (see sort_aiuti),
+    gives the order of `fully_flatten`, so that amounts are summed in the same order.
+
+    Numeric character references are stripped from the stream, and each
+    AIUTO element is discarded as soon as it has been read, so that memory
+    usage does not depend on the size of the file.
+
+    :param stream: binary stream of the XML content (e.g. a zip member)
+    :param codes: the normalized codes of the aids to keep (ie: a misure lookup), None to keep all
+    :return: an iterator over the records
+    """
+    from eu_state_aids.transforms import normalize_cod_ce_value
+
+    depth = 0
+    root = None
+    for event, elem in ElementTree.iterparse(CharRefStripper(stream), events=('start', 'end')):
+        if event == 'start':
+            depth += 1
+            if root is None:
+                root = elem
+            continue
+
+        depth -= 1
+        if depth != 1 or _local_name(elem.tag) != 'AIUTO':
+            continue
+
+        cod_ce = _child_text(elem, 'COD_CE_MISURA')
+        if cod_ce is not None and (codes is None or normalize_cod_ce_value(cod_ce) in codes):
+            denom_benef = _child_text(elem, 'DENOMINAZIONE_BENEFICIARIO')
+            cf_benef = _child_text(elem, 'CODICE_FISCALE_BENEFICIARIO')
+
+            componenti_aiuto = _children(elem, 'COMPONENTI_AIUTO')
+            componenti = [c for cc in componenti_aiuto for c in _children(cc, 'COMPONENTE_AIUTO')]
+            aid_keys = (_is_dict(componenti_aiuto[0]) if componenti_aiuto else False, len(componenti) > 1)
+            if not componenti:
+                yield cod_ce, denom_benef, cf_benef, None, _flatten_order(*aid_keys)
+            for componente in componenti:
+                strumenti_aiuto = _children(componente, 'STRUMENTI_AIUTO')
+                strumenti = [s for ss in strumenti_aiuto for s in _children(ss, 'STRUMENTO_AIUTO')]
+                componente_keys = aid_keys + (
+                    _is_dict(componente), _is_dict(strumenti_aiuto[0]) if strumenti_aiuto else False,
+                    len(strumenti) > 1
+                )
+                if not strumenti:
+                    yield cod_ce, denom_benef, cf_benef, None, _flatten_order(*componente_keys)
+                for strumento in strumenti:
+                    yield (
+                        cod_ce, denom_benef, cf_benef, _child_text(strumento, 'IMPORTO_NOMINALE'),
+                        _flatten_order(*componente_keys, _is_dict(strumento))
+                    )
+
+        # free the memory used by the processed element
+        root.clear()
+
+
+def read_aiuti(stream: BinaryIO, codes: Optional[Container[str]] = None, sort: bool = True) -> pd.DataFrame:
+    """Read the records of an Aiuti XML stream into a DataFrame,
+    with AIUTI_COLUMNS as columns, typed as in schema.AIUTI_DTYPES:
+    strings are categorical, and amounts are converted into floats.
+
+    :param stream: binary stream of the XML content
+    :param codes: the normalized codes of the aids to keep, None to keep all
+    :param sort: sort the records in the order of fully_flatten; when False, they are kept in the document order,
+      with their FLATTEN_ORDER column, to be sorted with sort_aiuti (ie: once the shards of a file are concatenated)
+    :return: the DataFrame
+    """
+    import pandas as pd
+
+    from eu_state_aids import schema
+
+    adf = pd.DataFrame.from_records(list(iter_aiuti(stream, codes)), columns=AIUTI_COLUMNS + [FLATTEN_ORDER])
+    adf = schema.compact(adf, schema.AIUTI_DTYPES)
+    return sort_aiuti(adf) if sort else adf
+
+
+def sort_aiuti(adf: pd.DataFrame) -> pd.DataFrame:
+    """Sort the records read by read_aiuti in the order of fully_flatten, by their FLATTEN_ORDER column, stably,
+    dropping the column, so that their amounts are summed in the same order, with the same floating point results.
+
+    :param adf: the records, in the document order, with their FLATTEN_ORDER column
+    :return: the sorted records, with AIUTI_COLUMNS as columns
+    """
+    return adf.sort_values(FLATTEN_ORDER, kind="stable").drop(columns=FLATTEN_ORDER).reset_index(drop=True)
+
+
+# version of the misure parsing logic, cached results of other versions are parsed again
+MISURE_CACHE_VERSION = "1"
+
+
+def misure_periods() -> List[Tuple[int, int]]:
+    """List the (year, month) periods of the published Misure files."""
+    return [
+        (year, month) for year in range(2014, 2022) for month in range(1, 13)
+        if not (year == 2021 and month in (8, 10)) and not (year == 2014 and month < 5)
+    ]
+
+
+def parse_misure(zip_file: Union[str, Path]) -> pd.DataFrame:
+    """Parse a zipped Misure XML file into a DataFrame of distinct (cod_ce, fondo_desc) records,
+    with the cod_ce normalized.
+
+    :param zip_file: path of the zipped XML file
+    :return: the DataFrame, empty if the file has no co-financed measures
+    """
+    import pandas as pd
+    import pandas_read_xml as pdx
+    from pandas_read_xml import flatten
+
+    from eu_state_aids import transforms
+
+    with zipfile.ZipFile(zip_file) as z:
+        z_filename = [f.filename for f in z.filelist][0]
+        with z.open(z_filename, "r") as zf:
+            ydf = pdx.read_xml(zf.read().decode(), ["ns0:LISTA_MISURE_TYPE"])
+
+    ydf = ydf.pipe(flatten).pipe(flatten)
+    if "MISURA|LISTA_COFINANZIAMENTI" not in ydf.columns:
+        return pd.DataFrame(columns=['cod_ce', 'fondo_desc'])
+    ydf = ydf[
+        ydf.notnull()["MISURA|LISTA_COFINANZIAMENTI"]
+    ][['MISURA|COD_CE', 'MISURA|LISTA_COFINANZIAMENTI']]
+    ydf = ydf.pipe(flatten).pipe(flatten).pipe(flatten)
+    ydf.rename(columns={
+        'MISURA|COD_CE': 'cod_ce',
+        'MISURA|LISTA_COFINANZIAMENTI|COFINANZIAMENTO|DESCRIZIONE_FONDO': 'fondo_desc',
+    }, inplace=True)
+    ydf = ydf[ydf.notnull()["cod_ce"]]
+
+    if 'MISURA|LISTA_COFINANZIAMENTI|COFINANZIAMENTO|COD_FONDO' in ydf.columns:
+        del ydf['MISURA|LISTA_COFINANZIAMENTI|COFINANZIAMENTO|COD_FONDO']
+        del ydf['MISURA|LISTA_COFINANZIAMENTI|COFINANZIAMENTO|IMPORTO']
+
+    ydf['cod_ce'] = transforms.normalize_cod_ce(ydf.cod_ce)
+    return ydf[ydf.notnull()["cod_ce"]].drop_duplicates()
 
 
 @app.command()
@@ -31,76 +273,127 @@ def generate_measures(
     local_path: str = typer.Option(
         "./data/it",
         help="Local path to use for XML files. Always use forward slashes."
-    )
+    ),
+    since: str = typer.Option(
+        None,
+        help="Only check months from this one on (YYYY_MM), reusing cached results for the previous ones"
+    ),
+    force: bool = typer.Option(
+        False, help="Generate the misure file even if the results of all months did not change"
+    ),
+    output_format: str = typer.Option("csv", help="Format of the misure file: csv, csv.gz, csv.zst or parquet"),
 ):
     """Fetch all Misure XML files locally, generate a DataFrame with the fields:
        - COD_CE,
        - DESC_FONDO
-    and store a CSV in local_path.
+    and store a CSV in local_path (or a compressed CSV, or a Parquet file, with the output_format option).
+
+    The results parsed out of each month's file are cached in local_path,
+    so that only new or changed files are fetched and parsed again,
+    and the CSV is not generated again when no month's results changed, unless forced.
 
     Create local_path if it does not exist. Forward slaches based paths
     are translated into proper paths using `pathlib`,
     so, even on Windows, there's no need to use backward slashes.
     """
+    import pandas as pd
+
+    from eu_state_aids.cache import ParsedCache, file_checksum
+    from eu_state_aids.manifest import Manifest
+    from eu_state_aids.writers import (check_format, output_filepath,
+                                       write_output)
+
+    # script parameters validations
+    if since is not None:
+        assert(validate_year_month(since))
+        since = tuple(map(int, since.split("_")))
+    check_format(output_format)
 
     # create directory if not existing
     local_path = Path(local_path)
     if not os.path.exists(local_path):
         os.makedirs(local_path)
 
-    # build remote url and filepath, out of the year,
+    cache = ParsedCache(local_path / "cache" / "misure", version=MISURE_CACHE_VERSION)
+
+    # months before since are not checked, unless they were never cached
+    periods = misure_periods()
+    urls = {period: build_misure_url(*period) for period in periods}
+    filepaths = {(year, month): local_path / f"misure_{year}_{month:02}.xml.zip" for year, month in periods}
+    checked = [
+        period for period in periods
+        if since is None or period >= since or cache.get(urls[period]) is None
+    ]
+
+    # fetch the files of the checked months, unless they were not modified since the last fetch
     typer.echo("Fetching all misure files")
+    items = []
+    for period in checked:
+        entry = cache.get(urls[period]) or {}
+        items.append((urls[period], filepaths[period], entry.get("etag"), entry.get("last_modified")))
+    results = dict(zip(checked, download_many(items, func=download_if_modified)))
+
+    reused, failed = [], []
+    for period in periods:
+        url = urls[period]
+        entry = cache.get(url)
+        if period not in results:
+            reused.append(period)
+            continue
+
+        result = results[period]
+        if isinstance(result, Exception):
+            typer.echo(f"Could not fetch {url}: {result}")
+            (reused if entry else failed).append(period)
+            continue
+        if result is None:
+            # not modified
+            reused.append(period)
+            continue
+
+        checksum = file_checksum(filepaths[period])
+        if entry and entry["checksum"] == checksum:
+            cache.update(url, **result)
+            reused.append(period)
+            continue
 
-    df = pd.DataFrame()
-    for year in range(2014, 2022):
-        for month in range(1, 13):
-
-            if year == 2021 and month in (8, 10):
-                continue
-            if year == 2014 and month < 5:
-                continue
-
-            xml_url = f"http://eu-state-aids.s3-eu-west-1.amazonaws.com/it/rna_mirror/" \
-                f"OpenDataMisure/OpenData_Misura_{year}_{month:02}.xml.zip"
-
-            typer.echo(f"Processing {xml_url}")
-
-            # read remote excel file content
-            r = requests.get(xml_url)
-            z = zipfile.ZipFile(BytesIO(r.content))
-            z_filename = [f.filename for f in z.filelist][0]
-            with z.open(z_filename, "r") as zf:
-                ydf = pdx.read_xml(zf.read().decode(), ["ns0:LISTA_MISURE_TYPE"])
-                ydf = ydf.pipe(flatten).pipe(flatten)
-                if "MISURA|LISTA_COFINANZIAMENTI" not in ydf.columns:
-                    continue
-                ydf = ydf[
-                    ydf.notnull()["MISURA|LISTA_COFINANZIAMENTI"]
-                ][['MISURA|COD_CE', 'MISURA|LISTA_COFINANZIAMENTI']]
-                ydf = ydf.pipe(flatten).pipe(flatten).pipe(flatten)
-                ydf.rename(columns={
-                    'MISURA|COD_CE': 'cod_ce',
-                    'MISURA|LISTA_COFINANZIAMENTI|COFINANZIAMENTO|DESCRIZIONE_FONDO': 'fondo_desc',
-                }, inplace=True)
-                ydf = ydf[ydf.notnull()["cod_ce"]]
-
-                if 'MISURA|LISTA_COFINANZIAMENTI|COFINANZIAMENTO|COD_FONDO' in ydf.columns:
-                    del ydf['MISURA|LISTA_COFINANZIAMENTI|COFINANZIAMENTO|COD_FONDO']
-                    del ydf['MISURA|LISTA_COFINANZIAMENTI|COFINANZIAMENTO|IMPORTO']
-
-                ydf['cod_ce'] = ydf.cod_ce.apply(normalize_cod_ce)
-                ydf = ydf[ydf.notnull()["cod_ce"]].drop_duplicates()
-
-                df = df.append(ydf)
-
-    df = df.drop_duplicates()
-
-    # emit csv
+        typer.echo(f"Processing {url}")
+        with metrics.stage("parse_misure", hot=True, year=period[0], month=period[1]) as counters:
+            df = parse_misure(filepaths[period])
+            counters.update(bytes_read=os.path.getsize(filepaths[period]), rows_out=len(df))
+        cache.store(url, df, checksum, **result)
+    cache.save()
+
+    if reused:
+        typer.echo(f"Cached results reused for {len(reused)} months: {', '.join(f'{y}_{m:02}' for y, m in reused)}")
+    if failed:
+        typer.echo(f"Could not fetch {len(failed)} months: {', '.join(f'{y}_{m:02}' for y, m in failed)}")
+
+    # the csv is generated again only if the results of any month changed
+    manifest = Manifest(local_path)
+    inputs = manifest.inputs({}, cache_version=MISURE_CACHE_VERSION, **{
+        f"misure_{y}_{m:02}": (cache.get(urls[(y, m)]) or {}).get("checksum") for y, m in periods
+    })
+    filepath = output_filepath(local_path, "misure", output_format)
+    if not force and manifest.is_unchanged("misure", inputs, filepath):
+        typer.echo(f"Misure files not changed since {filepath} was generated, skipped. Use --force to generate it.")
+        return
+
+    # merge all months' results, in a single concat
+    with metrics.stage("combine") as counters:
+        ydfs = [cache.load(urls[period]) for period in periods if cache.get(urls[period])]
+        df = pd.concat(ydfs).drop_duplicates() if ydfs else pd.DataFrame()
+        counters.update(rows_in=sum(len(ydf) for ydf in ydfs), rows_out=len(df))
+
+    # emit output file
     typer.echo(f"{len(df)} recordss found.")
-    csv_filepath = local_path / "misure.csv"
     if len(df):
-        typer.echo(f"Writing results to {csv_filepath}")
-        df.to_csv(csv_filepath, na_rep='', index=False)
+        typer.echo(f"Writing results to {filepath}")
+        with metrics.stage("write_output") as counters:
+            write_output(df, filepath, output_format)
+            counters["rows_out"] = len(df)
+    manifest.record("misure", inputs, filepath)
+    manifest.save()
 
 
 @app.command()
@@ -134,17 +427,13 @@ def fetch(
 
     # build remote url and filepath, out of the year,
     typer.echo(f"Fetching Aiuti data for year: {year}, month: {month}")
-    z_url = f"http://eu-state-aids.s3-eu-west-1.amazonaws.com/it/rna_mirror/" \
-        f"OpenDataAiuti/OpenData_Aiuti_{year}_{month}.xml.zip"
+    z_url = build_aiuti_url(int(year), int(month))
 
-    # read remote excel file content
-    r = requests.get(z_url)
-
-    if r.status_code == 200:
-        # store it locally
-        filepath = local_path / f"aiuti_{year}_{month}.xml.zip"
-        with open(filepath, 'wb') as f:
-            f.write(r.content)
+    # stream remote zip file content into the local file
+    filepath = local_path / f"aiuti_{year}_{month}.xml.zip"
+    with metrics.stage("fetch", year=int(year), month=int(month)):
+        downloaded = download(z_url, filepath)
+    if downloaded:
         typer.echo(f"File saved to {filepath}")
         return True
     else:
@@ -153,117 +442,789 @@ def fetch(
 
 
 @app.command()
-def export(
-    year_month: str,
+def fetch_range(
+    start_year_month: str,
+    end_year_month: str,
     local_path: str = typer.Option(
         "./data/it",
-        help="Local path to use for XML files. "
+        help="Local path to use for XML files. Always use forward slashes."
     ),
-    delete_processed: bool = typer.Option(False, help="Delete zipped xml file after processing")
+    workers: int = typer.Option(MAX_WORKERS, help="Max number of concurrent downloads"),
 ):
-    """Read XML from local path, filter with misure from misure.csv, then
-    compute and emit data as CSV file.
+    """Fetch Aiuti XML files for all months from start_year_month to end_year_month
+    (included, YYYY_MM format), downloading them concurrently, and store them locally.
 
-    Local path defaults to ./data/it, and can be changed with local_path.
+    Create the directory if it does not exist. Default directory is ./data/it,
+    and it can be changed with local_path.
     """
 
     # script parameters validations
-    # for both use cases: single month (YYYY_MM) and full year (YYYY)
-    if validate_year_month(year_month):
-        year, month = year_month.split("_")
-    elif validate_year(year_month):
-        year, month = year_month, None
-    else:
-        typer.echo(f"Invalid year, month value: {year_month}. Use YYYY or YYYY_MM.")
-        return
+    assert(validate_year_month(start_year_month))
+    assert(validate_year_month(end_year_month))
+    assert(workers >= 1)
 
-    # read misure csv from local_path
-    csv_filepath = Path(local_path) / "misure.csv"
-    misure_df = pd.read_csv(csv_filepath)
-    typer.echo(f"Misure dataframe read from {csv_filepath}.")
+    # create directory if not existing
+    local_path = Path(local_path)
+    if not os.path.exists(local_path):
+        os.makedirs(local_path)
 
-    # define months range in both cases
-    if month is None:
-        months = range(1, 13)
-    else:
-        months = [int(month)]
+    start_year, start_month = map(int, start_year_month.split("_"))
+    end_year, end_month = map(int, end_year_month.split("_"))
+    periods = [
+        (year, month) for year in range(start_year, end_year + 1) for month in range(1, 13)
+        if (start_year, start_month) <= (year, month) <= (end_year, end_month)
+    ]
+
+    typer.echo(f"Fetching Aiuti data for {len(periods)} months, from {start_year_month} to {end_year_month}")
+    filepaths = [local_path / f"aiuti_{year}_{month:02}.xml.zip" for year, month in periods]
+    results = download_many(
+        [(build_aiuti_url(year, month), filepath) for (year, month), filepath in zip(periods, filepaths)],
+        max_workers=workers
+    )
+    for (year, month), filepath, result in zip(periods, filepaths, results):
+        if result is True:
+            typer.echo(f"File saved to {filepath}")
+        elif result is False:
+            typer.echo(f"File not found for year: {year}, month: {month:02}")
+        else:
+            typer.echo(f"Error {result} while fetching year: {year}, month: {month:02}")
 
-    df = pd.DataFrame()  # empty dataframe that will contain all matching records
 
-    # main loop over the months range
-    for m in months:
-        # if xml file is not already there, then use the fetch program, to fetch it
-        if not os.path.exists(Path(local_path) / f"aiuti_{year}_{m:02}.xml.zip"):
-            if not fetch(year_month=f"{year}_{m:02}", local_path=local_path):
-                continue
+class MonthError(Exception):
+    """Raised when the Aiuti file of a month can not be fetched or parsed."""
+
+
+# version of the parsed Aiuti records, to be changed whenever the parsing logic changes,
+# so that stored partitions of other versions are parsed again
+AIUTI_SCHEMA_VERSION = "3"
+
+
+def parse_aiuti(
+    zip_file: Union[str, Path], codes: Optional[Container[str]] = None, shards: int = 1
+) -> pd.DataFrame:
+    """Parse a zipped Aiuti XML file into filtered and typed records:
+    only records with a valid cod_ce, normalized, are kept,
+    with the compact dtypes of schema.AIUTI_DTYPES.
+
+    Files larger than SHARD_MIN_SIZE, uncompressed, can be parsed in shards by more than one process,
+    with the same results (see read_aiuti_shards).
+
+    :param zip_file: path of the zipped XML file
+    :param codes: the normalized codes of the aids to keep, None to keep all
+    :param shards: number of processes used to parse a large file
+    :return: the DataFrame, with AIUTI_COLUMNS as columns
+    """
+    # parse content of zipped xml file, streaming the AIUTO elements
+    with metrics.stage("parse", hot=True) as counters:
+        with zipfile.ZipFile(zip_file) as z:
+            z_info = z.filelist[0]
+            adf = None
+            if shards > 1 and z_info.file_size >= SHARD_MIN_SIZE:
+                adf = read_aiuti_shards(z, z_info, codes, shards)
+            if adf is None:
+                with z.open(z_info.filename, "r") as zf:
+                    adf = read_aiuti(zf, codes)
+        counters.update(bytes_read=z_info.file_size, rows_out=len(adf))
+
+    return filter_aiuti(adf, codes)
+
+
+# files smaller than this, uncompressed, are always parsed by a single process
+SHARD_MIN_SIZE = 64 * 1024 * 1024
+
+# start tag of an AIUTO element, and first tag of a document (its root)
+AIUTO_START = re.compile(rb"<(?:[\w.-]+:)?AIUTO[\s/>]")
+ROOT_START = re.compile(rb"<([^\s?!/>][^\s/>]*)")
+
+
+def aiuto_bounds(buf: bytes, shards: int) -> List[int]:
+    """Split an Aiuti XML content into shards of whole AIUTO elements, of about the same size.
+
+    :param buf: the XML content (ie: a memory-mapped file)
+    :param shards: the number of shards
+    :return: the offsets of the starts of the shards, followed by the size of the content,
+      empty if there are no AIUTO elements
+    """
+    first = AIUTO_START.search(buf)
+    if first is None:
+        return []
+    start, size = first.start(), len(buf)
+    bounds = [start]
+    for i in range(1, shards):
+        match = AIUTO_START.search(buf, max(bounds[-1] + 1, start + (size - start) * i // shards))
+        if match is None:
+            break
+        bounds.append(match.start())
+    return bounds + [size]
+
+
+class _ConcatStream:
+    """Read-only binary stream over the concatenation of bytes-like parts."""
+
+    def __init__(self, *parts):
+        self.parts = [memoryview(part) for part in parts]
+        self.offset = 0
+
+    def read(self, size: int = -1) -> bytes:
+        chunks = []
+        while self.parts and size != 0:
+            part = self.parts[0]
+            n = len(part) - self.offset if size < 0 else min(size, len(part) - self.offset)
+            chunks.append(bytes(part[self.offset:self.offset + n]))
+            self.offset += n
+            if size > 0:
+                size -= n
+            if self.offset == len(part):
+                self.parts.pop(0).release()
+                self.offset = 0
+        return b"".join(chunks)
+
+    def close(self):
+        """Release the parts not read yet, so that the buffers they view can be closed."""
+        while self.parts:
+            self.parts.pop().release()
+
+
+def _read_aiuti_shard(
+    xml_file: str, header: bytes, start: int, end: int, trailer: bytes, codes: Optional[Container[str]]
+) -> pd.DataFrame:
+    """Read the records of the AIUTO elements between start and end of the XML file,
+    parsed as a document made of the header, the elements and the trailer."""
+    with open(xml_file, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        # all views of the file are released before it is unmapped
+        with memoryview(mm) as view, view[start:end] as shard:
+            stream = _ConcatStream(header, shard, trailer)
+            try:
+                return read_aiuti(stream, codes, sort=False)
+            finally:
+                stream.close()
+
+
+def read_aiuti_shards(
+    z: zipfile.ZipFile, z_info: zipfile.ZipInfo, codes: Optional[Container[str]] = None, shards: int = 2
+) -> Optional[pd.DataFrame]:
+    """Read the records of an Aiuti XML file, as read_aiuti does, in shards parsed by `shards` processes.
+
+    The XML content is extracted once into a temporary file, next to the zipped file,
+    and memory-mapped to split it into shards of whole AIUTO elements. Each shard is parsed
+    as a document, along with the content preceding the first AIUTO element (the root start tag),
+    and the records of the shards are concatenated in the document order.
 
+    :param z: the zipped XML file
+    :param z_info: the XML file in z
+    :param codes: the normalized codes of the aids to keep, None to keep all
+    :param shards: number of shards, and processes
+    :return: the DataFrame, None if the content can not be parsed in shards (ie: the shards are not well-formed)
+    """
+    import pandas as pd
+
+    from eu_state_aids import schema
+
+    fd, xml_file = tempfile.mkstemp(suffix=".xml", dir=os.path.dirname(os.path.abspath(z.filename)))
+    try:
+        with os.fdopen(fd, "wb") as f, z.open(z_info.filename, "r") as zf:
+            shutil.copyfileobj(zf, f, CHUNK_SIZE)
+        with open(xml_file, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            bounds = aiuto_bounds(mm, shards)
+            header = mm[:bounds[0]] if bounds else b""
+        root = ROOT_START.search(header)
+        if root is None:
+            return None
+
+        # the root element is closed by the last shard
+        trailer = b"</" + root.group(1) + b">"
+        args = [
+            (xml_file, header, start, end, trailer if end < bounds[-1] else b"", codes)
+            for start, end in zip(bounds, bounds[1:])
+        ]
+        with ProcessPoolExecutor(max_workers=len(args)) as executor:
+            try:
+                dfs = list(executor.map(_read_aiuti_shard, *zip(*args)))
+            except ElementTree.ParseError as e:
+                typer.echo(f"Error {e} while parsing in shards, parsing {z_info.filename} as a whole")
+                return None
+    finally:
+        os.unlink(xml_file)
+
+    adf = pd.concat(schema.unify_categories(dfs), ignore_index=True)
+    return sort_aiuti(schema.compact(adf, schema.AIUTI_DTYPES))
+
+
+def stream_aiuti(url: str, codes: Optional[Container[str]] = None) -> Tuple[pd.DataFrame, str]:
+    """Parse the zipped Aiuti XML file at url into filtered and typed records, as parse_aiuti does,
+    decompressing and parsing the content while it is downloaded, without storing it.
+
+    :param url: the url of the zipped XML file
+    :param codes: the normalized codes of the aids to keep, None to keep all
+    :return: the DataFrame, with AIUTI_COLUMNS as columns, and the sha256 checksum of the zipped file
+    :raise requests.HTTPError: when the server answered with a client error (ie: 404)
+    """
+    with metrics.stage("parse", hot=True) as counters:
+        with stream_url(url) as response:
+            zf = ZipMemberStream(response)
+            adf = read_aiuti(zf, codes)
+            # read up to the end of the archive, so that the checksum is the one of the whole file
+            while response.read(CHUNK_SIZE):
+                pass
+        counters.update(bytes_read=zf.size, rows_out=len(adf))
+
+    return filter_aiuti(adf, codes), response.sha256.hexdigest()
+
+
+def filter_aiuti(adf: pd.DataFrame, codes: Optional[Container[str]] = None) -> pd.DataFrame:
+    """Filter parsed Aiuti records: only records with a valid cod_ce, normalized, are kept.
+
+    :param adf: the records, as read by read_aiuti
+    :param codes: the normalized codes the records were read with, None if all were kept
+    :return: the DataFrame, with AIUTI_COLUMNS as columns
+    """
+    from eu_state_aids import schema, transforms
+
+    # with no codes, only aids with no COD_CE_MISURA are skipped while parsing
+    if len(adf) == 0:
+        typer.echo("No COD_CE_MISURA in file" if codes is None else "No aids matching the misure in file")
+
+    with metrics.stage("filter") as counters:
+        counters["rows_in"] = len(adf)
+
+        # normalise cod_ce into SA.XXXX format
+        adf['cod_ce'] = transforms.normalize_cod_ce(adf.cod_ce)
+
+        # keep only records with valid cod_ce
+        adf = adf[adf.notnull()["cod_ce"]].reset_index(drop=True)
+        adf = schema.compact(adf, schema.AIUTI_DTYPES)
+        counters["rows_out"] = len(adf)
+    return adf
+
+
+# keys and summed values of the exported records
+EXPORT_KEYS = ['cf_benef', 'denom_benef', 'cod_ce', 'fondo_desc']
+EXPORT_VALUES = ['componenti_importo_aiuto', 'n_records']
+
+# columns of the exported records stored in the results database (see results.COLUMNS)
+RESULTS_COLUMNS = {
+    'cf_benef': 'beneficiary_id',
+    'denom_benef': 'beneficiary_name',
+    'cod_ce': 'scheme',
+    'fondo_desc': 'program',
+    'componenti_importo_aiuto': 'amount',
+}
+
+# columns identifying the exported records, in their deltas
+DELTA_KEYS = ['cf_benef', 'cod_ce', 'fondo_desc']
+
+
+def build_misure_lookup(misure_df: pd.DataFrame) -> Dict[str, List[str]]:
+    """Map the normalized cod_ce of the misure dataframe to the descriptions of their funds,
+    so that aids can be matched with the misure while they are parsed.
+
+    :param misure_df: the misure dataframe, with cod_ce and fondo_desc columns
+    :return: the lists of funds' descriptions, by cod_ce
+    """
+    lookup = {}
+    for cod_ce, fondo_desc in zip(misure_df.cod_ce, misure_df.fondo_desc):
+        if isinstance(cod_ce, str):
+            lookup.setdefault(cod_ce, []).append(fondo_desc)
+    return lookup
+
+
+def export_month(
+    year: str, month: int, local_path: str, misure_df: pd.DataFrame,
+    delete_processed: bool = False, store_parsed: bool = False, stream: bool = False, shards: int = 1,
+    presum: bool = True
+) -> Optional[pd.DataFrame]:
+    """Fetch the Aiuti file of a month, if not already there, parse it,
+    and join its records with the misure dataframe.
+
+    When store_parsed is set, parsed records are stored as Parquet files in local_path/parsed,
+    and read from there in later calls, unless the stored records are stale.
+
+    When stream is set, a file that is not already there is parsed while it is downloaded,
+    without storing it locally.
+
+    Unless parsed records are stored, aids not matching the misure are skipped while parsing,
+    as they would be dropped by the join anyway.
+
+    This is the unit of work of the export command, and can be run in a
+    separate process.
+
+    :param year: the year (YYYY)
+    :param month: the month number
+    :param local_path: local path of the XML files
+    :param misure_df: the misure dataframe, with cod_ce and fondo_desc columns
+    :param delete_processed: delete zipped xml file after processing
+    :param store_parsed: store parsed records, and reuse them
+    :param stream: parse the remote file while downloading it, instead of fetching it
+    :param shards: number of processes used to parse a large local file
+    :param presum: sum the matching records by EXPORT_KEYS, instead of returning them as they are
+    :return: the matching records, with EXPORT_KEYS and EXPORT_VALUES as columns, None if there are none
+    :raise MonthError: when the file can not be fetched or parsed
+    """
+    from eu_state_aids.cache import file_checksum
+    from eu_state_aids.partitions import PartitionedStore
+
+    with metrics.stage("export_month", year=int(year), month=month):
         local_path = Path(local_path)
-        zip_file = local_path / f"aiuti_{year}_{m:02}.xml.zip"
-        typer.echo(f"Processing {zip_file}")
+        zip_file = local_path / f"aiuti_{year}_{month:02}.xml.zip"
 
-        # parse content of zipped xml file
-        z = zipfile.ZipFile(zip_file)
-        z_filename = [f.filename for f in z.filelist][0]
-        with z.open(z_filename, "r") as zf:
-            c = zf.read().decode()
+        # stored records must be complete, so that they do not depend on the misure
+        codes = None if store_parsed else build_misure_lookup(misure_df)
+
+        adf = None
+        if store_parsed:
+            store = PartitionedStore(local_path / "parsed", AIUTI_SCHEMA_VERSION)
+            checksum = file_checksum(zip_file) if os.path.exists(zip_file) else None
+            with metrics.stage("read_parsed") as counters:
+                adf = store.get(year, month, checksum)
+                counters["rows_out"] = 0 if adf is None else len(adf)
+            if adf is not None:
+                typer.echo(f"Parsed records read from {store.partition_path(year, month)}")
+
+        if adf is None and stream and not os.path.exists(zip_file):
+            adf, checksum = _stream_month(year, month, codes)
+            if store_parsed:
+                with metrics.stage("store_parsed"):
+                    store.put(year, month, adf, checksum)
+
+        if adf is None:
+            # if xml file is not already there, then use the fetch program, to fetch it
+            if not os.path.exists(zip_file):
+                if not fetch(year_month=f"{year}_{month:02}", local_path=str(local_path)):
+                    raise MonthError("file not found")
+
+            typer.echo(f"Processing {zip_file}")
             try:
-                adf = pdx.read_xml(re.sub(r"&#(\d+);", "", c), ["LISTA_AIUTI"])
+                adf = parse_aiuti(zip_file, codes, shards)
             except Exception as e:
                 typer.echo(f"Error {e} while parsing {zip_file}")
-                continue
+                raise MonthError(f"error {e} while parsing {zip_file}") from e
 
-            adf = adf.pipe(fully_flatten)
+            if store_parsed:
+                with metrics.stage("store_parsed"):
+                    store.put(year, month, adf, file_checksum(zip_file))
 
-        # clean up if required
-        if delete_processed:
-            os.unlink(zip_file)
-            typer.echo(f"Removing {zip_file}")
+            # clean up if required
+            if delete_processed:
+                os.unlink(zip_file)
+                typer.echo(f"Removing {zip_file}")
 
-        # skip when no COD_CE_MISURA values are in the xml file
-        if 'AIUTO|COD_CE_MISURA' not in adf.columns:
-            typer.echo("No COD_CE_MISURA in file")
-            continue
+        return sum_matches(adf, misure_df, presum)
 
-        # transform needed columns
-        adf = adf[adf.notnull()["AIUTO|COD_CE_MISURA"]]
-        adf.rename(columns={
-            "AIUTO|COD_CE_MISURA": "cod_ce",
-            "AIUTO|DENOMINAZIONE_BENEFICIARIO": "denom_benef",
-            "AIUTO|CODICE_FISCALE_BENEFICIARIO": "cf_benef",
-            "AIUTO|COMPONENTI_AIUTO|COMPONENTE_AIUTO|STRUMENTI_AIUTO|STRUMENTO_AIUTO|IMPORTO_NOMINALE":
-            "componenti_importo_aiuto"
-        }, inplace=True)
 
-        # normalise cod_ce into SA.XXXX format
-        adf['cod_ce'] = adf.cod_ce.apply(normalize_cod_ce)
+def _stream_month(year: str, month: int, codes: Optional[Container[str]] = None) -> Tuple[pd.DataFrame, str]:
+    """Parse the remote Aiuti file of a month while downloading it, as stream_aiuti does.
 
-        # keep only records with valid cod_ce
-        adf = adf[adf.notnull()["cod_ce"]]
+    :raise MonthError: when the file can not be fetched or parsed
+    """
+    import requests
 
-        # sip when no valid records
-        if len(adf) == 0:
-            continue
+    z_url = build_aiuti_url(int(year), month)
+    typer.echo(f"Streaming {z_url}")
+    try:
+        return stream_aiuti(z_url, codes)
+    except Exception as e:
+        if isinstance(e, requests.HTTPError) and is_client_error(e.response):
+            typer.echo("File not found")
+            raise MonthError("file not found") from e
+        typer.echo(f"Error {e} while streaming {z_url}")
+        raise MonthError(f"error {e} while streaming {z_url}") from e
 
-        # only keep needed columns
-        adf = adf[['cod_ce', 'denom_benef', 'cf_benef', 'componenti_importo_aiuto']]
 
-        # join the misure dataframe, to keep only records found in the misure sources
+def sum_matches(adf: pd.DataFrame, misure_df: pd.DataFrame, presum: bool = True) -> Optional[pd.DataFrame]:
+    """Join parsed Aiuti records with the misure dataframe, and sum them by EXPORT_KEYS.
+
+    The amounts of each group are added in the order of the records, as the XML file lists them,
+    so that the sums of a month are the same as the ones of a single sum of its records.
+
+    :param adf: the parsed records, as returned by parse_aiuti
+    :param misure_df: the misure dataframe, with cod_ce and fondo_desc columns
+    :param presum: sum the matching records, instead of returning them as they are
+    :return: the partial sums of the matching records (EXPORT_VALUES), by EXPORT_KEYS, None if there are none
+    """
+    import pandas as pd
+
+    from eu_state_aids import schema
+    from eu_state_aids.aggregate import PartialSums
+
+    # sip when no valid records
+    if len(adf) == 0:
+        return None
+
+    # join the misure dataframe, to keep only records found in the misure sources,
+    # on the codes of cod_ce categories shared by both dataframes
+    with metrics.stage("merge") as counters:
+        adf, misure_df = schema.unify_categories([adf, misure_df], ['cod_ce'])
         ydf = pd.merge(adf, misure_df, on="cod_ce", suffixes=("_a", "_m"))
+        counters.update(rows_in=len(adf), rows_out=len(ydf))
 
-        typer.echo(f"{len(ydf)} records with matching cod_ce found in file")
+    typer.echo(f"{len(ydf)} records with matching cod_ce found in file")
+    ydf['n_records'] = 1
+    if not presum:
+        return ydf[EXPORT_KEYS + EXPORT_VALUES]
 
-        # append to final dataframe
-        df = df.append(ydf)
+    # pre-aggregate the month's records into partial sums, counting them
+    with metrics.stage("sum") as counters:
+        sums = PartialSums(EXPORT_KEYS, EXPORT_VALUES).combine([ydf])
+        counters.update(rows_in=len(ydf), rows_out=len(sums))
+    return sums
 
-    typer.echo(f"{len(df)} matches found.")
-    if len(df):
-        # transform import into float, before properly summing it
-        df.componenti_importo_aiuto = df.componenti_importo_aiuto.astype(float)
-        df = df.groupby([
-            'cf_benef', 'denom_benef', 'cod_ce', 'fondo_desc'
-        ])['componenti_importo_aiuto'].sum().reset_index()
-
-        # emit the final csv for the period
-        csv_filepath = local_path / f"{year_month}.csv"
-        typer.echo(f"Writing results to {csv_filepath}")
-        df.to_csv(csv_filepath, na_rep='', index=False)
+
+def parse_period(year_month: str) -> Tuple[str, List[int]]:
+    """Split a period, a single month (YYYY_MM) or a full year (YYYY), into its year and month numbers.
+
+    :param year_month: the period
+    :return: the year (YYYY) and the month numbers
+    :raise ValueError: when the period is not valid
+    """
+    if validate_year_month(year_month):
+        year, month = year_month.split("_")
+        return year, [int(month)]
+    if validate_year(year_month):
+        return year_month, list(range(1, 13))
+    raise ValueError(f"Invalid year, month value: {year_month}. Use YYYY or YYYY_MM.")
+
+
+def misure_filepath(local_path: Union[str, Path]) -> Path:
+    """Return the path of the misure file in local_path, in the format it was last generated in,
+    misure.csv if it was never generated."""
+    from eu_state_aids.writers import find_output, output_filepath
+
+    return find_output(local_path, "misure") or output_filepath(local_path, "misure")
+
+
+def read_misure(local_path: Union[str, Path] = "./data/it") -> pd.DataFrame:
+    """Read the misure dataframe out of the misure file in local_path, in any of the output formats,
+    with the compact dtypes of schema.MISURE_DTYPES.
+
+    :param local_path: local path of the misure file
+    :return: the misure dataframe, with cod_ce and fondo_desc columns
+    """
+    from eu_state_aids import schema
+    from eu_state_aids.writers import read_output
+
+    filepath = misure_filepath(local_path)
+    with metrics.stage("read_misure") as counters:
+        misure_df = schema.compact(read_output(filepath), schema.MISURE_DTYPES)
+        counters.update(bytes_read=os.path.getsize(filepath), rows_out=len(misure_df))
+    typer.echo(f"Misure dataframe read from {filepath}.")
+    return misure_df
+
+
+def sum_months(
+    year: str, months: List[int], local_path: Union[str, Path], misure_df: pd.DataFrame, workers: int = 1,
+    delete_processed: bool = False, store_parsed: bool = False, memory_budget: Optional[int] = None,
+    stream: bool = False, shards: int = 1
+) -> Tuple[pd.DataFrame, List[Tuple[int, str]]]:
+    """Process the months of the year with export_month, serially or in a pool of processes,
+    and sum their matching records, always in the months order.
+
+    Without a memory budget, the records of all months are summed at once, at the end,
+    as a single sum of the year's records.
+    With a budget, each month's records are summed into partial sums, combined as they exceed it,
+    and spilled to disk, so that the last digits of the amounts may differ from the ones summed at once.
+
+    :param year: the year (YYYY)
+    :param months: the month numbers
+    :param local_path: local path of the XML files
+    :param misure_df: the misure dataframe, with cod_ce and fondo_desc columns
+    :param workers: number of processes used to process months in parallel
+    :param delete_processed: delete zipped xml files after processing
+    :param store_parsed: store parsed records, and reuse them
+    :param memory_budget: memory budget of the partial sums, in MB, exceeding sums are spilled to local_path
+    :param stream: parse the remote files while downloading them, instead of fetching them
+    :param shards: number of processes used to parse each large local file
+    :return: the sums of the matching records (EXPORT_VALUES), by EXPORT_KEYS, and the errors of the failed months
+    """
+    from eu_state_aids.aggregate import PartialSums
+
+    sums = PartialSums(
+        EXPORT_KEYS, EXPORT_VALUES,
+        memory_budget=memory_budget * 1024 * 1024 if memory_budget else None, spill_path=local_path
+    )
+    # months are only pre-aggregated under a budget, their records being summed at once otherwise
+    presum = sums.memory_budget is not None
+    args = [
+        (year, m, str(local_path), misure_df, delete_processed, store_parsed, stream, shards, presum) for m in months
+    ]
+    if workers > 1 and len(months) > 1:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            futures = [executor.submit(metrics.collected, metrics.worker_settings(), export_month, *a) for a in args]
+            outcomes = (_outcome(metrics.merge, f.result()) for f in futures)
+            errors = _add_outcomes(sums, months, outcomes)
+    else:
+        outcomes = (_outcome(export_month, *a) for a in args)
+        errors = _add_outcomes(sums, months, outcomes)
+
+    # report failed months
+    for m, error in errors:
+        typer.echo(f"Month {year}_{m:02} skipped: {error}")
+
+    with metrics.stage("combine") as counters:
+        df = sums.result()
+        counters["rows_out"] = len(df)
+    return df, errors
+
+
+def iter_aids(
+    year_month: str, local_path: Union[str, Path] = "./data/it", misure_df: Optional[pd.DataFrame] = None,
+    delete_processed: bool = False, store_parsed: bool = False, stream: bool = False, shards: int = 1
+) -> Iterator[pd.DataFrame]:
+    """Iterate over the aids of the months of a period (YYYY or YYYY_MM), matching the misure,
+    one month at a time, without writing any CSV file.
+
+    Months are processed as the export command does, fetching missing files,
+    and failed months are reported and skipped.
+
+    :param year_month: the period
+    :param local_path: local path of the XML files
+    :param misure_df: the misure dataframe, read from the misure file in local_path if not given
+    :param delete_processed: delete zipped xml files after processing
+    :param store_parsed: store parsed records, and reuse them
+    :param stream: parse the remote files while downloading them, instead of fetching them
+    :param shards: number of processes used to parse each large local file
+    :return: an iterator over the records of each month (EXPORT_VALUES), summed by EXPORT_KEYS,
+      records with missing keys excluded, as they are not exported
+    :raise ValueError: when the period is not valid
+    """
+    year, months = parse_period(year_month)
+    if misure_df is None:
+        misure_df = read_misure(local_path)
+    for m in months:
+        records, error = _outcome(
+            export_month, year, m, str(local_path), misure_df, delete_processed, store_parsed, stream, shards
+        )
+        if error is not None:
+            typer.echo(f"Month {year}_{m:02} skipped: {error}")
+        elif records is not None:
+            records = records.dropna(subset=EXPORT_KEYS).reset_index(drop=True)
+            if len(records):
+                yield records
+
+
+def load_period(
+    year_month: str, local_path: Union[str, Path] = "./data/it", misure_df: Optional[pd.DataFrame] = None,
+    workers: int = 1, delete_processed: bool = False, store_parsed: bool = False,
+    memory_budget: Optional[int] = None, stream: bool = False, shards: int = 1
+) -> pd.DataFrame:
+    """Load the aids of a period (YYYY or YYYY_MM), summed as the export command does,
+    without writing any CSV file.
+
+    :param year_month: the period
+    :param local_path: local path of the XML files
+    :param misure_df: the misure dataframe, read from the misure file in local_path if not given
+    :param workers: number of processes used to process months in parallel
+    :param delete_processed: delete zipped xml files after processing
+    :param store_parsed: store parsed records, and reuse them
+    :param memory_budget: memory budget of the partial sums, in MB, exceeding sums are spilled to local_path
+    :param stream: parse the remote files while downloading them, instead of fetching them
+    :param shards: number of processes used to parse each large local file
+    :return: the sums of the records (EXPORT_VALUES) by EXPORT_KEYS, records with missing keys excluded
+    :raise ValueError: when the period is not valid
+    """
+    year, months = parse_period(year_month)
+    if misure_df is None:
+        misure_df = read_misure(local_path)
+    df, _ = sum_months(
+        year, months, local_path, misure_df, workers, delete_processed, store_parsed, memory_budget, stream, shards
+    )
+    return df.dropna(subset=EXPORT_KEYS).reset_index(drop=True)
+
+
+@app.command()
+def export(
+    year_month: str,
+    local_path: str = typer.Option(
+        "./data/it",
+        help="Local path to use for XML files. "
+    ),
+    delete_processed: bool = typer.Option(False, help="Delete zipped xml file after processing"),
+    workers: int = typer.Option(
+        1, help="Number of processes used to process months in parallel; "
+                "their records are kept until summed, unless a --memory-budget is set"
+    ),
+    store_parsed: bool = typer.Option(
+        False, help="Store parsed records as Parquet files in local_path/parsed, and reuse them in later exports"
+    ),
+    memory_budget: int = typer.Option(
+        None, help="Memory budget for the aggregation, in MB, partial sums exceeding it are spilled to disk; "
+                   "the last digits of the amounts may then differ from the ones of an export without budget"
+    ),
+    stream: bool = typer.Option(
+        False, help="Parse missing XML files while downloading them, without storing them locally"
+    ),
+    force: bool = typer.Option(
+        False, help="Export the period even if its inputs did not change since its last export; "
+                    "periods whose XML files are not kept locally are always exported"
+    ),
+    shards: int = typer.Option(
+        1, help="Number of processes used to parse each large XML file, split into shards of whole AIUTO elements"
+    ),
+    results_db: str = typer.Option(
+        None, help="Also store the exported records into this SQLite database, to be looked up with the query command"
+    ),
+    output_format: str = typer.Option(
+        "csv", help="Format of the output file: csv, csv.gz, csv.zst or parquet, written with a .meta.json sidecar"
+    ),
+    delta: bool = typer.Option(
+        False, help="Also write the records inserted, updated or deleted since the previous export into a "
+                    "{year_month}_delta file"
+    ),
+):
+    """Read XML from local path, filter with the misure written by generate-measures,
+    in whatever output format, then compute and emit data as CSV file.
+
+    Local path defaults to ./data/it, and can be changed with local_path.
+    The matching records of a year are summed at once, unless memory_budget bounds the memory they use.
+    The period is skipped if its inputs did not change since its last export.
+    """
+    from eu_state_aids import delta as deltas
+    from eu_state_aids.manifest import Manifest
+    from eu_state_aids.results import ResultsStore
+    from eu_state_aids.writers import (check_format, output_filepath,
+                                       write_output)
+
+    # script parameters validations
+    # for both use cases: single month (YYYY_MM) and full year (YYYY)
+    try:
+        year, months = parse_period(year_month)
+    except ValueError as e:
+        typer.echo(str(e))
+        return
+    assert(workers >= 1)
+    assert(shards >= 1)
+    check_format(output_format)
+
+    # the period is skipped if its inputs and output did not change
+    local_path = Path(local_path)
+    manifest = Manifest(local_path)
+    store = ResultsStore(results_db) if results_db else None
+    try:
+        filepath = output_filepath(local_path, year_month, output_format)
+        inputs = export_inputs(manifest, local_path, year, months, memory_budget)
+        if not force and manifest.is_unchanged(f"export:{year_month}", inputs, filepath) and \
+                (store is None or store.has_period("it", year_month)):
+            typer.echo(
+                f"Inputs of {year_month} not changed since its last export, skipped. Use --force to export it again."
+            )
+            if delta:
+                deltas.remove(output_filepath(local_path, f"{year_month}_delta", output_format))
+            return
+
+        df, errors = sum_months(
+            year, months, local_path, read_misure(local_path),
+            workers, delete_processed, store_parsed, memory_budget, stream, shards
+        )
+        typer.echo(f"{df.n_records.sum()} matches found.")
+
+        # records with missing keys are not exported
+        df = df.dropna(subset=EXPORT_KEYS)[EXPORT_KEYS + ['componenti_importo_aiuto']]
+        previous = deltas.read_records(filepath) if delta else None
+        if len(df):
+
+            # emit the final output file for the period
+            typer.echo(f"Writing results to {filepath}")
+            with metrics.stage("write_output") as counters:
+                write_output(df, filepath, output_format)
+                counters["rows_out"] = len(df)
+        elif delta:
+            # the outdated output file is removed, so that the next delta does not delete its records again
+            deltas.remove(filepath)
+
+        # emit the records changed since the previous output file
+        if delta:
+            delta_filepath = output_filepath(local_path, f"{year_month}_delta", output_format)
+            with metrics.stage("write_delta") as counters:
+                delta_df = deltas.write_delta(
+                    previous, filepath if len(df) else None, delta_filepath, output_format, DELTA_KEYS
+                )
+                counters.update(rows_in=len(df), rows_out=len(delta_df))
+            typer.echo(f"{len(delta_df)} changed records written to {delta_filepath}")
+
+        # periods with failed months are exported again
+        if not errors:
+            manifest.record(
+                f"export:{year_month}", export_inputs(manifest, local_path, year, months, memory_budget), filepath
+            )
+        manifest.save()
+        if store is not None:
+            with metrics.stage("store_results") as counters:
+                store.upsert("it", year_month, df, RESULTS_COLUMNS)
+                counters["rows_out"] = len(df)
+            typer.echo(f"Records stored into {results_db}")
+    finally:
+        if store is not None:
+            store.close()
+
+
+def export_inputs(
+    manifest: Manifest, local_path: Union[str, Path], year: str, months: List[int],
+    memory_budget: Optional[int] = None
+) -> dict:
+    """Build the inputs of the export of the months of the year, for the manifest of local_path:
+    the misure file, the zipped Aiuti XML files of the months, and the memory budget,
+    as it changes the order the amounts are added in.
+
+    :param manifest: the manifest of local_path
+    :param local_path: local path of the XML files
+    :param year: the year (YYYY)
+    :param months: the month numbers
+    :param memory_budget: memory budget of the partial sums, in MB, None for no budget
+    :return: the inputs
+    """
+    local_path = Path(local_path)
+    files = {"misure": misure_filepath(local_path)}
+    files.update({f"aiuti_{year}_{m:02}": local_path / f"aiuti_{year}_{m:02}.xml.zip" for m in months})
+    return manifest.inputs(
+        files, schema_version=AIUTI_SCHEMA_VERSION, memory_budget=str(memory_budget) if memory_budget else ""
+    )
+
+
+def _add_outcomes(sums: PartialSums, months: List[int], outcomes: Iterator) -> List[Tuple[int, str]]:
+    """Add the records of the months' outcomes, returning the errors of the failed months."""
+    errors = []
+    for m, (records, error) in zip(months, outcomes):
+        if error is not None:
+            errors.append((m, error))
+        elif records is not None:
+            sums.add(records)
+    return errors
+
+
+def _outcome(func, *args) -> Tuple[Optional[pd.DataFrame], Optional[str]]:
+    """Call func, returning its result and the error message of a MonthError, if raised."""
+    try:
+        return func(*args), None
+    except MonthError as e:
+        return None, str(e)
+
+
+def pipeline_tasks(years: List[str], local_path: Union[str, Path], force: bool = False) -> List[Task]:
+    """Tasks of the pipeline of the given years: misure.csv is generated first,
+    then each year is exported, fetching its missing Aiuti files.
+
+    :param years: the years
+    :param local_path: local path of the XML files
+    :param force: generate misure.csv and export the years even if their inputs did not change
+    :return: the tasks
+    """
+    from eu_state_aids.pipeline import Task
+
+    local_path = Path(local_path)
+    misure_csv = local_path / "misure.csv"
+    # the commands are called with all their options, by name, as their defaults are typer.Option objects
+    tasks = [Task(
+        "it:misure",
+        partial(generate_measures, local_path=str(local_path), since=None, force=force, output_format="csv"),
+        outputs=[misure_csv]
+    )]
+    for year in years:
+        tasks.append(Task(
+            f"it:export:{year}",
+            partial(
+                export, year_month=year, local_path=str(local_path), delete_processed=False, workers=1,
+                store_parsed=False, memory_budget=None, stream=False, force=force, shards=1, results_db=None,
+                output_format="csv", delta=False
+            ),
+            inputs=[misure_csv], outputs=[local_path / f"{year}.csv"]
+        ))
+    return tasks
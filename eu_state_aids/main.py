@@ -1,8 +1,186 @@
 # coding: utf-8
+import contextlib
+import importlib
+import os
+import sys
+from pathlib import Path
+
+import click
 import typer
 
-from eu_state_aids import bg, it
+from eu_state_aids import metrics
+
+# modules of the countries' sub-commands
+countries = {
+    "bg": "eu_state_aids.bg",
+    "it": "eu_state_aids.it",
+}
+
+# short help of the countries' sub-commands, shown in the main help without importing their modules
+countries_help = {
+    "bg": "Bulgarian state aids, from the eufunds.bg projects.",
+    "it": "Italian state aids, from the RNA open data.",
+}
+
+
+class CountriesGroup(click.Group):
+    """Group of commands registering the countries' sub-commands lazily,
+    so that only the module of the invoked country is imported, and none for the main help."""
+
+    def list_commands(self, ctx: click.Context):
+        return sorted(set(super().list_commands(ctx)) | set(countries))
+
+    def get_command(self, ctx: click.Context, name: str):
+        if name in countries and name not in self.commands:
+            module = importlib.import_module(countries[name])
+            group = typer.main.get_group(module.app)
+            group.help = group.help or countries_help[name]
+            self.add_command(group, name)
+        return super().get_command(ctx, name)
+
+    def format_commands(self, ctx: click.Context, formatter: click.HelpFormatter):
+        """List the commands with their short help, the countries' one from countries_help."""
+        rows = []
+        for name in self.list_commands(ctx):
+            if name in countries and name not in self.commands:
+                rows.append((name, countries_help[name]))
+                continue
+            cmd = self.get_command(ctx, name)
+            if cmd is not None and not cmd.hidden:
+                rows.append((name, cmd))
+        if rows:
+            limit = formatter.width - 6 - max(len(name) for name, _ in rows)
+            with formatter.section("Commands"):
+                formatter.write_dl([
+                    (name, cmd if isinstance(cmd, str) else cmd.get_short_help_str(limit)) for name, cmd in rows
+                ])
+
+
+app = typer.Typer(cls=CountriesGroup)
+
+
+@app.callback()
+def main(
+    ctx: typer.Context,
+    metrics_file: str = typer.Option(
+        None, help="Write a JSON report with time, memory, bytes and rows of each stage of the run to this file"
+    ),
+    profile: bool = typer.Option(
+        False, help="Profile the hot stages with cProfile, dumping stats next to the metrics file"
+    ),
+):
+    """Extract state aids data from public sources and produce CSV files."""
+    if profile and not metrics_file:
+        typer.echo("The --profile option requires a --metrics-file")
+        raise typer.Exit(1)
+    if not metrics_file:
+        return
+
+    # collect metrics during the command, writing them when it ends
+    metrics_file = Path(metrics_file)
+    profile_path = metrics_file.parent / f"{metrics_file.stem}_profiles" if profile else None
+    stack = contextlib.ExitStack()
+    collector = stack.enter_context(metrics.collect(profile_path=profile_path))
+
+    def write_metrics():
+        stack.close()
+        collector.write(metrics_file, argv=sys.argv[1:])
+        typer.echo(f"Metrics written to {metrics_file}")
+    ctx.call_on_close(write_metrics)
+
+
+@app.command()
+def run(
+    country_codes: str = typer.Option(
+        ",".join(countries), "--countries", help="Comma separated codes of the countries to export"
+    ),
+    years: str = typer.Option(..., help="Years to export, as a single year (YYYY) or a range (YYYY-YYYY)"),
+    local_path: str = typer.Option("./data", help="Local path to use, with a directory for each country"),
+    workers: int = typer.Option(1, help="Number of processes used to run independent tasks in parallel"),
+    force: bool = typer.Option(False, help="Export all periods, even if their inputs did not change"),
+):
+    """Fetch and export all the given countries and years, in a single run.
+
+    Each country declares the tasks of its pipeline, with the files they read and write,
+    so that tasks are run after the ones they depend on (ie: misure.csv is generated before
+    Italian exports), and independent tasks are run in parallel. A summary is shown at the end.
+    """
+    from eu_state_aids.pipeline import DONE, run_tasks
+    from eu_state_aids.utils import validate_year
+
+    # script parameters validations
+    codes = country_codes.split(",")
+    for code in codes:
+        if code not in countries:
+            typer.echo(f"Unknown country: {code}. Use one of: {', '.join(countries)}.")
+            raise typer.Exit(1)
+    start_year, _, end_year = years.partition("-")
+    end_year = end_year or start_year
+    if not validate_year(start_year) or not validate_year(end_year):
+        typer.echo(f"Invalid years value: {years}. Use YYYY or YYYY-YYYY.")
+        raise typer.Exit(1)
+    assert(workers >= 1)
+
+    tasks = []
+    year_range = [str(y) for y in range(int(start_year), int(end_year) + 1)]
+    for code in codes:
+        module = importlib.import_module(countries[code])
+        tasks.extend(module.pipeline_tasks(year_range, Path(local_path) / code, force))
+
+    outcomes = run_tasks(tasks, workers=workers)
+
+    typer.echo("Summary:")
+    for name, outcome in outcomes.items():
+        typer.echo(f"  {name}: {outcome}")
+    n_done = sum(outcome == DONE for outcome in outcomes.values())
+    typer.echo(f"  {n_done} of {len(outcomes)} tasks done")
+
+
+@app.command()
+def query(
+    results_db: str = typer.Option(
+        "./data/results.db", help="SQLite database of the records stored by the export commands"
+    ),
+    beneficiary: str = typer.Option(None, help="ID (fiscal code) of the beneficiary"),
+    name: str = typer.Option(None, help="Part of the name of the beneficiaries, case insensitive"),
+    scheme: str = typer.Option(None, help="State aid scheme (SA.NNNNN)"),
+    country: str = typer.Option(None, help="Country code"),
+    period: str = typer.Option(None, help="Exported period (YYYY, or YYYY_MM)"),
+    totals_by: str = typer.Option(
+        None, help="Sum the amounts and count the records by country, period, beneficiary or scheme"
+    ),
+    limit: int = typer.Option(100, help="Maximum number of rows shown, 0 for all"),
+):
+    """Look up the records stored by the export commands into the results database (--results-db option),
+    or their totals, writing them as CSV.
+
+    Lookups by beneficiary, scheme, country and period are indexed, so that they do not
+    read all the records. Records of overlapping periods (ie: 2019 and 2019_03) are counted twice.
+    """
+    import csv
+    import io
+
+    from eu_state_aids.results import TOTALS, ResultsStore
+
+    # script parameters validations
+    if not os.path.exists(results_db):
+        typer.echo(f"Results database {results_db} not found, export with the --results-db option first")
+        raise typer.Exit(1)
+    if totals_by is not None and totals_by not in TOTALS:
+        typer.echo(f"Invalid totals: {totals_by}. Use one of: {', '.join(TOTALS)}.")
+        raise typer.Exit(1)
+
+    # empty filters are ignored, as unset ones
+    filters = [value or None for value in (beneficiary, name, scheme, country, period)]
+
+    store = ResultsStore(results_db)
+    try:
+        columns, rows = store.query(*filters, totals_by, limit)
+    finally:
+        store.close()
 
-app = typer.Typer()
-app.add_typer(bg.app, name="bg")
-app.add_typer(it.app, name="it")
+    buf = io.StringIO()
+    writer = csv.writer(buf, lineterminator="\n")
+    writer.writerow(columns)
+    writer.writerows(rows)
+    typer.echo(buf.getvalue(), nl=False)
@@ -0,0 +1,91 @@
+import json
+import os
+from pathlib import Path
+from typing import Dict, Optional, Union
+
+from eu_state_aids import __version__
+from eu_state_aids.cache import file_checksum
+
+
+class Manifest:
+    """Manifest of the periods exported into a local path.
+
+    Entries are keyed by the exported period (ie: `export:2019`), and hold the
+    checksums of the inputs the period was exported from (source files, reference data,
+    options, version of the package), and the checksum of the CSV file it produced.
+    A period whose inputs and output did not change since it was exported can be skipped.
+    The entries are kept in a `manifest.json` file, in the local path.
+
+    The checksums of files are reused as long as their size and modification time
+    do not change, so that unchanged source files are not read again.
+    """
+
+    def __init__(self, path: Union[str, Path]):
+        self.path = Path(path)
+        self.filepath = self.path / "manifest.json"
+        if os.path.exists(self.filepath):
+            with open(self.filepath) as f:
+                content = json.load(f)
+        else:
+            content = {}
+        self.periods = content.get("periods", {})
+        self.files = content.get("files", {})
+        self._changed = {"periods": set(), "files": set()}
+
+    def checksum(self, filepath: Union[str, Path]) -> Optional[str]:
+        """Return the sha256 checksum of a file, None if it does not exist."""
+        if not os.path.exists(filepath):
+            return None
+        stat = os.stat(filepath)
+        key = Path(os.path.relpath(filepath, self.path)).as_posix()
+        entry = self.files.get(key)
+        if entry is None or entry["size"] != stat.st_size or entry["mtime_ns"] != stat.st_mtime_ns:
+            entry = {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns, "checksum": file_checksum(filepath)}
+            self.files[key] = entry
+            self._changed["files"].add(key)
+        return entry["checksum"]
+
+    def inputs(self, files: Dict[str, Union[str, Path]], **values: Optional[str]) -> Dict[str, Optional[str]]:
+        """Build the inputs of a period.
+
+        :param files: the input files, by name, their checksums are used
+        :param values: other inputs, by name (ie: options, checksums of cached data)
+        :return: the inputs, including the version of the package, None for missing files
+        """
+        inputs = {name: self.checksum(filepath) for name, filepath in files.items()}
+        inputs.update(values, version=__version__)
+        return inputs
+
+    def is_unchanged(self, key: str, inputs: Dict[str, Optional[str]], output: Union[str, Path]) -> bool:
+        """Tell if the period was exported out of the same inputs, all of them known,
+        and its output file was not changed since.
+
+        :param key: the key of the period
+        :param inputs: the current inputs of the period, as built by `inputs`
+        :param output: the output file of the period
+        """
+        entry = self.periods.get(key)
+        return entry is not None and None not in inputs.values() and \
+            entry["inputs"] == inputs and entry["output"] == self.checksum(output)
+
+    def record(self, key: str, inputs: Dict[str, Optional[str]], output: Union[str, Path]):
+        """Record the inputs and the output file of an exported period."""
+        self.periods[key] = {"inputs": inputs, "output": self.checksum(output)}
+        self._changed["periods"].add(key)
+
+    def save(self):
+        """Write the manifest to disk, atomically.
+
+        Only the entries changed by this instance are written over the current content of the file,
+        so that entries recorded meanwhile by other processes (ie: exporting other years) are kept.
+        """
+        current = Manifest(self.path)
+        for name in ("periods", "files"):
+            for key in self._changed[name]:
+                getattr(current, name)[key] = getattr(self, name)[key]
+
+        os.makedirs(self.path, exist_ok=True)
+        tmp_filepath = self.filepath.with_name(f"{self.filepath.name}.{os.getpid()}.tmp")
+        with open(tmp_filepath, "w") as f:
+            json.dump({"periods": current.periods, "files": current.files}, f, indent=2, sort_keys=True)
+        os.replace(tmp_filepath, self.filepath)
@@ -0,0 +1,191 @@
+import contextlib
+import cProfile
+import json
+import os
+import sys
+import threading
+import time
+from datetime import datetime
+from pathlib import Path
+from typing import Callable, Iterator, List, Optional, Tuple, Union
+
+# the active collector, None when metrics are not collected
+_collector = None
+_local = threading.local()
+
+
+def peak_rss_mb() -> Optional[float]:
+    """Peak resident set size of the current process since it started (its high-water mark), in MB,
+    None where it is not available (ie: on Windows, with no resource module)."""
+    try:
+        import resource
+    except ImportError:
+        return None
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # bytes on macOS, kilobytes elsewhere
+    return round(maxrss / (1024 * 1024 if sys.platform == "darwin" else 1024), 1)
+
+
+def _growth(start: Optional[float], end: Optional[float]) -> Optional[float]:
+    """How much the peak RSS of the process grew from start to end, in MB, None if not available."""
+    return None if start is None or end is None else round(end - start, 1)
+
+
+class Metrics:
+    """Collector of the metrics of the stages of a run.
+
+    Each stage is recorded as a dict with its name, its labels (ie: year and month),
+    wall and CPU time in seconds, the peak RSS of the process at the end of the stage (process_peak_rss_mb),
+    how much the stage raised it (peak_rss_growth_mb), and the counters set by the stage itself
+    (bytes_read, rows_in, rows_out).
+    The peak RSS is the high-water mark of the whole process, so that process_peak_rss_mb includes the memory
+    of the stages run before, and peak_rss_growth_mb is 0 for stages using less memory than those;
+    stages run concurrently, in threads, raise it together.
+
+    When profile_path is set, hot stages are profiled with cProfile,
+    and their stats dumped into profile_path.
+    """
+
+    def __init__(self, profile_path: Optional[Union[str, Path]] = None, on_stage: Optional[Callable] = None):
+        """
+        :param profile_path: directory where the stats of profiled stages are dumped, None to disable profiling
+        :param on_stage: hook called with each stage's record, as soon as the stage ends
+        """
+        self.profile_path = Path(profile_path) if profile_path else None
+        self.on_stage = on_stage
+        self.stages = []
+        self.started = datetime.now()
+        self.start_wall, self.start_cpu = time.perf_counter(), time.process_time()
+        self.lock = threading.Lock()
+
+    def add(self, records: List[dict]):
+        with self.lock:
+            self.stages.extend(records)
+        if self.on_stage:
+            for record in records:
+                self.on_stage(record)
+
+    def report(self, **info) -> dict:
+        """The report of the run, with the records of all stages.
+
+        :param info: further information on the run (ie: the command)
+        """
+        return {
+            **info,
+            "started": self.started.isoformat(timespec="seconds"),
+            "wall_seconds": round(time.perf_counter() - self.start_wall, 4),
+            "cpu_seconds": round(time.process_time() - self.start_cpu, 4),
+            "peak_rss_mb": peak_rss_mb(),
+            "stages": self.stages,
+        }
+
+    def write(self, filepath: Union[str, Path], **info):
+        """Write the report of the run as a JSON file."""
+        with open(filepath, "w") as f:
+            json.dump(self.report(**info), f, indent=2, default=str)
+
+
+@contextlib.contextmanager
+def collect(profile_path: Optional[Union[str, Path]] = None, on_stage: Optional[Callable] = None) -> Iterator[Metrics]:
+    """Collect the metrics of the stages run within the context.
+
+    This is the API hook of the `--metrics-file` and `--profile` options::
+
+        with metrics.collect() as m:
+            it.export(...)
+        m.report()
+
+    :param profile_path: directory where the stats of profiled stages are dumped, None to disable profiling
+    :param on_stage: hook called with each stage's record, as soon as the stage ends
+    """
+    global _collector
+    previous = _collector
+    _collector = Metrics(profile_path, on_stage)
+    try:
+        yield _collector
+    finally:
+        _collector = previous
+
+
+@contextlib.contextmanager
+def stage(name: str, hot: bool = False, **labels) -> Iterator[dict]:
+    """Record the metrics of a stage, if metrics are being collected.
+
+    Yield a dict of counters, that the stage can set (bytes_read, rows_in, rows_out).
+    Labels are inherited by nested stages.
+
+    :param name: the name of the stage
+    :param hot: whether the stage is profiled, when profiling
+    :param labels: the labels of the stage (ie: year and month)
+    """
+    collector = _collector
+    counters = {}
+    if collector is None:
+        yield counters
+        return
+
+    parent_labels = getattr(_local, "labels", {})
+    labels = {**parent_labels, **labels}
+    _local.labels = labels
+    profiler = cProfile.Profile() if hot and collector.profile_path else None
+    start_wall, start_cpu, start_rss = time.perf_counter(), time.process_time(), peak_rss_mb()
+    if profiler:
+        profiler.enable()
+    try:
+        yield counters
+    except Exception as e:
+        counters["error"] = f"{type(e).__name__}: {e}"
+        raise
+    finally:
+        if profiler:
+            profiler.disable()
+            if not os.path.exists(collector.profile_path):
+                os.makedirs(collector.profile_path, exist_ok=True)
+            profiler.dump_stats(
+                collector.profile_path / "_".join([name] + [f"{v}" for v in labels.values()] + [f"{os.getpid()}.prof"])
+            )
+        _local.labels = parent_labels
+        end_rss = peak_rss_mb()
+        collector.add([{
+            "stage": name,
+            **labels,
+            "wall_seconds": round(time.perf_counter() - start_wall, 4),
+            "cpu_seconds": round(time.process_time() - start_cpu, 4),
+            "process_peak_rss_mb": end_rss,
+            "peak_rss_growth_mb": _growth(start_rss, end_rss),
+            **counters,
+        }])
+
+
+def worker_settings() -> Optional[dict]:
+    """Settings of the active collector, to be passed to worker processes, None when metrics are not collected."""
+    return None if _collector is None else {"profile_path": _collector.profile_path}
+
+
+def collected(settings: Optional[dict], func: Callable, *args) -> Tuple[object, List[dict], Optional[Exception]]:
+    """Call func in a worker process, collecting the metrics of its stages with the given settings.
+
+    :param settings: the settings of the parent's collector, as returned by worker_settings
+    :param func: the function
+    :return: func's result, the records of its stages, and the exception raised, if any
+    """
+    with (collect(**settings) if settings is not None else contextlib.nullcontext()) as collector:
+        try:
+            result, error = func(*args), None
+        except Exception as e:
+            result, error = None, e
+    return result, collector.stages if collector else [], error
+
+
+def merge(outcome: Tuple[object, List[dict], Optional[Exception]]):
+    """Add the records of a worker's outcome to the active collector, re-raising its exception, if any.
+
+    :param outcome: the outcome of `collected`
+    :return: the result of the worker's function
+    """
+    result, records, error = outcome
+    if _collector is not None and records:
+        _collector.add(records)
+    if error is not None:
+        raise error
+    return result
@@ -0,0 +1,102 @@
+import json
+import os
+from pathlib import Path
+from typing import Optional, Union
+
+import pandas as pd
+
+METADATA_KEY = b"eu_state_aids"
+
+
+def _pyarrow():
+    """Import pyarrow, an optional dependency, only needed when storing Parquet files."""
+    try:
+        import pyarrow
+        import pyarrow.parquet
+    except ImportError:
+        raise ImportError(
+            "pyarrow is needed to store Parquet files, install it with: pip install eu-state-aids[parquet]"
+        )
+    return pyarrow, pyarrow.parquet
+
+
+def read_table(filepath: Union[str, Path], version: str, checksum: Optional[str] = None) -> Optional[pd.DataFrame]:
+    """Read a dataframe from a Parquet file written by write_table.
+
+    :param filepath: the file path
+    :param version: the version of the logic that produced the dataframe
+    :param checksum: the checksum of the source file, if available
+    :return: the dataframe, None if the file is missing, or stale: of another version, or another source file
+    """
+    if not os.path.exists(filepath):
+        return None
+
+    _, pq = _pyarrow()
+    metadata = json.loads((pq.read_schema(filepath).metadata or {}).get(METADATA_KEY, b"{}"))
+    if metadata.get("version") != version:
+        return None
+    if checksum is not None and metadata.get("checksum") != checksum:
+        return None
+    return pq.read_table(filepath).to_pandas()
+
+
+def write_table(filepath: Union[str, Path], df: pd.DataFrame, version: str, checksum: Optional[str] = None):
+    """Write a dataframe as a Parquet file, atomically, recording in its metadata
+    the version of the logic that produced it and the checksum of its source file.
+
+    :param filepath: the file path
+    :param df: the dataframe
+    :param version: the version of the logic that produced the dataframe
+    :param checksum: the checksum of the source file
+    """
+    pa, pq = _pyarrow()
+    filepath = Path(filepath)
+    if not os.path.exists(filepath.parent):
+        os.makedirs(filepath.parent)
+
+    table = pa.Table.from_pandas(df, preserve_index=False)
+    metadata = dict(table.schema.metadata or {})
+    metadata[METADATA_KEY] = json.dumps({"version": version, "checksum": checksum}).encode()
+    table = table.replace_schema_metadata(metadata)
+
+    tmp_filepath = filepath.with_name(filepath.name + ".tmp")
+    pq.write_table(table, tmp_filepath)
+    os.replace(tmp_filepath, filepath)
+
+
+class PartitionedStore:
+    """Store of monthly dataframes, as Parquet files partitioned by year and month
+    (`year=YYYY/month=MM/part-0.parquet`).
+
+    Each file records, in its metadata, the `version` of the logic that produced it
+    and the checksum of the source file it was produced from.
+    Partitions with a different version, or a different checksum,
+    are considered stale and are not returned.
+    """
+
+    def __init__(self, path: Union[str, Path], version: str):
+        self.path = Path(path)
+        self.version = version
+
+    def partition_path(self, year: Union[int, str], month: int) -> Path:
+        return self.path / f"year={year}" / f"month={month:02}" / "part-0.parquet"
+
+    def get(self, year: Union[int, str], month: int, checksum: Optional[str] = None) -> Optional[pd.DataFrame]:
+        """Read the partition of the month.
+
+        :param year: the year
+        :param month: the month number
+        :param checksum: the checksum of the source file, if available
+        :return: the dataframe, None if the partition is missing or stale
+        """
+        return read_table(self.partition_path(year, month), self.version, checksum)
+
+    def put(self, year: Union[int, str], month: int, df: pd.DataFrame, checksum: Optional[str] = None):
+        """Write the partition of the month, atomically.
+
+        :param year: the year
+        :param month: the month number
+        :param df: the dataframe
+        :param checksum: the checksum of the source file
+        """
+        write_table(self.partition_path(year, month), df, self.version, checksum)
@@ -0,0 +1,129 @@
+import os
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from pathlib import Path
+from typing import Callable, Dict, Iterable, List, Set, Union
+
+import typer
+
+from eu_state_aids import metrics
+
+DONE = "done"
+
+
+class Task:
+    """A step of a country's pipeline: a function, called with its arguments,
+    that reads the `inputs` files and writes the `outputs` files.
+
+    A task depends on the tasks writing its inputs: it is run after them,
+    and only if they are done and all its inputs exist.
+    """
+
+    def __init__(
+        self, name: str, func: Callable, args: tuple = (),
+        inputs: Iterable[Union[str, Path]] = (), outputs: Iterable[Union[str, Path]] = ()
+    ):
+        """
+        :param name: the unique name of the task (ie: `it:export:2019`)
+        :param func: the function, its result is discarded; keyword arguments can be bound with functools.partial
+        :param args: the arguments of the function
+        :param inputs: the files read by the task
+        :param outputs: the files written by the task
+        """
+        self.name = name
+        self.func = func
+        self.args = tuple(args)
+        self.inputs = [Path(p) for p in inputs]
+        self.outputs = [Path(p) for p in outputs]
+
+    def __repr__(self):
+        return f"Task({self.name!r})"
+
+
+def dependencies(tasks: List[Task]) -> Dict[str, Set[str]]:
+    """Compute the dependencies of the tasks, as the names of the tasks writing their inputs.
+
+    :param tasks: the tasks
+    :return: the names of the tasks each task depends on, by task name
+    :raise ValueError: when two tasks have the same name or write the same file, or tasks depend on each other
+    """
+    names, writers = set(), {}
+    for task in tasks:
+        if task.name in names:
+            raise ValueError(f"Duplicate task {task.name}")
+        names.add(task.name)
+        for output in task.outputs:
+            if output in writers:
+                raise ValueError(f"{output} is written by both {writers[output]} and {task.name}")
+            writers[output] = task.name
+    deps = {task.name: {writers[i] for i in task.inputs if i in writers} - {task.name} for task in tasks}
+
+    # tasks are sorted topologically, so that cycles are found before running anything
+    remaining = {name: set(d) for name, d in deps.items()}
+    while remaining:
+        ready = [name for name, d in remaining.items() if not d]
+        if not ready:
+            raise ValueError(f"Tasks depend on each other: {', '.join(sorted(remaining))}")
+        for name in ready:
+            del remaining[name]
+        for d in remaining.values():
+            d.difference_update(ready)
+    return deps
+
+
+def _call(func: Callable, *args):
+    """Call func, discarding its result, so that it is not sent back by worker processes."""
+    func(*args)
+
+
+def run_tasks(tasks: List[Task], workers: int = 1) -> Dict[str, str]:
+    """Run the tasks after the tasks they depend on, in a pool of `workers` processes.
+
+    Independent tasks are run in parallel, in the order they are given.
+    Tasks whose dependencies are not done, or whose inputs do not exist, are skipped,
+    and so are, in turn, the tasks depending on them.
+
+    :param tasks: the tasks
+    :param workers: the number of processes, tasks are run in the current process when 1
+    :return: the outcome of each task, by name: `done`, `failed: {error}` or `skipped: {reason}`
+    """
+    deps = dependencies(tasks)
+    pending = list(tasks)
+    running = {}
+    outcomes = {}
+    executor = ProcessPoolExecutor(max_workers=workers) if workers > 1 else None
+    try:
+        while pending or running:
+            for task in [t for t in pending if deps[t.name] <= outcomes.keys()]:
+                pending.remove(task)
+                not_done = sorted(d for d in deps[task.name] if outcomes[d] != DONE)
+                missing = [str(i) for i in task.inputs if not os.path.exists(i)]
+                if not_done:
+                    outcomes[task.name] = f"skipped: {', '.join(not_done)} not done"
+                elif missing:
+                    outcomes[task.name] = f"skipped: missing {', '.join(missing)}"
+                elif executor is None:
+                    outcomes[task.name] = _outcome(_call, task.func, *task.args)
+                else:
+                    future = executor.submit(metrics.collected, metrics.worker_settings(), _call, task.func, *task.args)
+                    running[future] = task.name
+
+            if running:
+                finished, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in finished:
+                    outcomes[running.pop(future)] = _outcome(metrics.merge, future.result())
+    finally:
+        if executor is not None:
+            executor.shutdown()
+    return {task.name: outcomes[task.name] for task in tasks}
+
+
+def _outcome(func: Callable, *args) -> str:
+    """Call func, returning the outcome of a task."""
+    try:
+        func(*args)
+        return DONE
+    except typer.Exit as e:
+        # commands report their errors before exiting
+        return f"failed: exit code {e.exit_code}"
+    except Exception as e:
+        return f"failed: {type(e).__name__}: {e}"
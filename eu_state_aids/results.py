@@ -0,0 +1,133 @@
+import math
+import os
+import sqlite3
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple, Union
+
+# columns of the stored records, common to all countries
+COLUMNS = ['country', 'period', 'beneficiary_id', 'beneficiary_name', 'scheme', 'program', 'amount']
+
+# groups of the totals, with the columns they are grouped by, and the further columns they show
+TOTALS = {
+    'country': (['country'], []),
+    'period': (['country', 'period'], []),
+    'beneficiary': (['country', 'beneficiary_id'], ['MAX(beneficiary_name) AS beneficiary_name']),
+    'scheme': (['scheme'], []),
+}
+
+
+def _value(value):
+    """Convert a dataframe value into a database value: missing values into None,
+    and integral floats (ie: IDs read along with missing values) into integer strings."""
+    if value is None or (isinstance(value, float) and math.isnan(value)):
+        return None
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return value
+
+
+class ResultsStore:
+    """Local SQLite database of the exported records of all countries and periods,
+    so that they can be looked up and aggregated without reading the CSV files.
+
+    Records are stored in a single `aids` table, with the COLUMNS common to all countries,
+    indexed by country and period, by beneficiary ID (fiscal code), and by state aid scheme (cod_ce).
+    The records of a period are replaced as a whole, each time the period is exported,
+    and the stored periods are listed in the `periods` table.
+    """
+
+    def __init__(self, filepath: Union[str, Path]):
+        os.makedirs(Path(filepath).parent, exist_ok=True)
+        self.connection = sqlite3.connect(filepath, timeout=30)
+        with self.connection:
+            self.connection.executescript("""
+                CREATE TABLE IF NOT EXISTS aids (
+                    country TEXT NOT NULL,
+                    period TEXT NOT NULL,
+                    beneficiary_id TEXT,
+                    beneficiary_name TEXT,
+                    scheme TEXT,
+                    program TEXT,
+                    amount REAL
+                );
+                CREATE INDEX IF NOT EXISTS aids_period ON aids (country, period);
+                CREATE INDEX IF NOT EXISTS aids_beneficiary ON aids (beneficiary_id);
+                CREATE INDEX IF NOT EXISTS aids_scheme ON aids (scheme);
+                CREATE TABLE IF NOT EXISTS periods (
+                    country TEXT NOT NULL,
+                    period TEXT NOT NULL,
+                    records INTEGER NOT NULL,
+                    PRIMARY KEY (country, period)
+                );
+            """)
+
+    def upsert(self, country: str, period: str, df, columns: Dict[str, str]):
+        """Replace the records of the period with the records of df, in a single transaction.
+
+        :param country: the country code
+        :param period: the period (ie: `2019`, `2019_03`)
+        :param df: the exported dataframe
+        :param columns: the names of COLUMNS in df, by column of df
+        """
+        df = df.rename(columns=columns)[[c for c in COLUMNS if c in columns.values()]]
+        sql = f"INSERT INTO aids (country, period, {', '.join(df.columns)}) " \
+            f"VALUES (?, ?, {', '.join('?' * len(df.columns))})"
+        with self.connection:
+            self.connection.execute("DELETE FROM aids WHERE country = ? AND period = ?", (country, period))
+            self.connection.executemany(sql, (
+                (country, period, *map(_value, row)) for row in df.astype(object).itertuples(index=False, name=None)
+            ))
+            self.connection.execute(
+                "INSERT OR REPLACE INTO periods (country, period, records) VALUES (?, ?, ?)", (country, period, len(df))
+            )
+
+    def has_period(self, country: str, period: str) -> bool:
+        """Tell if the period was stored, even with no records."""
+        return self.connection.execute(
+            "SELECT 1 FROM periods WHERE country = ? AND period = ?", (country, period)
+        ).fetchone() is not None
+
+    def query(
+        self, beneficiary: Optional[str] = None, name: Optional[str] = None, scheme: Optional[str] = None,
+        country: Optional[str] = None, period: Optional[str] = None, totals_by: Optional[str] = None,
+        limit: int = 0
+    ) -> Tuple[List[str], List[tuple]]:
+        """Look up the stored records, or their totals.
+
+        :param beneficiary: the ID (fiscal code) of the beneficiary
+        :param name: part of the name of the beneficiaries, case insensitive
+        :param scheme: the state aid scheme (cod_ce)
+        :param country: the country code
+        :param period: the period
+        :param totals_by: sum the amounts and count the records by one of the TOTALS groups, sorted by amount
+        :param limit: maximum number of rows, 0 for all
+        :return: the names of the columns, and the rows
+        :raise ValueError: when totals_by is not one of the TOTALS groups
+        """
+        filters = {
+            "beneficiary_id = ?": beneficiary, "beneficiary_name LIKE ?": f"%{name}%" if name else None,
+            "scheme = ?": scheme, "country = ?": country, "period = ?": period,
+        }
+        where = [condition for condition, value in filters.items() if value is not None]
+        params = [value for value in filters.values() if value is not None]
+
+        if totals_by is None:
+            sql = f"SELECT {', '.join(COLUMNS)} FROM aids"
+            group_by, order_by = "", "country, period, rowid"
+        elif totals_by in TOTALS:
+            keys, extra = TOTALS[totals_by]
+            sql = f"SELECT {', '.join(keys + extra)}, SUM(amount) AS amount, COUNT(*) AS records FROM aids"
+            group_by, order_by = f" GROUP BY {', '.join(keys)}", "amount DESC"
+        else:
+            raise ValueError(f"Invalid totals: {totals_by}. Use one of: {', '.join(TOTALS)}.")
+
+        if where:
+            sql += f" WHERE {' AND '.join(where)}"
+        sql += f"{group_by} ORDER BY {order_by}"
+        if limit:
+            sql += f" LIMIT {int(limit)}"
+        cursor = self.connection.execute(sql, params)
+        return [d[0] for d in cursor.description], cursor.fetchall()
+
+    def close(self):
+        self.connection.close()
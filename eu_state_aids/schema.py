@@ -0,0 +1,71 @@
+from typing import Dict, List, Optional
+
+import pandas as pd
+
+# compact dtypes of the intermediate dataframes:
+# repeated strings are categorical, with sorted categories, and amounts are floats
+
+AIUTI_DTYPES = {
+    'cod_ce': 'category',
+    'denom_benef': 'category',
+    'cf_benef': 'category',
+    'componenti_importo_aiuto': 'float64',
+}
+
+MISURE_DTYPES = {
+    'cod_ce': 'category',
+    'fondo_desc': 'category',
+}
+
+BG_DTYPES = {
+    'Name of the beneficiary': 'category',
+    'European operation program (ID)': 'category',
+    'Amounts (€)': 'float64',
+    'Date': 'category',
+    'State aid Scheme': 'category',
+}
+
+
+def is_categorical(s: pd.Series) -> bool:
+    return isinstance(s.dtype, pd.CategoricalDtype)
+
+
+def compact(df: pd.DataFrame, dtypes: Dict[str, str]) -> pd.DataFrame:
+    """Convert the columns of df into the given dtypes, in place.
+
+    Columns missing from df are ignored, and the unused categories of
+    already categorical columns are removed.
+
+    :param df: the dataframe
+    :param dtypes: the dtypes, by column
+    :return: the dataframe
+    """
+    for column, dtype in dtypes.items():
+        if column not in df.columns:
+            continue
+        if dtype == 'category' and is_categorical(df[column]):
+            df[column] = df[column].cat.remove_unused_categories()
+        else:
+            df[column] = df[column].astype(dtype)
+    return df
+
+
+def unify_categories(dfs: List[pd.DataFrame], columns: Optional[List[str]] = None) -> List[pd.DataFrame]:
+    """Convert the columns of all dataframes into categoricals with the same, sorted, categories,
+    so that they can be concatenated, merged and grouped by their codes.
+
+    :param dfs: the dataframes
+    :param columns: the columns, defaults to the ones categorical in any of the dataframes
+    :return: the converted dataframes
+    """
+    if columns is None:
+        columns = [c for c in dfs[0].columns if any(c in df.columns and is_categorical(df[c]) for df in dfs)]
+
+    dtypes = {}
+    for column in columns:
+        values = [
+            df[column].cat.categories if is_categorical(df[column]) else pd.Index(df[column].dropna().unique())
+            for df in dfs
+        ]
+        dtypes[column] = pd.CategoricalDtype(values[0].append(values[1:]).unique().sort_values())
+    return [df.astype(dtypes) for df in dfs]
@@ -0,0 +1,82 @@
+import re
+from typing import Optional
+
+import numpy as np
+import pandas as pd
+
+# an integer literal, as accepted by int(), with digits of any script
+INT_LITERAL = r'[+-]?\d+(?:_\d+)*'
+
+# a CE code of a state aid measure, as `SA.` or `SA ` followed by digits
+COD_CE = r'^SA[. ](\d+)'
+
+
+def _partition(s: pd.Series, sep: str, last: bool = False) -> pd.DataFrame:
+    """Split values at the first (or last) occurrence of sep, into (head, sep, tail) columns."""
+    parts = s.str.rpartition(sep) if last else s.str.partition(sep)
+    return parts.reindex(columns=[0, 1, 2]).astype(object)
+
+
+def lookup_name(s: pd.Series) -> pd.Series:
+    """Extract the name out of `ID Name` values, as everything after the first space.
+
+    Values with no spaces are returned as they are, converted into strings.
+    """
+    s = s.astype(str)
+    parts = _partition(s, ' ')
+    return parts[2].where(parts[1] == ' ', s).rename(s.name)
+
+
+def lookup_id(s: pd.Series) -> pd.Series:
+    """Extract the integer ID out of `ID Name` values, as everything before the first space.
+
+    IDs are parsed as int() does, also when written with non ASCII digits (as `١٢`),
+    the result is NaN when the ID is not an integer.
+    """
+    ids = _partition(s.astype(str), ' ')[0].str.strip()
+    valid = ids.str.fullmatch(INT_LITERAL).fillna(False).astype(bool)
+    digits = ids[valid].str.replace('_', '', regex=False)
+    numbers = pd.to_numeric(digits, errors='coerce')
+    if numbers.isna().any():
+        # to_numeric only parses ASCII digits
+        numbers = pd.to_numeric(digits.map(int))
+    if valid.all():
+        return numbers.rename(s.name)
+
+    # integers are converted into floats, as missing values are there
+    result = pd.Series(np.NAN, index=s.index, name=s.name)
+    result[valid.values] = numbers.astype(float).values
+    return result
+
+
+def build_eu_prog_id(s: pd.Series, program_start_year: str) -> pd.Series:
+    """Build the european operation program ID out of project proposal numbers
+    (`XXX-N.NNN-NNNN`), prefixing the part before the first dash with the program's starting year.
+
+    The result is NaN when there are no dashes.
+    """
+    parts = _partition(s, '-')
+    return (program_start_year + parts[0]).where(parts[1] == '-').rename(s.name)
+
+
+def build_eu_prog_aid_id(s: pd.Series) -> pd.Series:
+    """Build the program aid ID out of project proposal numbers (`XXX-N.NNN-NNNN`),
+    removing the part after the last dash.
+
+    The result is NaN when there are less than two dashes.
+    """
+    return _partition(s, '-', last=True)[0].where(s.str.count('-') >= 2).rename(s.name)
+
+
+def normalize_cod_ce(s: pd.Series) -> pd.Series:
+    """Normalize the CE codes of the state aid measures into the `SA.XXXXX` format.
+
+    The result is NaN when the value does not start with `SA.` or `SA `, followed by digits.
+    """
+    return 'SA.' + s.str.extract(COD_CE, expand=False)
+
+
+def normalize_cod_ce_value(value: str) -> Optional[str]:
+    """Normalize a single CE code, as normalize_cod_ce does, None when the value is not valid."""
+    match = re.match(COD_CE, value)
+    return 'SA.' + match.group(1) if match else None
@@ -0,0 +1,167 @@
+import gzip
+import json
+import os
+from pathlib import Path
+from typing import Optional, Union
+
+import pandas as pd
+import typer
+
+from eu_state_aids.cache import file_checksum
+
+# output formats, with the suffix of their files
+FORMATS = {
+    "csv": ".csv",
+    "csv.gz": ".csv.gz",
+    "csv.zst": ".csv.zst",
+    "parquet": ".parquet",
+}
+
+# number of rows written at a time
+CHUNK_ROWS = 100_000
+
+
+def _zstandard():
+    """Import zstandard, an optional dependency, only needed when writing zstd compressed files."""
+    try:
+        import zstandard
+    except ImportError:
+        raise ImportError(
+            "zstandard is needed to write zstd compressed files, install it with: pip install eu-state-aids[zstd]"
+        )
+    return zstandard
+
+
+def check_format(output_format: str) -> str:
+    """Validate the output_format option of the commands, in API calls too.
+
+    :param output_format: the output format
+    :return: the output format
+    :raise typer.BadParameter: when output_format is not one of the FORMATS
+    """
+    if output_format not in FORMATS:
+        raise typer.BadParameter(
+            f"{output_format}. Use one of: {', '.join(FORMATS)}.", param_hint="'--output-format'"
+        )
+    return output_format
+
+
+def output_filepath(path: Union[str, Path], stem: str, output_format: str = "csv") -> Path:
+    """Return the path of the output file named stem, in the given format.
+
+    :param path: the directory of the output file
+    :param stem: the name of the output file, without suffix (ie: `2019`, `misure`)
+    :param output_format: one of the FORMATS
+    :return: the file path
+    :raise ValueError: when output_format is not one of the FORMATS
+    """
+    if output_format not in FORMATS:
+        raise ValueError(f"Invalid output format: {output_format}. Use one of: {', '.join(FORMATS)}.")
+    return Path(path) / f"{stem}{FORMATS[output_format]}"
+
+
+def find_output(path: Union[str, Path], stem: str) -> Optional[Path]:
+    """Find the output file named stem, in any format, the most recently written one if more than one.
+
+    :param path: the directory of the output file
+    :param stem: the name of the output file, without suffix
+    :return: the file path, None if there is no such file
+    """
+    filepaths = [output_filepath(path, stem, f) for f in FORMATS]
+    filepaths = [filepath for filepath in filepaths if os.path.exists(filepath)]
+    if not filepaths:
+        return None
+    return max(filepaths, key=lambda filepath: os.stat(filepath).st_mtime_ns)
+
+
+def sidecar_filepath(filepath: Union[str, Path]) -> Path:
+    """Return the path of the sidecar file of an output file, with its format, rows and checksum."""
+    filepath = Path(filepath)
+    return filepath.with_name(f"{filepath.name}.meta.json")
+
+
+def read_output(filepath: Union[str, Path], **kwargs) -> pd.DataFrame:
+    """Read a dataframe out of an output file, in any of the FORMATS.
+
+    :param filepath: the file path
+    :param kwargs: further arguments of pandas.read_csv, for CSV files
+    :return: the dataframe
+    """
+    if str(filepath).endswith(FORMATS["parquet"]):
+        return pd.read_parquet(filepath)
+    if str(filepath).endswith(FORMATS["csv.zst"]):
+        with _zstandard().open(filepath, "rt", encoding="utf-8", newline="") as f:
+            return pd.read_csv(f, **kwargs)
+    return pd.read_csv(filepath, **kwargs)
+
+
+def _write_csv(df: pd.DataFrame, f, chunk_rows: int):
+    """Write df as CSV into the text file f, a chunk of rows at a time."""
+    df.iloc[:0].to_csv(f, na_rep='', index=False)
+    for start in range(0, len(df), chunk_rows):
+        df.iloc[start:start + chunk_rows].to_csv(f, na_rep='', index=False, header=False)
+
+
+def _write_parquet(df: pd.DataFrame, filepath: Path, chunk_rows: int):
+    """Write df as a Parquet file, a row group of chunk_rows at a time."""
+    from eu_state_aids.partitions import _pyarrow
+
+    pa, pq = _pyarrow()
+    schema = pa.Schema.from_pandas(df, preserve_index=False)
+    with pq.ParquetWriter(filepath, schema) as writer:
+        for start in range(0, max(len(df), 1), chunk_rows):
+            chunk = df.iloc[start:start + chunk_rows]
+            writer.write_table(pa.Table.from_pandas(chunk, schema=schema, preserve_index=False))
+
+
+def write_output(
+    df: pd.DataFrame, filepath: Union[str, Path], output_format: str = "csv", chunk_rows: int = CHUNK_ROWS
+) -> dict:
+    """Write a dataframe into an output file, in chunks of rows, atomically,
+    along with a sidecar file holding its format, number of rows and checksum.
+
+    The dataframe is written into a temporary file in the same directory,
+    renamed over filepath only when complete, so that readers never see a truncated file.
+
+    :param df: the dataframe
+    :param filepath: the file path, as returned by output_filepath
+    :param output_format: one of the FORMATS
+    :param chunk_rows: number of rows written at a time
+    :return: the content of the sidecar file: format, rows, bytes and sha256 checksum of the file
+    """
+    filepath = Path(filepath)
+    if output_format not in FORMATS:
+        raise ValueError(f"Invalid output format: {output_format}. Use one of: {', '.join(FORMATS)}.")
+    if not os.path.exists(filepath.parent):
+        os.makedirs(filepath.parent)
+
+    tmp_filepath = filepath.with_name(f"{filepath.name}.{os.getpid()}.tmp")
+    try:
+        if output_format == "parquet":
+            _write_parquet(df, tmp_filepath, chunk_rows)
+        elif output_format == "csv.zst":
+            with _zstandard().open(tmp_filepath, "wt", encoding="utf-8", newline="") as f:
+                _write_csv(df, f, chunk_rows)
+        elif output_format == "csv.gz":
+            with gzip.open(tmp_filepath, "wt", encoding="utf-8", newline="") as f:
+                _write_csv(df, f, chunk_rows)
+        else:
+            with open(tmp_filepath, "w", encoding="utf-8", newline="") as f:
+                _write_csv(df, f, chunk_rows)
+
+        sidecar = {
+            "format": output_format,
+            "rows": len(df),
+            "bytes": os.path.getsize(tmp_filepath),
+            "sha256": file_checksum(tmp_filepath),
+        }
+        os.replace(tmp_filepath, filepath)
+    finally:
+        if os.path.exists(tmp_filepath):
+            os.remove(tmp_filepath)
+
+    tmp_sidecar = sidecar_filepath(tmp_filepath)
+    with open(tmp_sidecar, "w") as f:
+        json.dump(sidecar, f, indent=2)
+    os.replace(tmp_sidecar, sidecar_filepath(filepath))
+    return sidecar
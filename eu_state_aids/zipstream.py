@@ -0,0 +1,120 @@
+import struct
+import zlib
+from typing import BinaryIO
+from zipfile import BadZipFile
+
+LOCAL_HEADER = struct.Struct("<IHHHHHIIIHH")
+LOCAL_HEADER_SIGNATURE = 0x04034b50
+DATA_DESCRIPTOR_SIGNATURE = 0x08074b50
+ZIP64_EXTRA_ID = 0x0001
+CHUNK_SIZE = 64 * 1024
+
+
+class ZipMemberStream:
+    """Binary stream of the decompressed content of the first member of a zip archive,
+    read sequentially from a non-seekable stream (ie: an HTTP response).
+
+    The member is located through its local file header, at the start of the archive,
+    so that the central directory, at its end, is never needed.
+    Only stored and deflated members are supported; the CRC of the content
+    is checked once the member has been read.
+    """
+
+    def __init__(self, stream: BinaryIO, chunk_size: int = CHUNK_SIZE):
+        """
+        :param stream: the binary stream of the zip archive
+        :param chunk_size: size of the chunks read from the stream, in bytes
+        """
+        self.stream = stream
+        self.chunk_size = chunk_size
+        self.buffer = bytearray()
+        self.size = 0
+        self.crc = 0
+        self.eof = False
+
+        header = self._read_exactly(LOCAL_HEADER.size)
+        (
+            signature, _, self.flags, self.method, _, _, self.expected_crc,
+            compressed_size, _, name_length, extra_length
+        ) = LOCAL_HEADER.unpack(header)
+        if signature != LOCAL_HEADER_SIGNATURE:
+            raise BadZipFile("Not a zip archive, or the archive does not start with a file")
+        if self.flags & 0x1:
+            raise BadZipFile("Encrypted zip members are not supported")
+        self.filename = self._read_exactly(name_length).decode("utf-8" if self.flags & 0x800 else "cp437")
+        extra = self._read_exactly(extra_length)
+        if compressed_size == 0xFFFFFFFF:
+            compressed_size = self._zip64_compressed_size(extra)
+
+        if self.method == 8:
+            self.decompressor = zlib.decompressobj(-zlib.MAX_WBITS)
+        elif self.method == 0:
+            if self.flags & 0x8:
+                raise BadZipFile("Stored zip members with a data descriptor are not supported")
+            self.decompressor = None
+            self.remaining = compressed_size
+        else:
+            raise BadZipFile(f"Compression method {self.method} is not supported")
+
+    def _read_exactly(self, size: int) -> bytes:
+        data = b""
+        while len(data) < size:
+            chunk = self.stream.read(size - len(data))
+            if not chunk:
+                raise BadZipFile("Truncated zip archive")
+            data += chunk
+        return data
+
+    @staticmethod
+    def _zip64_compressed_size(extra: bytes) -> int:
+        """Read the compressed size out of the zip64 extra field of a local header,
+        where it follows the uncompressed size."""
+        pos = 0
+        while pos + 4 <= len(extra):
+            header_id, length = struct.unpack("<HH", extra[pos:pos + 4])
+            if header_id == ZIP64_EXTRA_ID:
+                return struct.unpack("<QQ", extra[pos + 4:pos + 20])[1]
+            pos += 4 + length
+        raise BadZipFile("Missing zip64 extra field")
+
+    def _fill(self):
+        """Decompress the next chunk of the member into the buffer."""
+        if self.decompressor is None:
+            chunk = self.stream.read(min(self.chunk_size, self.remaining)) if self.remaining else b""
+            if self.remaining and not chunk:
+                raise BadZipFile("Truncated zip archive")
+            self.remaining -= len(chunk)
+            data, finished, unused = chunk, self.remaining == 0, b""
+        else:
+            chunk = self.stream.read(self.chunk_size)
+            if not chunk:
+                raise BadZipFile("Truncated zip archive")
+            data = self.decompressor.decompress(chunk)
+            finished, unused = self.decompressor.eof, self.decompressor.unused_data
+
+        self.buffer += data
+        self.size += len(data)
+        self.crc = zlib.crc32(data, self.crc)
+        if finished:
+            self._finish(unused)
+
+    def _finish(self, unused: bytes):
+        """Check the CRC of the member, reading it from the data descriptor, when there is one."""
+        self.eof = True
+        expected_crc = self.expected_crc
+        if self.flags & 0x8:
+            descriptor = unused[:8] + self._read_exactly(max(0, 8 - len(unused)))
+            signature, crc = struct.unpack("<II", descriptor)
+            # the signature of the data descriptor is optional
+            expected_crc = crc if signature == DATA_DESCRIPTOR_SIGNATURE else signature
+        if self.crc != expected_crc:
+            raise BadZipFile(f"Bad CRC-32 for file {self.filename}")
+
+    def read(self, size: int = -1) -> bytes:
+        while not self.eof and (size < 0 or len(self.buffer) < size):
+            self._fill()
+        if size < 0:
+            size = len(self.buffer)
+        data = bytes(self.buffer[:size])
+        del self.buffer[:size]
+        return data
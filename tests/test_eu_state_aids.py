@@ -1,12 +1,33 @@
+import inspect
+import json
+import mmap
 import os
+import re
 import shutil
+import subprocess
+import sys
+import threading
+import zipfile
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from io import BytesIO
 from pathlib import Path
 
+import numpy as np
+import pandas as pd
+import pandas_read_xml as pdx
+import pytest
+import requests
 import requests_mock
+import typer
+from hypothesis import assume, given
+from hypothesis import strategies as st
+from pandas_read_xml import fully_flatten
 
 from validators.utils import ValidationFailure
 
-from eu_state_aids import __version__
+from eu_state_aids import (__version__, aggregate, bg, delta, download, it, metrics, pipeline, results,
+                           schema, transforms, writers, zipstream)
+from eu_state_aids.cache import file_checksum
 from eu_state_aids.utils import validate_year, validate_year_month
 
 from typer.testing import CliRunner
@@ -127,3 +148,1516 @@ def test_bg_export():
         assert(os.path.exists(local_test_path / "2015.csv"))
         with open(local_test_path / "2015.csv", mode='r') as csv:
             assert(len(csv.readlines()) == 189)
+
+
+def test_bg_export_range(tmp_path):
+    with open(Path("./tests") / "bg_projects_sample.xlsx", mode='rb') as sample_xls:
+        sample_content = sample_xls.read()
+    with open(Path("./tests") / "bg_state_aids.xlsx", mode='rb') as state_aids_xls:
+        state_aids_content = state_aids_xls.read()
+
+    for year in ["2015", "2016"]:
+        with open(tmp_path / f"projects_{year}.xlsx", mode='wb') as f:
+            f.write(sample_content)
+
+    with requests_mock.Mocker() as mock:
+        mock.get(state_aids_url, content=state_aids_content)
+        result = runner.invoke(
+            app, ["bg", "export-range", "2015", "2017", f"--local-path={tmp_path}", "--workers=2", "--combined"],
+            prog_name='eu-state-aids'
+        )
+        # the stateaid file is fetched once, for all years
+        assert mock.call_count == 1
+
+    assert result.exit_code == 0
+    assert "2015: 470 rows, 188 matches" in result.stdout
+    assert "2016: 470 rows, 188 matches" in result.stdout
+    assert "2017: error" in result.stdout
+    assert "total: 940 rows, 376 matches" in result.stdout
+
+    df_2015 = pd.read_csv(tmp_path / "2015.csv")
+    assert len(df_2015) == 188
+    combined_df = pd.read_csv(tmp_path / "2015_2017.csv")
+    assert list(combined_df.Date.unique()) == [2015, 2016]
+    pd.testing.assert_frame_equal(combined_df[:188], df_2015)
+
+
+def test_bg_convert(tmp_path):
+    pytest.importorskip("pyarrow")
+    with open(Path("./tests") / "bg_projects_sample.xlsx", mode='rb') as sample_xls:
+        sample_content = sample_xls.read()
+    with open(Path("./tests") / "bg_state_aids.xlsx", mode='rb') as state_aids_xls:
+        state_aids_content = state_aids_xls.read()
+
+    with open(tmp_path / "projects_2015.xlsx", mode='wb') as f:
+        f.write(sample_content)
+    args = ["bg", "export", "2015", f"--local-path={tmp_path}"]
+
+    with requests_mock.Mocker() as mock:
+        mock.get(state_aids_url, content=state_aids_content)
+        result = runner.invoke(app, args, prog_name='eu-state-aids')
+        assert f"rows created from {tmp_path / 'projects_2015.xlsx'}" in result.stdout
+        with open(tmp_path / "2015.csv") as csv:
+            expected = csv.read()
+
+        result = runner.invoke(
+            app, ["bg", "convert", "2015", f"--local-path={tmp_path}"], prog_name='eu-state-aids'
+        )
+        assert result.exit_code == 0
+        assert f"DataFrame with 470 rows saved to {tmp_path / 'projects_2015.parquet'}" in result.stdout
+
+        # the converted copy is read instead of the excel file, with the same results
+        result = runner.invoke(app, args + ["--force"], prog_name='eu-state-aids')
+        assert f"DataFrame with 470 rows read from {tmp_path / 'projects_2015.parquet'}" in result.stdout
+        assert '188 matches found.' in result.stdout
+        with open(tmp_path / "2015.csv") as csv:
+            assert csv.read() == expected
+
+        # the copy is stale when the excel file changes
+        with open(tmp_path / "projects_2015.xlsx", mode='ab') as f:
+            f.write(b"\0")
+        assert bg.read_converted_projects("2015", tmp_path) is None
+        assert f"rows created from {tmp_path / 'projects_2015.xlsx'}" in runner.invoke(
+            app, args, prog_name='eu-state-aids'
+        ).stdout
+
+
+def test_bg_state_aid_index():
+    stateaid_df = pd.DataFrame({
+        'scheme': ['SA.1, SA.11', 'SA.2', None, 'SA.3'],
+        'description': ['BG16RFOP002-2.001 and BG16RFOP002-1.005', 'BG16RFOP002-2.001', 'BG05M2OP001-4.001', 3],
+    })
+    codes = pd.Series(['BG16RFOP002-2.001', 'BG16RFOP002-1.005', 'BG16RFOP002-2X001', 'BG05M2OP001-4.001', None])
+    schemes = bg.StateAidIndex(stateaid_df).assign(codes)
+    assert schemes.tolist()[:2] == ['SA.1', 'SA.1']
+    assert schemes.isna().tolist()[2:] == [True, True, True]
+
+
+def test_bg_state_aid_index_matches_scan():
+    stateaid_df = pd.read_excel(Path("./tests") / "bg_state_aids.xlsx", header=1).iloc[:, :10]
+    eu_df = pd.read_excel(Path("./tests") / "bg_projects_sample.xlsx", header=3)[:-6]
+    codes = eu_df['Project proposal number'].dropna().str.rsplit('-', n=1).str[0]
+
+    def scan(x):
+        has_x = stateaid_df[stateaid_df.iloc[:, 1].str.contains(x, regex=False)]
+        return has_x.iloc[0, 0].split(',')[0] if not has_x.empty else None
+
+    expected = codes.apply(scan)
+    schemes = bg.StateAidIndex(stateaid_df).assign(codes)
+    assert schemes.notna().sum() > 0
+    assert schemes.where(schemes.notna(), None).tolist() == expected.tolist()
+
+
+aiuti_test_xml = """<?xml version="1.0" encoding="UTF-8"?>
+<LISTA_AIUTI>
+  <AIUTO>
+    <COD_CE_MISURA>SA.12345</COD_CE_MISURA>
+    <DENOMINAZIONE_BENEFICIARIO>ACME S.R.L. &#8211; &#232;</DENOMINAZIONE_BENEFICIARIO>
+    <CODICE_FISCALE_BENEFICIARIO>01234567890</CODICE_FISCALE_BENEFICIARIO>
+    <COMPONENTI_AIUTO>
+      <COMPONENTE_AIUTO>
+        <STRUMENTI_AIUTO>
+          <STRUMENTO_AIUTO><IMPORTO_NOMINALE>100.5</IMPORTO_NOMINALE></STRUMENTO_AIUTO>
+          <STRUMENTO_AIUTO><IMPORTO_NOMINALE>200</IMPORTO_NOMINALE></STRUMENTO_AIUTO>
+        </STRUMENTI_AIUTO>
+      </COMPONENTE_AIUTO>
+      <COMPONENTE_AIUTO>
+        <STRUMENTI_AIUTO>
+          <STRUMENTO_AIUTO><IMPORTO_NOMINALE>50</IMPORTO_NOMINALE></STRUMENTO_AIUTO>
+        </STRUMENTI_AIUTO>
+      </COMPONENTE_AIUTO>
+    </COMPONENTI_AIUTO>
+  </AIUTO>
+  <AIUTO>
+    <COD_CE_MISURA>SA 12345</COD_CE_MISURA>
+    <DENOMINAZIONE_BENEFICIARIO>ACME S.R.L. &#8211; &#232;</DENOMINAZIONE_BENEFICIARIO>
+    <CODICE_FISCALE_BENEFICIARIO>01234567890</CODICE_FISCALE_BENEFICIARIO>
+    <COMPONENTI_AIUTO>
+      <COMPONENTE_AIUTO>
+        <STRUMENTI_AIUTO>
+          <STRUMENTO_AIUTO><IMPORTO_NOMINALE>1000</IMPORTO_NOMINALE></STRUMENTO_AIUTO>
+        </STRUMENTI_AIUTO>
+      </COMPONENTE_AIUTO>
+    </COMPONENTI_AIUTO>
+  </AIUTO>
+  <AIUTO>
+    <DENOMINAZIONE_BENEFICIARIO>NO MISURA SPA</DENOMINAZIONE_BENEFICIARIO>
+    <CODICE_FISCALE_BENEFICIARIO>09876543210</CODICE_FISCALE_BENEFICIARIO>
+    <COMPONENTI_AIUTO>
+      <COMPONENTE_AIUTO>
+        <STRUMENTI_AIUTO>
+          <STRUMENTO_AIUTO><IMPORTO_NOMINALE>7</IMPORTO_NOMINALE></STRUMENTO_AIUTO>
+        </STRUMENTI_AIUTO>
+      </COMPONENTE_AIUTO>
+    </COMPONENTI_AIUTO>
+  </AIUTO>
+  <AIUTO>
+    <COD_CE_MISURA>SA.54321</COD_CE_MISURA>
+    <DENOMINAZIONE_BENEFICIARIO>ROSSI MARIO</DENOMINAZIONE_BENEFICIARIO>
+    <CODICE_FISCALE_BENEFICIARIO>RSSMRA80A01H501U</CODICE_FISCALE_BENEFICIARIO>
+    <COMPONENTI_AIUTO>
+      <COMPONENTE_AIUTO>
+        <STRUMENTI_AIUTO>
+          <STRUMENTO_AIUTO><IMPORTO_NOMINALE>10.25</IMPORTO_NOMINALE></STRUMENTO_AIUTO>
+        </STRUMENTI_AIUTO>
+      </COMPONENTE_AIUTO>
+    </COMPONENTI_AIUTO>
+  </AIUTO>
+  <AIUTO>
+    <COD_CE_MISURA>XX.00001</COD_CE_MISURA>
+    <DENOMINAZIONE_BENEFICIARIO>INVALID SRL</DENOMINAZIONE_BENEFICIARIO>
+    <CODICE_FISCALE_BENEFICIARIO>11111111111</CODICE_FISCALE_BENEFICIARIO>
+    <COMPONENTI_AIUTO>
+      <COMPONENTE_AIUTO>
+        <STRUMENTI_AIUTO>
+          <STRUMENTO_AIUTO><IMPORTO_NOMINALE>3</IMPORTO_NOMINALE></STRUMENTO_AIUTO>
+        </STRUMENTI_AIUTO>
+      </COMPONENTE_AIUTO>
+    </COMPONENTI_AIUTO>
+  </AIUTO>
+</LISTA_AIUTI>
+"""
+
+misure_test_csv = "cod_ce,fondo_desc\nSA.12345,FESR\nSA.54321,FSE\n"
+
+
+def write_aiuti_zip(filepath, content=aiuti_test_xml):
+    with zipfile.ZipFile(filepath, "w", compression=zipfile.ZIP_DEFLATED) as z:
+        z.writestr("OpenData_Aiuti.xml", content)
+
+
+class ChunkedStream:
+    """Binary stream returning at most `chunk_size` bytes per read."""
+    def __init__(self, content, chunk_size):
+        self.buf = BytesIO(content)
+        self.chunk_size = chunk_size
+
+    def read(self, size=-1):
+        return self.buf.read(self.chunk_size if size < 0 else min(size, self.chunk_size))
+
+
+def test_it_char_ref_stripper_chunks():
+    content = "a&#1;b&#232;c&amp;d&#12345;&#".encode() * 3 + b"9;e&"
+    expected = re.sub(rb"&#(\d+);", b"", content)
+    for chunk_size in (1, 2, 3, 5, 7, 64):
+        stripper = it.CharRefStripper(ChunkedStream(content, chunk_size))
+        out = b""
+        while True:
+            data = stripper.read(chunk_size)
+            if not data:
+                break
+            out += data
+        assert out == expected
+
+
+def test_it_read_aiuti_matches_fully_flatten():
+    adf = pdx.read_xml(re.sub(r"&#(\d+);", "", aiuti_test_xml), ["LISTA_AIUTI"]).pipe(fully_flatten)
+    adf = adf[adf.notnull()["AIUTO|COD_CE_MISURA"]]
+    expected = adf[[
+        "AIUTO|COD_CE_MISURA", "AIUTO|DENOMINAZIONE_BENEFICIARIO", "AIUTO|CODICE_FISCALE_BENEFICIARIO",
+        "AIUTO|COMPONENTI_AIUTO|COMPONENTE_AIUTO|STRUMENTI_AIUTO|STRUMENTO_AIUTO|IMPORTO_NOMINALE"
+    ]]
+    expected.columns = it.AIUTI_COLUMNS
+    expected = schema.compact(expected, schema.AIUTI_DTYPES)
+
+    sdf = it.read_aiuti(ChunkedStream(aiuti_test_xml.encode(), 97))
+
+    # records are in the same order, so that their amounts are summed in the same order
+    def uncategorize(df):
+        return df.astype({'cod_ce': object, 'denom_benef': object, 'cf_benef': object}).reset_index(drop=True)
+    pd.testing.assert_frame_equal(uncategorize(sdf), uncategorize(expected))
+
+
+def test_it_read_aiuti_flatten_order():
+    xml = """<LISTA_AIUTI>
+  <AIUTO><COD_CE_MISURA>SA.1</COD_CE_MISURA></AIUTO>
+  <AIUTO><COD_CE_MISURA>SA.2</COD_CE_MISURA><COMPONENTI_AIUTO><COMPONENTE_AIUTO><STRUMENTI_AIUTO>
+    <STRUMENTO_AIUTO><IMPORTO_NOMINALE>1</IMPORTO_NOMINALE></STRUMENTO_AIUTO>
+    <STRUMENTO_AIUTO><IMPORTO_NOMINALE>2</IMPORTO_NOMINALE></STRUMENTO_AIUTO>
+  </STRUMENTI_AIUTO></COMPONENTE_AIUTO></COMPONENTI_AIUTO></AIUTO>
+  <AIUTO><COD_CE_MISURA>SA.3</COD_CE_MISURA><COMPONENTI_AIUTO><COMPONENTE_AIUTO><STRUMENTI_AIUTO>
+    <STRUMENTO_AIUTO><IMPORTO_NOMINALE>3</IMPORTO_NOMINALE></STRUMENTO_AIUTO>
+  </STRUMENTI_AIUTO></COMPONENTE_AIUTO></COMPONENTI_AIUTO></AIUTO>
+  <AIUTO><COD_CE_MISURA>SA.4</COD_CE_MISURA><COMPONENTI_AIUTO/></AIUTO>
+</LISTA_AIUTI>"""
+    # fully_flatten moves exploded rows first, then normalized ones, innermost level first
+    adf = it.read_aiuti(BytesIO(xml.encode()))
+    assert list(adf.cod_ce) == ['SA.2', 'SA.2', 'SA.3', 'SA.1', 'SA.4']
+    assert list(adf.componenti_importo_aiuto.fillna(0)) == [1, 2, 3, 0, 0]
+
+    unsorted = it.read_aiuti(BytesIO(xml.encode()), sort=False)
+    assert list(unsorted.cod_ce) == ['SA.1', 'SA.2', 'SA.2', 'SA.3', 'SA.4']
+    pd.testing.assert_frame_equal(it.sort_aiuti(unsorted), adf)
+
+
+def test_it_read_aiuti_misure_lookup():
+    misure_df = pd.DataFrame({'cod_ce': ['SA.12345', 'SA.12345', None], 'fondo_desc': ['FESR', 'FSE', 'FEASR']})
+    lookup = it.build_misure_lookup(misure_df)
+    assert lookup == {'SA.12345': ['FESR', 'FSE']}
+
+    adf = it.read_aiuti(BytesIO(aiuti_test_xml.encode()))
+    expected = adf[transforms.normalize_cod_ce(adf.cod_ce.astype(object)) == 'SA.12345'].reset_index(drop=True)
+    pushed_down = it.read_aiuti(BytesIO(aiuti_test_xml.encode()), lookup)
+    assert len(pushed_down) == 4
+    pd.testing.assert_frame_equal(
+        pushed_down.astype(object), expected.astype(object), check_index_type=False
+    )
+    assert len(it.read_aiuti(BytesIO(aiuti_test_xml.encode()), {})) == 0
+
+
+def test_it_parse_aiuti_no_matches(capsys, tmp_path):
+    write_aiuti_zip(tmp_path / "aiuti.xml.zip")
+    assert len(it.parse_aiuti(tmp_path / "aiuti.xml.zip", {})) == 0
+    assert capsys.readouterr().out == "No aids matching the misure in file\n"
+
+    write_aiuti_zip(tmp_path / "aiuti.xml.zip", "<LISTA_AIUTI><AIUTO></AIUTO></LISTA_AIUTI>")
+    assert len(it.parse_aiuti(tmp_path / "aiuti.xml.zip")) == 0
+    assert capsys.readouterr().out == "No COD_CE_MISURA in file\n"
+
+
+@pytest.mark.parametrize("root", ["LISTA_AIUTI", "ns0:LISTA_AIUTI xmlns:ns0=\"http://www.rna.gov.it\""])
+def test_it_parse_aiuti_shards(monkeypatch, tmp_path, root):
+    aiuti = re.search(r"<AIUTO>.*</AIUTO>", aiuti_test_xml, re.S).group(0)  # all the sample aids
+    content = "".join(
+        aiuti.replace("01234567890", f"0123456789{i % 7}").replace("100.5", f"{i}.5") for i in range(40)
+    )
+    prefix = "ns0:" if root.startswith("ns0:") else ""
+    content = content.replace("<AIUTO>", f"<{prefix}AIUTO>").replace("</AIUTO>", f"</{prefix}AIUTO>")
+    write_aiuti_zip(
+        tmp_path / "aiuti.xml.zip",
+        f'<?xml version="1.0" encoding="UTF-8"?>\n<{root}>{content}</{root.split()[0]}>\n'
+    )
+    monkeypatch.setattr(it, "SHARD_MIN_SIZE", 0)
+
+    codes = {"SA.12345": ["FESR"]}
+    expected = it.parse_aiuti(tmp_path / "aiuti.xml.zip", codes)
+    assert len(expected) == 160
+    for shards in (2, 3, 7):
+        pd.testing.assert_frame_equal(it.parse_aiuti(tmp_path / "aiuti.xml.zip", codes, shards), expected)
+    assert os.listdir(tmp_path) == ["aiuti.xml.zip"]
+
+    # shards that are not well-formed on their own are parsed as a whole
+    write_aiuti_zip(
+        tmp_path / "aiuti.xml.zip",
+        f"<{root}><![CDATA[<AIUTO>]]>{content}<![CDATA[<AIUTO>]]></{root.split()[0]}>"
+    )
+    pd.testing.assert_frame_equal(it.parse_aiuti(tmp_path / "aiuti.xml.zip", codes, 3), expected)
+    assert it.aiuto_bounds(b"<LISTA_AIUTI></LISTA_AIUTI>", 2) == []
+
+
+def test_it_read_aiuti_shard_closes_mmap(monkeypatch, tmp_path):
+    mms = []
+
+    class RecordedMmap(mmap.mmap):
+        def __init__(self, *args, **kwargs):
+            mms.append(self)
+
+    monkeypatch.setattr(it.mmap, "mmap", RecordedMmap)
+    xml = aiuti_test_xml.encode("utf-8")
+    (tmp_path / "aiuti.xml").write_bytes(xml)
+    start, end = re.search(rb"<AIUTO>.*</AIUTO>", xml, re.S).span()
+
+    df = it._read_aiuti_shard(str(tmp_path / "aiuti.xml"), xml[:start], start, end, xml[end:], None)
+    assert len(df) == len(it.read_aiuti(BytesIO(xml)))
+    assert len(mms) == 1 and mms[0].closed
+
+
+def test_it_export_month(tmp_path):
+    with open(tmp_path / "misure.csv", "w") as f:
+        f.write(misure_test_csv)
+    write_aiuti_zip(tmp_path / "aiuti_2019_03.xml.zip")
+
+    result = runner.invoke(
+        app, ["it", "export", "2019_03", f"--local-path={tmp_path}"], prog_name='eu-state-aids'
+    )
+    assert result.exit_code == 0
+    assert "5 matches found." in result.stdout
+    with open(tmp_path / "2019_03.csv") as csv:
+        assert csv.read() == (
+            "cf_benef,denom_benef,cod_ce,fondo_desc,componenti_importo_aiuto\n"
+            "01234567890,ACME S.R.L.,SA.12345,FESR,1350.5\n"
+            "RSSMRA80A01H501U,ROSSI MARIO,SA.54321,FSE,10.25\n"
+        )
+
+
+def test_it_export_year_workers(tmp_path):
+    with open(tmp_path / "misure.csv", "w") as f:
+        f.write(misure_test_csv)
+    write_aiuti_zip(tmp_path / "aiuti_2019_03.xml.zip")
+    write_aiuti_zip(tmp_path / "aiuti_2019_07.xml.zip")
+    write_aiuti_zip(tmp_path / "aiuti_2019_09.xml.zip", "<LISTA_AIUTI><AIUTO>")
+
+    outputs = []
+    with requests_mock.Mocker() as mock:
+        mock.get(re.compile("OpenData_Aiuti_2019_"), status_code=404)
+        for options in (["--workers=1"], ["--workers=3"], ["--workers=2", "--memory-budget=1"]):
+            result = runner.invoke(
+                app, ["it", "export", "2019", f"--local-path={tmp_path}"] + options, prog_name='eu-state-aids'
+            )
+            assert result.exit_code == 0
+            assert "Month 2019_01 skipped: file not found" in result.stdout
+            assert "Month 2019_09 skipped: error" in result.stdout
+            assert "10 matches found." in result.stdout
+            with open(tmp_path / "2019.csv") as csv:
+                outputs.append(csv.read())
+
+    assert outputs[0] == outputs[1] == outputs[2]
+    assert "01234567890,ACME S.R.L.,SA.12345,FESR,2701.0\n" in outputs[0]
+
+
+def ref_export(xmls, misure_csv):
+    """Export the months' Aiuti XML files as the version parsing them with fully_flatten did,
+    appending the records of all months, then summing them at once."""
+    misure_df = pd.read_csv(BytesIO(misure_csv.encode()))
+    df = pd.DataFrame()
+    for xml in xmls:
+        adf = pdx.read_xml(re.sub(r"&#(\d+);", "", xml), ["LISTA_AIUTI"]).pipe(fully_flatten)
+        adf = adf[adf.notnull()["AIUTO|COD_CE_MISURA"]]
+        adf = adf[[
+            "AIUTO|COD_CE_MISURA", "AIUTO|DENOMINAZIONE_BENEFICIARIO", "AIUTO|CODICE_FISCALE_BENEFICIARIO",
+            "AIUTO|COMPONENTI_AIUTO|COMPONENTE_AIUTO|STRUMENTI_AIUTO|STRUMENTO_AIUTO|IMPORTO_NOMINALE"
+        ]]
+        adf.columns = it.AIUTI_COLUMNS
+        adf['cod_ce'] = adf.cod_ce.apply(ref_normalize_cod_ce)
+        adf = adf[adf.notnull()["cod_ce"]]
+        ydf = pd.merge(adf, misure_df, on="cod_ce", suffixes=("_a", "_m"))
+        df = pd.concat([df, ydf])
+    df.componenti_importo_aiuto = df.componenti_importo_aiuto.astype(float)
+    df = df.groupby([
+        'cf_benef', 'denom_benef', 'cod_ce', 'fondo_desc'
+    ])['componenti_importo_aiuto'].sum().reset_index()
+    return df.to_csv(na_rep='', index=False).encode()
+
+
+def test_it_export_matches_fully_flatten(monkeypatch, tmp_path):
+    """Exports are byte-identical to the ones of the version parsing Aiuti files with fully_flatten,
+    as the amounts of all months are summed at once, in the same order."""
+    monkeypatch.setattr(it, "SHARD_MIN_SIZE", 0)
+    misure_csv = "cod_ce,fondo_desc\nSA.10001,FESR\nSA.10001,FSE\nSA.20002,FEASR\n"
+    with open(tmp_path / "misure.csv", "w") as f:
+        f.write(misure_csv)
+    xmls = []
+    for m in (1, 2):
+        with open(Path("./tests") / f"it_aiuti_2019_{m:02}.xml") as f:
+            xmls.append(f.read())
+        write_aiuti_zip(tmp_path / f"aiuti_2019_{m:02}.xml.zip", xmls[-1])
+
+    with requests_mock.Mocker() as mock:
+        mock.get(re.compile("OpenData_Aiuti_2019_"), status_code=404)
+        for year_month, month_xmls in (("2019_01", xmls[:1]), ("2019", xmls)):
+            expected = ref_export(month_xmls, misure_csv)
+            for options in ([], ["--workers=2"], ["--shards=2"]):
+                result = runner.invoke(
+                    app, ["it", "export", year_month, f"--local-path={tmp_path}", "--force"] + options,
+                    prog_name='eu-state-aids'
+                )
+                assert result.exit_code == 0
+                with open(tmp_path / f"{year_month}.csv", "rb") as f:
+                    assert f.read() == expected
+
+
+def test_it_export_metrics_file(tmp_path):
+    with open(tmp_path / "misure.csv", "w") as f:
+        f.write(misure_test_csv)
+    write_aiuti_zip(tmp_path / "aiuti_2019_03.xml.zip")
+    write_aiuti_zip(tmp_path / "aiuti_2019_09.xml.zip", "<LISTA_AIUTI><AIUTO>")
+
+    with requests_mock.Mocker() as mock:
+        mock.get(re.compile("OpenData_Aiuti_2019_"), status_code=404)
+        result = runner.invoke(
+            app, [
+                f"--metrics-file={tmp_path / 'metrics.json'}", "--profile",
+                "it", "export", "2019", f"--local-path={tmp_path}", "--workers=2"
+            ], prog_name='eu-state-aids'
+        )
+    assert result.exit_code == 0
+    assert f"Metrics written to {tmp_path / 'metrics.json'}" in result.stdout
+
+    with open(tmp_path / "metrics.json") as f:
+        report = json.load(f)
+    stages = {(s["stage"], s.get("month")): s for s in report["stages"]}
+    assert stages[("parse", 3)]["year"] == 2019
+    # aids not matching the misure are skipped while parsing
+    assert stages[("parse", 3)]["rows_out"] == 5
+    assert stages[("parse", 3)]["bytes_read"] == len(aiuti_test_xml.encode())
+    assert stages[("merge", 3)]["rows_out"] == 5
+    # without a memory budget, the records of all months are only summed when combined
+    assert ("sum", 3) not in stages
+    assert "error" in stages[("parse", 9)]
+    assert "error" in stages[("download", 1)]
+    assert stages[("combine", None)]["rows_out"] == 2
+    for s in report["stages"]:
+        assert s["wall_seconds"] >= 0 and s["cpu_seconds"] >= 0
+        assert s["process_peak_rss_mb"] > 0 and s["peak_rss_growth_mb"] >= 0
+    assert len(list((tmp_path / "metrics_profiles").glob("parse_2019_3_*.prof"))) == 1
+
+    # API hook
+    records = []
+    with metrics.collect(on_stage=records.append):
+        it.export_month("2019", 3, str(tmp_path), pd.read_csv(tmp_path / "misure.csv"))
+    assert [r["stage"] for r in records] == ["parse", "filter", "merge", "sum", "export_month"]
+
+
+def test_metrics_without_resource(monkeypatch):
+    # there is no resource module on Windows
+    monkeypatch.setitem(sys.modules, "resource", None)
+    assert metrics.peak_rss_mb() is None
+    records = []
+    with metrics.collect(on_stage=records.append):
+        with metrics.stage("test"):
+            pass
+    assert records[0]["process_peak_rss_mb"] is None and records[0]["peak_rss_growth_mb"] is None
+
+
+class RangeRequestHandler(BaseHTTPRequestHandler):
+    """Serve a payload at /file.zip, with an ETag, supporting Range and If-Range requests.
+
+    The first response is truncated, to simulate a dropped connection."""
+    payload = bytes(range(256)) * 1200
+    etag = '"v1"'
+    truncate = True
+    ranges = []
+
+    def do_GET(self):
+        if self.path != "/file.zip":
+            self.send_error(404)
+            return
+        range_header = self.headers.get("Range")
+        if self.headers.get("If-Range") not in (None, self.etag):
+            # the file changed, send it whole
+            range_header = None
+        self.ranges.append(range_header)
+        start = int(range_header[len("bytes="):-1]) if range_header else 0
+        body = self.payload[start:]
+        self.send_response(206 if range_header else 200)
+        if range_header:
+            self.send_header("Content-Range", f"bytes {start}-{len(self.payload) - 1}/{len(self.payload)}")
+        self.send_header("ETag", self.etag)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        if RangeRequestHandler.truncate:
+            RangeRequestHandler.truncate = False
+            body = body[:len(body) // 2]
+            self.close_connection = True
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def http_server():
+    RangeRequestHandler.payload = bytes(range(256)) * 1200
+    RangeRequestHandler.etag = '"v1"'
+    RangeRequestHandler.truncate = True
+    RangeRequestHandler.ranges = []
+    server = ThreadingHTTPServer(("127.0.0.1", 0), RangeRequestHandler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield f"http://127.0.0.1:{server.server_port}"
+    server.shutdown()
+    server.server_close()
+
+
+def test_download_resumes_after_dropped_connection(http_server, tmp_path):
+    filepath = tmp_path / "file.zip"
+    assert download.download(f"{http_server}/file.zip", filepath, backoff=0, chunk_size=1024)
+    assert filepath.read_bytes() == RangeRequestHandler.payload
+    assert not (tmp_path / "file.zip.part").exists()
+    assert not (tmp_path / "file.zip.part.json").exists()
+
+    # the second request resumed the download from the end of the partial file
+    assert RangeRequestHandler.ranges[0] is None
+    assert RangeRequestHandler.ranges[1] == f"bytes={len(RangeRequestHandler.payload) // 2}-"
+
+
+def test_download_restarts_when_changed(http_server, tmp_path):
+    filepath = tmp_path / "file.zip"
+    with pytest.raises(requests.RequestException):
+        download.download(f"{http_server}/file.zip", filepath, retries=0, chunk_size=1024)
+    assert (tmp_path / "file.zip.part").exists()
+    with open(tmp_path / "file.zip.part.json") as f:
+        assert json.load(f)["etag"] == '"v1"'
+
+    # the remote file changed since the partial download: it is sent whole, and the partial file truncated
+    RangeRequestHandler.payload = bytes(range(255, -1, -1)) * 1000
+    RangeRequestHandler.etag = '"v2"'
+    validators = download.download_if_modified(f"{http_server}/file.zip", filepath, backoff=0)
+    assert validators["etag"] == '"v2"'
+    assert filepath.read_bytes() == RangeRequestHandler.payload
+    assert RangeRequestHandler.ranges == [None, None]
+    assert sorted(os.listdir(tmp_path)) == ["file.zip"]
+
+    # partial files with no validators are downloaded again from the start
+    with open(tmp_path / "other.zip.part", "wb") as f:
+        f.write(b"stale")
+    assert download.download(f"{http_server}/file.zip", tmp_path / "other.zip", backoff=0)
+    assert (tmp_path / "other.zip").read_bytes() == RangeRequestHandler.payload
+    assert RangeRequestHandler.ranges[-1] is None
+
+
+def test_download_not_found(http_server, tmp_path):
+    filepath = tmp_path / "missing.zip"
+    assert download.download(f"{http_server}/missing.zip", filepath, backoff=0) is False
+    assert not filepath.exists()
+
+
+def test_download_many(http_server, tmp_path):
+    RangeRequestHandler.truncate = False
+    results = download.download_many([
+        (f"{http_server}/file.zip", tmp_path / "a.zip"),
+        (f"{http_server}/missing.zip", tmp_path / "b.zip"),
+        (f"{http_server}/file.zip", tmp_path / "c.zip"),
+    ], max_workers=2, backoff=0)
+    assert results == [True, False, True]
+    assert (tmp_path / "c.zip").read_bytes() == RangeRequestHandler.payload
+
+
+def test_it_fetch_range(tmp_path):
+
+    with requests_mock.Mocker() as mock:
+        mock.get(re.compile("OpenData_Aiuti_2019_1[12]"), content=b"zip")
+        mock.get(re.compile("OpenData_Aiuti_2020_01"), status_code=404)
+        result = runner.invoke(
+            app, ["it", "fetch-range", "2019_11", "2020_01", f"--local-path={tmp_path}"],
+            prog_name='eu-state-aids'
+        )
+
+    assert result.exit_code == 0
+    assert f"File saved to {tmp_path / 'aiuti_2019_11.xml.zip'}" in result.stdout
+    assert f"File saved to {tmp_path / 'aiuti_2019_12.xml.zip'}" in result.stdout
+    assert "File not found for year: 2020, month: 01" in result.stdout
+    assert not os.path.exists(tmp_path / "aiuti_2020_01.xml.zip")
+
+
+# reference, per-row implementations of the transforms
+def ref_lookup_name(x):
+    try:
+        return str(x).split(' ', 1)[1]
+    except IndexError:
+        return str(x)
+
+
+def ref_lookup_id(x):
+    try:
+        return int(str(x).split(' ', 1)[0])
+    except ValueError:
+        return np.NAN
+
+
+def ref_build_eu_prog_id(x, program_start_year='2014'):
+    splits = x.split('-', 1)
+    if len(splits) < 2:
+        return np.NAN
+    return program_start_year + x.split('-', 1)[0]
+
+
+def ref_build_eu_prog_aid_id(x):
+    splits = x.split('-')
+    if len(splits) < 3:
+        return np.NAN
+    else:
+        return '-'.join(splits[:-1])
+
+
+def ref_normalize_cod_ce(x):
+    c = re.compile(r'SA[. ](\d+)')
+    m = re.match(c, x)
+    if m and len(m.groups()) == 1:
+        return f"SA.{m.group(1)}"
+    else:
+        return np.NAN
+
+
+# text made of the characters relevant to the transforms
+texts = st.text(alphabet="0123456789 -._+SAab\t", max_size=20)
+beneficiaries = st.lists(st.one_of(texts, st.integers(), st.just(np.NAN)), max_size=20)
+
+
+def assert_same_values(result, values, ref, check_dtype=False):
+    expected = pd.Series(values, dtype=object).apply(ref)
+    assert result.index.equals(expected.index)
+    assert [None if pd.isna(v) else v for v in result] == [None if pd.isna(v) else v for v in expected]
+    if check_dtype and len(values):
+        assert result.dtype == expected.dtype
+
+
+@given(beneficiaries)
+def test_transforms_lookup_name(values):
+    assert_same_values(transforms.lookup_name(pd.Series(values, dtype=object)), values, ref_lookup_name)
+
+
+@given(beneficiaries)
+def test_transforms_lookup_id(values):
+    # IDs are expected to fit into 64 bits integers
+    assume(all(abs(v) < 2 ** 63 for v in map(ref_lookup_id, values) if not pd.isna(v)))
+    assert_same_values(
+        transforms.lookup_id(pd.Series(values, dtype=object)), values, ref_lookup_id, check_dtype=True
+    )
+
+
+def test_transforms_lookup_id_unicode_digits():
+    values = ['١٢ Name', '-٣_٤ Name', '12 Name', 'x Name']
+    assert_same_values(
+        transforms.lookup_id(pd.Series(values, dtype=object)), values, ref_lookup_id, check_dtype=True
+    )
+    assert_same_values(transforms.lookup_id(pd.Series(values[:2])), values[:2], ref_lookup_id, check_dtype=True)
+
+
+@given(st.lists(texts, max_size=20))
+def test_transforms_build_eu_prog_id(values):
+    assert_same_values(
+        transforms.build_eu_prog_id(pd.Series(values, dtype=object), '2014'), values, ref_build_eu_prog_id
+    )
+
+
+@given(st.lists(texts, max_size=20))
+def test_transforms_build_eu_prog_aid_id(values):
+    assert_same_values(
+        transforms.build_eu_prog_aid_id(pd.Series(values, dtype=object)), values, ref_build_eu_prog_aid_id
+    )
+
+
+@given(st.lists(texts, max_size=20))
+def test_transforms_normalize_cod_ce(values):
+    assert_same_values(
+        transforms.normalize_cod_ce(pd.Series(values, dtype=object)), values, ref_normalize_cod_ce
+    )
+
+
+misure_test_xml = """<?xml version="1.0" encoding="UTF-8"?>
+<ns0:LISTA_MISURE_TYPE xmlns:ns0="http://www.rna.gov.it/misure">
+  <MISURA>
+    <COD_CE>SA.12345</COD_CE>
+    <LISTA_COFINANZIAMENTI>
+      <COFINANZIAMENTO>
+        <COD_FONDO>1</COD_FONDO><DESCRIZIONE_FONDO>FESR</DESCRIZIONE_FONDO><IMPORTO>10</IMPORTO>
+      </COFINANZIAMENTO>
+    </LISTA_COFINANZIAMENTI>
+  </MISURA>
+  <MISURA>
+    <COD_CE>SA 54321</COD_CE>
+    <LISTA_COFINANZIAMENTI>
+      <COFINANZIAMENTO>
+        <COD_FONDO>2</COD_FONDO><DESCRIZIONE_FONDO>FSE</DESCRIZIONE_FONDO><IMPORTO>20</IMPORTO>
+      </COFINANZIAMENTO>
+    </LISTA_COFINANZIAMENTI>
+  </MISURA>
+  <MISURA>
+    <COD_CE>SA.99999</COD_CE>
+  </MISURA>
+</ns0:LISTA_MISURE_TYPE>
+"""
+
+
+def zipped(content, filename="OpenData.xml"):
+    buf = BytesIO()
+    with zipfile.ZipFile(buf, "w") as z:
+        z.writestr(filename, content)
+    return buf.getvalue()
+
+
+def test_it_generate_measures_cache(tmp_path):
+
+    # month 2019_03 publishes a new measure in the second version of the files
+    versions = {"2019_03": "v1"}
+    requested = []
+
+    def misure_callback(request, context):
+        period = re.search(r"OpenData_Misura_(\d{4}_\d{2})", request.url).group(1)
+        etag = f'"{versions.get(period, "v1")}"'
+        if request.headers.get("If-None-Match") == etag:
+            context.status_code = 304
+            return b""
+        requested.append(period)
+        context.headers["ETag"] = etag
+        if etag == '"v2"':
+            return zipped(misure_test_xml.replace("SA.99999</COD_CE>", """SA.77777</COD_CE>
+                <LISTA_COFINANZIAMENTI><COFINANZIAMENTO><DESCRIZIONE_FONDO>FEASR</DESCRIZIONE_FONDO>
+                </COFINANZIAMENTO></LISTA_COFINANZIAMENTI>"""))
+        return zipped(misure_test_xml)
+
+    with requests_mock.Mocker() as mock:
+        mock.get(re.compile("OpenData_Misura_"), content=misure_callback)
+        args = ["it", "generate-measures", f"--local-path={tmp_path}"]
+
+        result = runner.invoke(app, args, prog_name='eu-state-aids')
+        assert result.exit_code == 0
+        assert len(requested) == len(it.misure_periods())
+        assert "Cached results reused" not in result.stdout
+        assert "2 recordss found." in result.stdout
+
+        requested.clear()
+        result = runner.invoke(app, args, prog_name='eu-state-aids')
+        assert result.exit_code == 0
+        assert requested == []
+        assert f"Cached results reused for {len(it.misure_periods())} months" in result.stdout
+        assert "Processing" not in result.stdout
+
+        versions["2019_03"] = "v2"
+        result = runner.invoke(app, args + ["--since=2019_01"], prog_name='eu-state-aids')
+        assert result.exit_code == 0
+        assert requested == ["2019_03"]
+        assert "Processing" in result.stdout and "OpenData_Misura_2019_03" in result.stdout
+        assert "3 recordss found." in result.stdout
+
+    with open(tmp_path / "misure.csv") as f:
+        assert f.read() == "cod_ce,fondo_desc\nSA.12345,FESR\nSA.54321,FSE\nSA.77777,FEASR\n"
+
+
+def test_it_export_store_parsed(monkeypatch, tmp_path):
+    pytest.importorskip("pyarrow")
+    with open(tmp_path / "misure.csv", "w") as f:
+        f.write(misure_test_csv)
+    write_aiuti_zip(tmp_path / "aiuti_2019_03.xml.zip")
+    args = ["it", "export", "2019_03", f"--local-path={tmp_path}", "--store-parsed"]
+
+    result = runner.invoke(app, args, prog_name='eu-state-aids')
+    assert result.exit_code == 0
+    assert "Processing" in result.stdout
+    assert os.path.exists(tmp_path / "parsed" / "year=2019" / "month=03" / "part-0.parquet")
+    with open(tmp_path / "2019_03.csv") as csv:
+        expected = csv.read()
+
+    # stored records are read, even when the xml file is deleted
+    result = runner.invoke(app, args + ["--delete-processed", "--force"], prog_name='eu-state-aids')
+    assert "Parsed records read from" in result.stdout
+    assert "Processing" not in result.stdout
+    result = runner.invoke(app, args + ["--force"], prog_name='eu-state-aids')
+    assert "Parsed records read from" in result.stdout
+    with open(tmp_path / "2019_03.csv") as csv:
+        assert csv.read() == expected
+
+    # stored records of a different version are stale
+    monkeypatch.setattr(it, "AIUTI_SCHEMA_VERSION", "test")
+    with requests_mock.Mocker() as mock:
+        mock.get(it.build_aiuti_url(2019, 3), content=zipped(aiuti_test_xml))
+        result = runner.invoke(app, args, prog_name='eu-state-aids')
+    assert "Processing" in result.stdout
+    with open(tmp_path / "2019_03.csv") as csv:
+        assert csv.read() == expected
+
+    # stored records of a different source file are stale
+    write_aiuti_zip(tmp_path / "aiuti_2019_03.xml.zip", aiuti_test_xml.replace(">10.25<", ">20.5<"))
+    result = runner.invoke(app, args, prog_name='eu-state-aids')
+    assert "Processing" in result.stdout
+    with open(tmp_path / "2019_03.csv") as csv:
+        assert "RSSMRA80A01H501U,ROSSI MARIO,SA.54321,FSE,20.5\n" in csv.read()
+
+
+@pytest.mark.parametrize("compression", [zipfile.ZIP_STORED, zipfile.ZIP_DEFLATED])
+def test_zip_member_stream(compression):
+    content = aiuti_test_xml.encode() * 50
+    buf = BytesIO()
+    with zipfile.ZipFile(buf, "w", compression=compression) as z:
+        z.writestr("OpenData_Aiuti.xml", content)
+    for chunk_size in (7, 1024):
+        zf = zipstream.ZipMemberStream(ChunkedStream(buf.getvalue(), chunk_size), chunk_size=chunk_size)
+        assert zf.filename == "OpenData_Aiuti.xml"
+        assert zf.read() == content
+        assert zf.size == len(content)
+
+    # members written to a non-seekable stream have a data descriptor
+    class Unseekable(BytesIO):
+        def seekable(self):
+            return False
+
+        def seek(self, *args):
+            raise OSError
+
+        def tell(self):
+            raise OSError
+    buf = Unseekable()
+    with zipfile.ZipFile(buf, "w", compression=zipfile.ZIP_DEFLATED) as z:
+        with z.open("OpenData_Aiuti.xml", "w") as f:
+            f.write(content)
+    assert zipstream.ZipMemberStream(BytesIO(buf.getvalue())).read() == content
+
+    corrupted = bytearray(zipped(content))
+    corrupted[100] ^= 0xFF
+    with pytest.raises(zipfile.BadZipFile):
+        zipstream.ZipMemberStream(BytesIO(bytes(corrupted))).read()
+    with pytest.raises(zipfile.BadZipFile):
+        zipstream.ZipMemberStream(BytesIO(b"not a zip file at all, really"))
+
+
+def test_it_export_stream(tmp_path):
+    with open(tmp_path / "misure.csv", "w") as f:
+        f.write(misure_test_csv)
+    write_aiuti_zip(tmp_path / "aiuti_2019_03.xml.zip")
+    result = runner.invoke(
+        app, ["it", "export", "2019_03", f"--local-path={tmp_path}"], prog_name='eu-state-aids'
+    )
+    with open(tmp_path / "2019_03.csv") as csv:
+        expected = csv.read()
+    os.unlink(tmp_path / "aiuti_2019_03.xml.zip")
+
+    with requests_mock.Mocker() as mock:
+        mock.get(re.compile("OpenData_Aiuti_2019_"), status_code=404)
+        mock.get(it.build_aiuti_url(2019, 3), content=zipped(aiuti_test_xml))
+        mock.get(it.build_aiuti_url(2019, 4), content=zipped(aiuti_test_xml)[:200])
+        result = runner.invoke(
+            app, ["it", "export", "2019_03", f"--local-path={tmp_path}", "--stream"], prog_name='eu-state-aids'
+        )
+        assert result.exit_code == 0
+        assert "Streaming" in result.stdout
+        assert "5 matches found." in result.stdout
+        with open(tmp_path / "2019_03.csv") as csv:
+            assert csv.read() == expected
+        # no local copy is stored
+        assert not os.path.exists(tmp_path / "aiuti_2019_03.xml.zip")
+
+        result = runner.invoke(
+            app, ["it", "export", "2019", f"--local-path={tmp_path}", "--stream", "--workers=2"],
+            prog_name='eu-state-aids'
+        )
+        assert result.exit_code == 0
+        assert "Month 2019_01 skipped: file not found" in result.stdout
+        assert "Month 2019_04 skipped: error" in result.stdout
+        assert "5 matches found." in result.stdout
+
+
+def test_partial_sums_spill(tmp_path):
+    rng = np.random.RandomState(0)
+    months = [
+        pd.DataFrame({
+            'k1': rng.choice(['a', 'b', 'c', None], 50),
+            'k2': rng.choice(['x', 'y'], 50),
+            'v': rng.randint(0, 1000, 50) / 4,
+        }) for _ in range(6)
+    ]
+    expected = pd.concat(months).groupby(['k1', 'k2'], dropna=False)['v'].sum().reset_index()
+
+    sums = aggregate.PartialSums(['k1', 'k2'], ['v'], memory_budget=1, spill_path=tmp_path, n_buckets=3)
+    for month in months:
+        sums.add(sums.combine([month]))
+    assert sums.n_spills == len(months)
+    pd.testing.assert_frame_equal(sums.result(), expected)
+    assert list(tmp_path.iterdir()) == []
+
+    sums = aggregate.PartialSums(['k1', 'k2'], ['v'])
+    for month in months:
+        sums.add(sums.combine([month]))
+    pd.testing.assert_frame_equal(sums.result(), expected)
+
+
+def test_partial_sums_categorical(tmp_path):
+    rng = np.random.RandomState(0)
+    months = [
+        pd.DataFrame({
+            'k1': rng.choice(['a', 'b', 'c', None], 50),
+            'k2': rng.choice(['x', 'y', 'z'][:2 + n % 2], 50),
+            'v': rng.randint(0, 1000, 50) / 4,
+        }) for n in range(6)
+    ]
+    expected = pd.concat(months).groupby(['k1', 'k2'], dropna=False)['v'].sum().reset_index()
+
+    # months have different categories, and missing keys are kept
+    for memory_budget in (None, 1):
+        sums = aggregate.PartialSums(['k1', 'k2'], ['v'], memory_budget=memory_budget, spill_path=tmp_path)
+        for month in months:
+            sums.add(sums.combine([schema.compact(month.copy(), {'k1': 'category', 'k2': 'category'})]))
+        result = sums.result()
+        assert schema.is_categorical(result.k1) and schema.is_categorical(result.k2)
+
+        def sort(df):
+            return df.astype({'k1': object, 'k2': object}).sort_values(['k1', 'k2']).reset_index(drop=True)
+        pd.testing.assert_frame_equal(sort(result), sort(expected))
+
+
+def test_it_read_aiuti_compact():
+    adf = it.read_aiuti(BytesIO(aiuti_test_xml.encode()))
+    assert all(schema.is_categorical(adf[c]) for c in ['cod_ce', 'denom_benef', 'cf_benef'])
+    assert adf.componenti_importo_aiuto.dtype == float
+
+    misure_df = schema.compact(pd.read_csv(BytesIO(misure_test_csv.encode())), schema.MISURE_DTYPES)
+    sums = it.sum_matches(it.filter_aiuti(adf), misure_df)
+    assert schema.is_categorical(sums.fondo_desc)
+    assert list(sums.columns) == it.EXPORT_KEYS + it.EXPORT_VALUES
+    assert sums.n_records.sum() == 5
+    assert sorted(sums.componenti_importo_aiuto) == [10.25, 1350.5]
+
+
+def test_bg_export_stateaid_cache(tmp_path):
+    with open(Path("./tests") / "bg_projects_sample.xlsx", mode='rb') as sample_xls:
+        sample_content = sample_xls.read()
+    with open(Path("./tests") / "bg_state_aids.xlsx", mode='rb') as state_aids_xls:
+        state_aids_content = state_aids_xls.read()
+
+    with open(tmp_path / "projects_2015.xlsx", mode='wb') as f:
+        f.write(sample_content)
+    args = ["bg", "export", "2015", f"--local-path={tmp_path}"]
+
+    # no cached data yet
+    with requests_mock.Mocker():
+        result = runner.invoke(app, args + ["--offline"], prog_name='eu-state-aids')
+    assert "can not work offline" in result.stdout
+    assert result.exit_code == 1
+    assert not os.path.exists(tmp_path / "2015.csv")
+
+    def state_aids_callback(request, context):
+        if request.headers.get("If-None-Match") == '"v1"':
+            context.status_code = 304
+            return b""
+        context.headers["ETag"] = '"v1"'
+        return state_aids_content
+
+    with requests_mock.Mocker() as mock:
+        mock.get(state_aids_url, content=state_aids_callback)
+        result = runner.invoke(app, args, prog_name='eu-state-aids')
+        assert '188 matches found.' in result.stdout
+        assert "using cached data" not in result.stdout
+
+        result = runner.invoke(app, args + ["--force"], prog_name='eu-state-aids')
+        assert mock.last_request.headers["If-None-Match"] == '"v1"'
+        assert "Stateaid data not modified, using cached data" in result.stdout
+        assert '188 matches found.' in result.stdout
+
+    # no requests are sent when working offline
+    with requests_mock.Mocker() as mock:
+        result = runner.invoke(app, args + ["--offline", "--force"], prog_name='eu-state-aids')
+        assert not mock.called
+    assert "Using cached stateaid data" in result.stdout
+    assert '188 matches found.' in result.stdout
+
+
+def test_it_export_manifest(tmp_path):
+    with open(tmp_path / "misure.csv", "w") as f:
+        f.write(misure_test_csv)
+    write_aiuti_zip(tmp_path / "aiuti_2019_03.xml.zip")
+    args = ["it", "export", "2019_03", f"--local-path={tmp_path}"]
+
+    result = runner.invoke(app, args, prog_name='eu-state-aids')
+    assert "5 matches found." in result.stdout
+    with open(tmp_path / "2019_03.csv") as csv:
+        expected = csv.read()
+
+    # unchanged inputs and output
+    result = runner.invoke(app, args, prog_name='eu-state-aids')
+    assert result.exit_code == 0
+    assert "Inputs of 2019_03 not changed since its last export, skipped" in result.stdout
+    assert "Processing" not in result.stdout
+    result = runner.invoke(app, args + ["--force"], prog_name='eu-state-aids')
+    assert "Processing" in result.stdout
+
+    # changed output, or changed inputs
+    with open(tmp_path / "2019_03.csv", "a") as csv:
+        csv.write("edited by hand\n")
+    assert "Processing" in runner.invoke(app, args, prog_name='eu-state-aids').stdout
+    with open(tmp_path / "2019_03.csv") as csv:
+        assert csv.read() == expected
+    with open(tmp_path / "misure.csv", "w") as f:
+        f.write(misure_test_csv.replace("FSE", "FSE+"))
+    assert "Processing" in runner.invoke(app, args, prog_name='eu-state-aids').stdout
+    assert "skipped" in runner.invoke(app, args, prog_name='eu-state-aids').stdout
+
+    # the memory budget changes the order amounts are summed in
+    assert "Processing" in runner.invoke(app, args + ["--memory-budget=1"], prog_name='eu-state-aids').stdout
+    assert "skipped" in runner.invoke(app, args + ["--memory-budget=1"], prog_name='eu-state-aids').stdout
+    assert "Processing" in runner.invoke(app, args, prog_name='eu-state-aids').stdout
+
+    # periods with missing months are always exported
+    with requests_mock.Mocker() as mock:
+        mock.get(re.compile("OpenData_Aiuti_2019_"), status_code=404)
+        for _ in range(2):
+            result = runner.invoke(
+                app, ["it", "export", "2019", f"--local-path={tmp_path}"], prog_name='eu-state-aids'
+            )
+            assert "Month 2019_01 skipped: file not found" in result.stdout
+
+
+@pytest.mark.parametrize("output_format", ["csv", "csv.gz", "csv.zst", "parquet"])
+def test_writers_write_output(monkeypatch, tmp_path, output_format):
+    if output_format == "csv.zst":
+        pytest.importorskip("zstandard")
+    if output_format == "parquet":
+        pytest.importorskip("pyarrow")
+    df = pd.DataFrame({"code": [f"SA.{i}" for i in range(25)], "amount": [i * 1.5 for i in range(25)]})
+    df.loc[3, "code"] = None
+    filepath = writers.output_filepath(tmp_path, "2019", output_format)
+    assert filepath.name == f"2019{writers.FORMATS[output_format]}"
+
+    # chunked writes produce the same content as a single write
+    sidecar = writers.write_output(df, filepath, output_format, chunk_rows=7)
+    pd.testing.assert_frame_equal(writers.read_output(filepath), df)
+    if output_format == "csv":
+        with open(filepath) as f:
+            assert f.read() == df.to_csv(na_rep='', index=False)
+    with open(writers.sidecar_filepath(filepath)) as f:
+        assert json.load(f) == sidecar
+    assert sidecar["format"] == output_format and sidecar["rows"] == 25
+    assert sidecar["bytes"] == os.path.getsize(filepath) and sidecar["sha256"] == file_checksum(filepath)
+    assert writers.find_output(tmp_path, "2019") == filepath
+    assert writers.find_output(tmp_path, "2020") is None
+
+    # a failed write leaves the previous file in place, and no temporary file
+    def write_failing(df, f, chunk_rows):
+        raise OSError("disk full")
+    monkeypatch.setattr(writers, "_write_csv", write_failing)
+    monkeypatch.setattr(writers, "_write_parquet", write_failing)
+    with pytest.raises(OSError):
+        writers.write_output(df.head(3), filepath, output_format)
+    pd.testing.assert_frame_equal(writers.read_output(filepath), df)
+    assert sorted(os.listdir(tmp_path)) == [filepath.name, writers.sidecar_filepath(filepath).name]
+
+    with pytest.raises(ValueError):
+        writers.output_filepath(tmp_path, "2019", "xls")
+
+
+def test_it_export_output_format(tmp_path):
+    with open(tmp_path / "misure.csv", "w") as f:
+        f.write(misure_test_csv)
+    write_aiuti_zip(tmp_path / "aiuti_2019_03.xml.zip")
+    args = ["it", "export", "2019_03", f"--local-path={tmp_path}"]
+
+    result = runner.invoke(app, args, prog_name='eu-state-aids')
+    assert "5 matches found." in result.stdout
+    expected = pd.read_csv(tmp_path / "2019_03.csv")
+
+    # another format is exported again, as its output is missing
+    result = runner.invoke(app, args + ["--output-format=csv.gz"], prog_name='eu-state-aids')
+    assert f"Writing results to {tmp_path / '2019_03.csv.gz'}" in result.stdout
+    pd.testing.assert_frame_equal(pd.read_csv(tmp_path / "2019_03.csv.gz"), expected)
+    with open(tmp_path / "2019_03.csv.gz.meta.json") as f:
+        assert json.load(f)["rows"] == len(expected)
+    result = runner.invoke(app, args + ["--output-format=csv.gz"], prog_name='eu-state-aids')
+    assert "skipped" in result.stdout
+
+    result = runner.invoke(app, args + ["--output-format=xls"], prog_name='eu-state-aids')
+    assert result.exit_code == 2
+    assert "Invalid value for '--output-format': xls." in result.output
+    assert not os.path.exists(tmp_path / "2019_03.xls")
+
+    # the output format is validated in API calls too, as asserts are stripped with -O
+    with pytest.raises(typer.BadParameter):
+        it.export(
+            "2019_03", local_path=str(tmp_path), delete_processed=False, workers=1, store_parsed=False,
+            memory_budget=None, stream=False, force=True, shards=1, results_db=None, output_format="xls", delta=False
+        )
+
+
+def test_delta_diff():
+    keys = ["cf", "scheme"]
+    previous = pd.DataFrame({
+        "cf": ["A", "B", "B", "C", "D"], "scheme": ["SA.1", "SA.2", "SA.2", "SA.3", "SA.4"],
+        "amount": ["10.0", "5.0", "6.0", "7.0", "8.0"],
+    })
+    current = pd.DataFrame({
+        "cf": ["A", "B", "C", "E", "D"], "scheme": ["SA.1", "SA.2", "SA.3", "SA.5", "SA.4"],
+        "amount": ["10.0", "5.0", "7.5", "1.0", "8.0"],
+    })
+
+    delta_df = delta.diff(previous, current, keys)
+    assert list(delta_df.columns) == ["operation", "occurrence", "cf", "scheme", "amount"]
+    assert delta_df.values.tolist() == [
+        ["insert", 0, "E", "SA.5", "1.0"],
+        ["update", 0, "C", "SA.3", "7.5"],
+        ["delete", 1, "B", "SA.2", "6.0"],
+    ]
+
+    # records with the same keys: removing one does not turn the following ones into updates,
+    # and the occurrence tells which one changed
+    previous = pd.DataFrame({"cf": ["B"] * 4, "scheme": ["SA.2"] * 4, "amount": ["5.0", "6.0", "7.0", "7.0"]})
+    current = pd.DataFrame({"cf": ["B"] * 3, "scheme": ["SA.2"] * 3, "amount": ["6.0", "7.5", "7.0"]})
+    assert delta.diff(previous, current, keys).values.tolist() == [
+        ["update", 0, "B", "SA.2", "7.5"],
+        ["delete", 3, "B", "SA.2", "7.0"],
+    ]
+    assert delta.diff(previous, previous.iloc[1:], keys).values.tolist() == [["delete", 0, "B", "SA.2", "5.0"]]
+    assert delta.diff(previous.iloc[1:], previous, keys).values.tolist() == [["insert", 0, "B", "SA.2", "5.0"]]
+
+    # no previous records, or no current records
+    assert delta.diff(None, current, keys).operation.tolist() == ["insert"] * 3
+    assert delta.diff(previous, None, keys).operation.tolist() == ["delete"] * 4
+    assert delta.diff(previous, None, keys).occurrence.tolist() == [0, 1, 2, 3]
+    assert delta.diff(current, current, keys).empty
+    assert list(delta.diff(None, None, keys).columns) == ["operation", "occurrence"] + keys
+
+
+def test_it_export_delta(tmp_path):
+    with open(tmp_path / "misure.csv", "w") as f:
+        f.write(misure_test_csv)
+    write_aiuti_zip(tmp_path / "aiuti_2019_03.xml.zip")
+    args = ["it", "export", "2019_03", f"--local-path={tmp_path}", "--delta"]
+    delta_filepath = tmp_path / "2019_03_delta.csv"
+
+    # all records are inserted, at first
+    result = runner.invoke(app, args, prog_name='eu-state-aids')
+    df = pd.read_csv(tmp_path / "2019_03.csv")
+    assert f"{len(df)} changed records written to {tmp_path / '2019_03_delta.csv'}" in result.stdout
+    delta_df = pd.read_csv(delta_filepath)
+    assert delta_df.operation.tolist() == ["insert"] * len(df)
+    assert delta_df.occurrence.tolist() == [0] * len(df)
+    pd.testing.assert_frame_equal(delta_df.drop(columns=["operation", "occurrence"]), df)
+
+    # unchanged records are not written
+    result = runner.invoke(app, args + ["--force"], prog_name='eu-state-aids')
+    assert "0 changed records written" in result.stdout
+    assert len(pd.read_csv(delta_filepath)) == 0
+
+    # records of a changed fund are deleted, and inserted again with the new fund
+    with open(tmp_path / "misure.csv", "w") as f:
+        f.write(misure_test_csv.replace("FSE", "FSE+"))
+    runner.invoke(app, args, prog_name='eu-state-aids')
+    delta_df = pd.read_csv(delta_filepath)
+    changed = df[df.fondo_desc == "FSE"]
+    assert len(changed)
+    assert sorted(delta_df.operation) == ["delete"] * len(changed) + ["insert"] * len(changed)
+    assert set(delta_df[delta_df.operation == "insert"].fondo_desc) == {"FSE+"}
+    with open(tmp_path / "2019_03_delta.csv.meta.json") as f:
+        assert json.load(f)["rows"] == len(delta_df)
+
+    # the delta of a skipped period is removed
+    result = runner.invoke(app, args, prog_name='eu-state-aids')
+    assert "skipped" in result.stdout
+    assert not os.path.exists(delta_filepath)
+    assert not os.path.exists(tmp_path / "2019_03_delta.csv.meta.json")
+
+    # when no records match anymore, all of them are deleted, once
+    with open(tmp_path / "misure.csv", "w") as f:
+        f.write("cod_ce,fondo_desc\nSA.99999,FESR\n")
+    runner.invoke(app, args, prog_name='eu-state-aids')
+    assert pd.read_csv(delta_filepath).operation.tolist() == ["delete"] * len(df)
+    assert not os.path.exists(tmp_path / "2019_03.csv")
+    assert not os.path.exists(tmp_path / "2019_03.csv.meta.json")
+    result = runner.invoke(app, args + ["--force"], prog_name='eu-state-aids')
+    assert "0 changed records written" in result.stdout
+
+
+def test_bg_export_range_manifest(tmp_path):
+    with open(Path("./tests") / "bg_projects_sample.xlsx", mode='rb') as sample_xls:
+        sample_content = sample_xls.read()
+    with open(Path("./tests") / "bg_state_aids.xlsx", mode='rb') as state_aids_xls:
+        state_aids_content = state_aids_xls.read()
+
+    for year in ["2015", "2016"]:
+        with open(tmp_path / f"projects_{year}.xlsx", mode='wb') as f:
+            f.write(sample_content)
+    args = ["bg", "export-range", "2015", "2016", f"--local-path={tmp_path}", "--combined"]
+
+    with requests_mock.Mocker() as mock:
+        mock.get(state_aids_url, content=state_aids_content)
+        result = runner.invoke(app, args, prog_name='eu-state-aids')
+        assert "2015: 470 rows, 188 matches" in result.stdout
+        with open(tmp_path / "2015_2016.csv") as csv:
+            expected = csv.read()
+
+        # only the year whose excel file changed is exported again
+        with open(tmp_path / "projects_2016.xlsx", mode='ab') as f:
+            f.write(b"\0")
+        result = runner.invoke(app, args, prog_name='eu-state-aids')
+        assert "2015: not changed, skipped" in result.stdout
+        assert "2016: 470 rows, 188 matches" in result.stdout
+        with open(tmp_path / "2015_2016.csv") as csv:
+            assert csv.read() == expected
+
+        result = runner.invoke(
+            app, ["bg", "export", "2016", f"--local-path={tmp_path}"], prog_name='eu-state-aids'
+        )
+        assert "Inputs of 2016 not changed since its last export, skipped" in result.stdout
+
+        # a different stateaid file changes the inputs of all years
+        mock.get(state_aids_url, content=state_aids_content + b"\0")
+        result = runner.invoke(app, args, prog_name='eu-state-aids')
+        assert "not changed" not in result.stdout
+
+    with open(tmp_path / "manifest.json") as f:
+        manifest = json.load(f)
+    assert sorted(manifest["periods"]) == ["export:2015", "export:2016"]
+
+
+def test_bg_load_year(tmp_path):
+    with open(Path("./tests") / "bg_projects_sample.xlsx", mode='rb') as sample_xls:
+        sample_content = sample_xls.read()
+    with open(Path("./tests") / "bg_state_aids.xlsx", mode='rb') as state_aids_xls:
+        state_aids_content = state_aids_xls.read()
+
+    with open(tmp_path / "projects_2015.xlsx", mode='wb') as f:
+        f.write(sample_content)
+
+    with pytest.raises(ValueError, match="No cached stateaid data"):
+        bg.load_year("2015", tmp_path, offline=True)
+    with requests_mock.Mocker() as mock:
+        mock.get(state_aids_url, content=state_aids_content)
+        df = bg.load_year("2015", tmp_path)
+    assert len(df) == 188
+    assert not os.path.exists(tmp_path / "2015.csv")
+
+    # the same records are exported by the export command
+    with requests_mock.Mocker():
+        runner.invoke(
+            app, ["bg", "export", "2015", f"--local-path={tmp_path}", "--offline"], prog_name='eu-state-aids'
+        )
+    with open(tmp_path / "2015.csv") as csv:
+        assert df.to_csv(na_rep='', index=False) == csv.read()
+
+
+def test_it_load_period(tmp_path):
+    with open(tmp_path / "misure.csv", "w") as f:
+        f.write(misure_test_csv)
+    write_aiuti_zip(tmp_path / "aiuti_2019_03.xml.zip")
+    write_aiuti_zip(tmp_path / "aiuti_2019_07.xml.zip")
+    # aids with missing keys are not exported, nor loaded
+    write_aiuti_zip(
+        tmp_path / "aiuti_2019_09.xml.zip",
+        re.sub(r"<CODICE_FISCALE_BENEFICIARIO>.*?</CODICE_FISCALE_BENEFICIARIO>", "", aiuti_test_xml)
+    )
+
+    with pytest.raises(ValueError, match="Invalid year, month value"):
+        it.load_period("2019_13", tmp_path)
+
+    with requests_mock.Mocker() as mock:
+        mock.get(re.compile("OpenData_Aiuti_2019_"), status_code=404)
+        batches = list(it.iter_aids("2019", tmp_path))
+        df = it.load_period("2019", tmp_path, misure_df=it.read_misure(tmp_path))
+    assert len(batches) == 2
+    assert [b.n_records.sum() for b in batches] == [5, 5]
+    assert list(df.columns) == it.EXPORT_KEYS + it.EXPORT_VALUES
+    assert df.n_records.sum() == 10
+    assert not os.path.exists(tmp_path / "2019.csv")
+    assert df.set_index('cf_benef').componenti_importo_aiuto.to_dict() == {
+        "01234567890": 2701.0, "RSSMRA80A01H501U": 20.5
+    }
+
+
+def test_results_query(tmp_path):
+    with open(Path("./tests") / "bg_projects_sample.xlsx", mode='rb') as sample_xls:
+        sample_content = sample_xls.read()
+    with open(Path("./tests") / "bg_state_aids.xlsx", mode='rb') as state_aids_xls:
+        state_aids_content = state_aids_xls.read()
+
+    os.makedirs(tmp_path / "bg")
+    os.makedirs(tmp_path / "it")
+    with open(tmp_path / "bg" / "projects_2015.xlsx", mode='wb') as f:
+        f.write(sample_content)
+    with open(tmp_path / "it" / "misure.csv", "w") as f:
+        f.write(misure_test_csv)
+    write_aiuti_zip(tmp_path / "it" / "aiuti_2019_03.xml.zip")
+    db = f"--results-db={tmp_path / 'results.db'}"
+
+    result = runner.invoke(app, ["query", db], prog_name='eu-state-aids')
+    assert result.exit_code == 1
+    assert "export with the --results-db option first" in result.stdout
+
+    with requests_mock.Mocker() as mock:
+        mock.get(state_aids_url, content=state_aids_content)
+        runner.invoke(
+            app, ["bg", "export", "2015", f"--local-path={tmp_path / 'bg'}"], prog_name='eu-state-aids'
+        )
+        # exported periods are not skipped, unless stored
+        for _ in range(2):
+            result = runner.invoke(
+                app, ["bg", "export", "2015", f"--local-path={tmp_path / 'bg'}", db], prog_name='eu-state-aids'
+            )
+        assert "skipped" in result.stdout
+    result = runner.invoke(
+        app, ["it", "export", "2019_03", f"--local-path={tmp_path / 'it'}", db], prog_name='eu-state-aids'
+    )
+    assert f"Records stored into {tmp_path / 'results.db'}" in result.stdout
+
+    result = runner.invoke(app, ["query", db, "--totals-by=country"], prog_name='eu-state-aids')
+    assert result.exit_code == 0
+    lines = result.stdout.splitlines()
+    assert lines[0] == "country,amount,records"
+    assert [line.split(",")[0] for line in lines[1:]] == ["bg", "it"]
+    assert lines[1].endswith(",188")
+    assert lines[2] == "it,1360.75,2"
+
+    result = runner.invoke(app, ["query", db, "--beneficiary=01234567890"], prog_name='eu-state-aids')
+    assert result.stdout == (
+        "country,period,beneficiary_id,beneficiary_name,scheme,program,amount\n"
+        "it,2019_03,01234567890,ACME S.R.L.,SA.12345,FESR,1350.5\n"
+    )
+    df_2015 = pd.read_csv(tmp_path / "bg" / "2015.csv", dtype={"ID of the beneficiary": object})
+    beneficiary_id = df_2015["ID of the beneficiary"][0][:-2]
+    result = runner.invoke(app, ["query", db, f"--beneficiary={beneficiary_id}"], prog_name='eu-state-aids')
+    assert result.stdout.splitlines()[1].startswith(
+        f"bg,2015,{beneficiary_id},{df_2015['Name of the beneficiary'][0]}"
+    )
+
+    result = runner.invoke(app, ["query", db, "--name=rossi", "--totals-by=scheme"], prog_name='eu-state-aids')
+    assert result.stdout == "scheme,amount,records\nSA.54321,10.25,1\n"
+    # empty filters are ignored
+    result = runner.invoke(app, ["query", db, "--name=", "--country=it"], prog_name='eu-state-aids')
+    assert len(result.stdout.splitlines()) == 3
+    result = runner.invoke(app, ["query", db, "--totals-by=program"], prog_name='eu-state-aids')
+    assert result.exit_code == 1
+
+    # the records of a period are replaced when it is exported again
+    result = runner.invoke(
+        app, ["it", "export", "2019_03", f"--local-path={tmp_path / 'it'}", db, "--force"],
+        prog_name='eu-state-aids'
+    )
+    result = runner.invoke(app, ["query", db, "--country=it", "--limit=0"], prog_name='eu-state-aids')
+    assert len(result.stdout.splitlines()) == 3
+
+
+def test_results_store_closed_when_skipped(monkeypatch, tmp_path):
+    with open(tmp_path / "misure.csv", "w") as f:
+        f.write(misure_test_csv)
+    write_aiuti_zip(tmp_path / "aiuti_2019_03.xml.zip")
+    closed = []
+    monkeypatch.setattr(results.ResultsStore, "close", lambda self: closed.append(self.connection.close()))
+
+    args = ["it", "export", "2019_03", f"--local-path={tmp_path}", f"--results-db={tmp_path / 'results.db'}"]
+    for _ in range(2):
+        result = runner.invoke(app, args, prog_name='eu-state-aids')
+    assert "skipped" in result.stdout
+    assert len(closed) == 2
+
+
+def test_benchmark_generators(tmp_path):
+    from benchmarks import generators
+
+    codes = generators.measure_codes(20)
+    generators.write_aiuti_zip(tmp_path / "aiuti.xml.zip", 0.05, codes)
+    adf = it.parse_aiuti(tmp_path / "aiuti.xml.zip")
+    assert len(adf) > 0
+    assert adf.cod_ce.str.fullmatch(r"SA\.\d+").all()
+
+    generators.write_misure_zip(tmp_path / "misure.xml.zip", codes)
+    assert set(it.parse_misure(tmp_path / "misure.xml.zip").cod_ce) <= {f"SA.{c}" for c in codes}
+
+    programs = generators.program_codes(10)
+    generators.write_bg_projects_xlsx(tmp_path / "projects_2019.xlsx", 50, programs)
+    generators.write_bg_stateaid_xlsx(tmp_path / "stateaid.xlsx", programs, codes[:10])
+    eu_df = bg.read_projects("2019", tmp_path)
+    assert len(eu_df) == 50
+    stateaid_df = pd.read_excel(tmp_path / "stateaid.xlsx", header=1).iloc[:, :10]
+    eu_df = bg.transform_projects(eu_df, "2019", "2014", bg.StateAidIndex(stateaid_df))
+    assert len(eu_df) > 0
+
+
+def test_fetch_startup_imports(http_server, tmp_path):
+    # fetch commands never import pandas, nor the other countries' modules
+    script = (
+        "import sys; from eu_state_aids import it; it.rna_mirror_url = sys.argv[1]; "
+        "from eu_state_aids.main import app; app(sys.argv[2:], prog_name='eu-state-aids')"
+    )
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", script, http_server,
+         "it", "fetch", "2019_03", f"--local-path={tmp_path}"],
+        capture_output=True, text=True
+    )
+    assert "File not found" in result.stdout
+    imported = {
+        line.split("|")[-1].strip() for line in result.stderr.splitlines() if line.startswith("import time:")
+    }
+    assert "eu_state_aids.it" in imported
+    assert not imported & {"pandas", "numpy", "pandas_read_xml", "eu_state_aids.bg"}
+
+
+def test_help_startup_imports():
+    # the main help lists the countries' sub-commands without importing their modules
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c",
+         "from eu_state_aids.main import app; app(['--help'], prog_name='eu-state-aids')"],
+        capture_output=True, text=True
+    )
+    assert "Italian state aids" in result.stdout and "Bulgarian state aids" in result.stdout
+    imported = {
+        line.split("|")[-1].strip() for line in result.stderr.splitlines() if line.startswith("import time:")
+    }
+    assert "eu_state_aids.main" in imported
+    assert not imported & {"eu_state_aids.it", "eu_state_aids.bg", "requests", "validators", "pandas"}
+
+
+def _write_task(path, content):
+    with open(path, "w") as f:
+        f.write(content)
+
+
+def _copy_task(source, path):
+    with open(source) as f:
+        _write_task(path, f.read().upper())
+
+
+def _failing_task(path):
+    raise ValueError(f"cannot write {path}")
+
+
+@pytest.mark.parametrize("workers", [1, 2])
+def test_pipeline_run_tasks(tmp_path, workers):
+    a, b, c, d = (tmp_path / f"{n}.txt" for n in "abcd")
+    tasks = [
+        # given before the tasks it depends on
+        pipeline.Task("copy", _copy_task, (a, b), inputs=[a], outputs=[b]),
+        pipeline.Task("write", _write_task, (a, "a"), outputs=[a]),
+        pipeline.Task("fail", _failing_task, (c,), outputs=[c]),
+        pipeline.Task("after-fail", _copy_task, (c, d), inputs=[c], outputs=[d]),
+        pipeline.Task("missing", _copy_task, (d, tmp_path / "e.txt"), inputs=[tmp_path / "x.txt"]),
+    ]
+    outcomes = pipeline.run_tasks(tasks, workers=workers)
+    assert outcomes == {
+        "copy": "done",
+        "write": "done",
+        "fail": f"failed: ValueError: cannot write {c}",
+        "after-fail": "skipped: fail not done",
+        "missing": f"skipped: missing {tmp_path / 'x.txt'}",
+    }
+    assert b.read_text() == "A"
+
+
+def test_pipeline_dependencies_errors(tmp_path):
+    a, b = tmp_path / "a.txt", tmp_path / "b.txt"
+    with pytest.raises(ValueError, match="depend on each other"):
+        pipeline.dependencies([
+            pipeline.Task("ab", _copy_task, inputs=[a], outputs=[b]),
+            pipeline.Task("ba", _copy_task, inputs=[b], outputs=[a]),
+        ])
+    with pytest.raises(ValueError, match="written by both"):
+        pipeline.dependencies([
+            pipeline.Task("a1", _write_task, outputs=[a]),
+            pipeline.Task("a2", _write_task, outputs=[a]),
+        ])
+
+
+def test_pipeline_tasks_options(tmp_path):
+    # all the options of the commands are passed, by name, as their defaults are typer.Option objects
+    for tasks in (it.pipeline_tasks(["2019"], tmp_path, True), bg.pipeline_tasks(["2019"], tmp_path, True)):
+        for task in tasks:
+            parameters = inspect.signature(task.func).parameters.values()
+            assert not task.args
+            assert [p.name for p in parameters if p.default is inspect.Parameter.empty] == [], task
+            assert [p.name for p in parameters if isinstance(p.default, typer.models.OptionInfo)] == [], task
+            if "force" in task.func.keywords:
+                assert task.func.keywords["force"] is True
+
+
+def test_pipeline_tasks_bg_export_without_stateaid(tmp_path):
+    # the stateaid cache has no entry for the stateaid url, the export fails
+    shutil.copy(Path("./tests") / "bg_projects_sample.xlsx", tmp_path / "projects_2015.xlsx")
+    os.makedirs(tmp_path / "cache" / "stateaid")
+    with open(tmp_path / "cache" / "stateaid" / "index.json", "w") as f:
+        json.dump({}, f)
+
+    tasks = [t for t in bg.pipeline_tasks(["2015"], tmp_path) if t.name == "bg:export:2015"]
+    with requests_mock.Mocker():
+        outcomes = pipeline.run_tasks(tasks)
+    assert outcomes["bg:export:2015"] == "failed: exit code 1"
+    assert not os.path.exists(tmp_path / "2015.csv")
+
+
+def test_run(tmp_path):
+    with open(Path("./tests") / "bg_projects_sample.xlsx", mode='rb') as sample_xls:
+        sample_content = sample_xls.read()
+    with open(Path("./tests") / "bg_state_aids.xlsx", mode='rb') as state_aids_xls:
+        state_aids_content = state_aids_xls.read()
+
+    with requests_mock.Mocker() as mock:
+        mock.get(excel_test_url, content=sample_content)
+        mock.get(bg.DEFAULT_STATEAID_URL, content=state_aids_content)
+        result = runner.invoke(
+            app, ["run", "--countries", "bg", "--years", "2015", f"--local-path={tmp_path}"],
+            prog_name='eu-state-aids'
+        )
+    assert result.exit_code == 0
+    assert "bg:stateaid: done" in result.stdout
+    assert "bg:fetch:2015: done" in result.stdout
+    assert "bg:export:2015: done" in result.stdout
+    assert "3 of 3 tasks done" in result.stdout
+    assert os.path.exists(tmp_path / "bg" / "2015.csv")
+
+    result = runner.invoke(app, ["run", "--countries", "xx", "--years", "2015"], prog_name='eu-state-aids')
+    assert result.exit_code == 1
+    assert "Unknown country: xx" in result.stdout